@@ -0,0 +1,58 @@
+# Measures BruteForceIndex.query latency as a function of hnsw:batch_size, which is
+# the capacity of the brute force layer consulted on every PersistentLocalHnswSegment
+# query.
+#
+# Usage (from the chroma directory):
+#   PYTHONPATH=. python bin/benchmarks/brute_force_query.py [--dim 384] [--k 10]
+import argparse
+import time
+import numpy as np
+from chromadb.segment.impl.vector.brute_force_index import BruteForceIndex
+from chromadb.types import EmbeddingRecord, Operation, ScalarEncoding, VectorQuery
+
+BATCH_SIZES = [100, 500, 1000, 2500, 5000, 10000]
+
+
+def run(batch_size: int, dim: int, k: int, n_queries: int, space: str) -> float:
+    rng = np.random.default_rng(42)
+    index = BruteForceIndex(size=batch_size, dimensionality=dim, space=space)
+    index.upsert(
+        [
+            EmbeddingRecord(
+                id=str(i),
+                seq_id=i,
+                embedding=v,
+                encoding=ScalarEncoding.FLOAT32,
+                metadata=None,
+                operation=Operation.ADD,
+            )
+            for i, v in enumerate(rng.random((batch_size, dim), dtype=np.float32))
+        ]
+    )
+    query = VectorQuery(
+        vectors=rng.random((n_queries, dim), dtype=np.float32).tolist(),
+        k=k,
+        allowed_ids=None,
+        include_embeddings=False,
+        options=None,
+    )
+    index.query(query)  # warm up
+    repeats = 20
+    start = time.perf_counter()
+    for _ in range(repeats):
+        index.query(query)
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=1)
+    parser.add_argument("--space", default="l2", choices=["l2", "cosine", "ip"])
+    args = parser.parse_args()
+
+    print(f"{'batch_size':>10} {'latency (ms)':>14}")
+    for batch_size in BATCH_SIZES:
+        latency = run(batch_size, args.dim, args.k, args.queries, args.space)
+        print(f"{batch_size:>10} {latency * 1000:>14.3f}")
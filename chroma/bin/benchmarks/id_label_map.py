@@ -0,0 +1,165 @@
+# Compares IdLabelMap with the three dicts it replaced (id -> label, label -> id and
+# id -> SeqID) on the write path of LocalHnswSegment, which applies batches of
+# hnsw:batch_size records (put_many, get_label, delete_many), and on mapping the
+# labels of query results back to IDs and SeqIDs. Also reports the memory each
+# structure holds per million IDs, including the ID strings the dicts keep alive.
+#
+# Usage (from the chroma directory):
+#   python bin/benchmarks/id_label_map.py [--records 200000] [--batch-size 100]
+#       [--k 10]
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from chromadb.segment.impl.vector.id_label_map import IdLabelMap  # noqa: E402
+
+
+def timed(f: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+
+def batches(ids: List[str], batch_size: int) -> List[List[str]]:
+    return [ids[i : i + batch_size] for i in range(0, len(ids), batch_size)]
+
+
+def run_map(
+    ids: List[str], batch_size: int, results: np.ndarray  # type: ignore
+) -> Dict[str, float]:
+    id_map = IdLabelMap()
+
+    def put() -> None:
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start : start + batch_size]
+            labels = list(range(start + 1, start + len(batch) + 1))
+            id_map.put_many(batch, labels, labels)
+
+    def get() -> None:
+        for id in ids:
+            id_map.get_label(id)
+
+    def get_batch() -> None:
+        for batch in batches(ids, batch_size):
+            id_map.get_labels(batch)
+
+    def lookup() -> None:
+        id_map.ids_for(results)
+        id_map.seq_ids_for(results).tolist()
+
+    def delete() -> None:
+        for batch in batches(ids[::2], batch_size):
+            id_map.delete_many(batch)
+
+    return {
+        "put": timed(put),
+        "get_label": timed(get),
+        "get_labels": timed(get_batch),
+        "query results": timed(lookup),
+        "delete": timed(delete),
+    }
+
+
+def run_dicts(
+    ids: List[str], batch_size: int, results: np.ndarray  # type: ignore
+) -> Dict[str, float]:
+    id_to_label: Dict[str, int] = {}
+    label_to_id: Dict[int, str] = {}
+    id_to_seq_id: Dict[str, int] = {}
+
+    def put() -> None:
+        for label, id in enumerate(ids, 1):
+            id_to_label[id] = label
+            label_to_id[label] = id
+            id_to_seq_id[id] = label
+
+    def get() -> None:
+        for id in ids:
+            id_to_label.get(id)
+
+    def get_batch() -> None:
+        for batch in batches(ids, batch_size):
+            [id_to_label.get(id) for id in batch]
+
+    def lookup() -> None:
+        result_ids = [label_to_id[label] for label in results.ravel().tolist()]
+        [id_to_seq_id[id] for id in result_ids]
+
+    def delete() -> None:
+        for batch in batches(ids[::2], batch_size):
+            for id in batch:
+                label = id_to_label.pop(id)
+                del label_to_id[label]
+                del id_to_seq_id[id]
+
+    return {
+        "put": timed(put),
+        "get_label": timed(get),
+        "get_labels": timed(get_batch),
+        "query results": timed(lookup),
+        "delete": timed(delete),
+    }
+
+
+def memory(build: Callable[[List[str]], object], records: int) -> float:
+    """MB held per million IDs by the structure build returns. The IDs are
+    created inside the traced region so the strings a structure keeps count."""
+    gc.collect()
+    tracemalloc.start()
+    ids = [f"id_{i}" for i in range(records)]
+    structure = build(ids)
+    del ids
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del structure
+    return held / records
+
+
+def build_map(ids: List[str]) -> IdLabelMap:
+    id_map = IdLabelMap()
+    labels = list(range(1, len(ids) + 1))
+    id_map.put_many(ids, labels, labels)
+    return id_map
+
+
+def build_dicts(ids: List[str]) -> object:
+    labels = range(1, len(ids) + 1)
+    return (dict(zip(ids, labels)), dict(zip(labels, ids)), dict(zip(ids, labels)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=200000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=1000)
+    args = parser.parse_args()
+
+    ids = [f"id_{i}" for i in range(args.records)]
+    rng = np.random.default_rng(42)
+    results = rng.integers(1, args.records + 1, (args.queries, args.k), np.uint64)
+
+    timings = {
+        "IdLabelMap": run_map(ids, args.batch_size, results),
+        "dicts": run_dicts(ids, args.batch_size, results),
+    }
+    print(f"{'':>14}" + "".join(f"{name:>14}" for name in timings))
+    for operation in timings["dicts"]:
+        print(
+            f"{operation:>14}"
+            + "".join(f"{t[operation] * 1000:>11.1f} ms" for t in timings.values())
+        )
+    print(
+        f"{'MB per 1M ids':>14}"
+        + "".join(
+            f"{memory(build, args.records):>14.1f}"
+            for build in (build_map, build_dicts)
+        )
+    )
@@ -0,0 +1,103 @@
+# Compares persistent ingest and query throughput under SQLite pragma profiles (the
+# sqlite_* settings). Ingest adds records to a collection in batches; queries are
+# filtered gets (served by the metadata segment) and nearest neighbour queries.
+#
+# Usage (from the chroma directory):
+#   PYTHONPATH=. python bin/benchmarks/sqlite_profiles.py [--records 20000] [--dim 128]
+#       [--persist-directory /tmp/chroma-bench]
+import argparse
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, Tuple
+import numpy as np
+from chromadb.api import API
+from chromadb.config import Settings, System
+
+PROFILES: Dict[str, Dict[str, Any]] = {
+    "default": {},
+    "wal": {"sqlite_journal_mode": "WAL", "sqlite_synchronous": "NORMAL"},
+    "wal+memory": {
+        "sqlite_journal_mode": "WAL",
+        "sqlite_synchronous": "NORMAL",
+        "sqlite_mmap_size": 256 << 20,
+        "sqlite_cache_size": -64 << 10,
+        "sqlite_temp_store": "MEMORY",
+        "sqlite_busy_timeout": 5000,
+    },
+    "unsafe": {"sqlite_journal_mode": "OFF", "sqlite_synchronous": "OFF"},
+}
+
+
+def run(
+    profile: Dict[str, Any],
+    data: np.ndarray,  # type: ignore
+    batch_size: int,
+    queries: int,
+    persist_directory: str,
+) -> Tuple[float, float, float]:
+    """Return records ingested per second, filtered gets per second and queries per
+    second"""
+    shutil.rmtree(persist_directory, ignore_errors=True)
+    system = System(
+        Settings(
+            is_persistent=True,
+            persist_directory=persist_directory,
+            anonymized_telemetry=False,
+            **profile,
+        )
+    )
+    client = system.instance(API)
+    system.start()
+    collection = client.create_collection("benchmark")
+    n = len(data)
+
+    start = time.perf_counter()
+    for i in range(0, n, batch_size):
+        ids = range(i, min(i + batch_size, n))
+        collection.add(
+            ids=[str(j) for j in ids],
+            embeddings=data[i : i + batch_size].tolist(),
+            metadatas=[{"bucket": j % 100, "name": f"record {j}"} for j in ids],
+            documents=[f"document {j}" for j in ids],
+        )
+    ingest_rate = n / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(queries):
+        collection.get(where={"bucket": i % 100}, include=["metadatas"])
+    get_rate = queries / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(queries):
+        collection.query(query_embeddings=[data[i].tolist()], n_results=10)
+    query_rate = queries / (time.perf_counter() - start)
+
+    system.stop()
+    shutil.rmtree(persist_directory, ignore_errors=True)
+    return ingest_rate, get_rate, query_rate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--persist-directory", default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    data = rng.random((args.records, args.dim), dtype=np.float32)
+    base_directory = args.persist_directory or tempfile.mkdtemp()
+
+    print(f"{'profile':>12} {'ingest/s':>12} {'gets/s':>10} {'queries/s':>10}")
+    for name, profile in PROFILES.items():
+        ingest_rate, get_rate, query_rate = run(
+            profile,
+            data,
+            args.batch_size,
+            args.queries,
+            f"{base_directory}/{name}",
+        )
+        print(f"{name:>12} {ingest_rate:>12.0f} {get_rate:>10.1f} {query_rate:>10.1f}")
@@ -0,0 +1,91 @@
+# Measures embeddings queue ingest throughput when records are submitted one at a
+# time with submit_embedding, and in batches of increasing size with
+# submit_embeddings.
+#
+# Usage (from the chroma directory):
+#   PYTHONPATH=. python bin/benchmarks/submit_embeddings.py [--records 10000] [--dim 384]
+#       [--persist-directory /tmp/chroma-bench]
+import argparse
+import shutil
+import time
+from typing import List, Optional, Sequence
+import numpy as np
+from chromadb.config import Settings, System
+from chromadb.db.impl.sqlite import SqliteDB
+from chromadb.types import (
+    EmbeddingRecord,
+    Operation,
+    ScalarEncoding,
+    SubmitEmbeddingRecord,
+)
+
+BATCH_SIZES = [1, 10, 100, 1000, 10000]
+
+
+def records(n: int, dim: int) -> List[SubmitEmbeddingRecord]:
+    rng = np.random.default_rng(42)
+    return [
+        SubmitEmbeddingRecord(
+            id=str(i),
+            embedding=v,
+            encoding=ScalarEncoding.FLOAT32,
+            metadata={"chroma:document": f"document {i}", "i": i},
+            operation=Operation.ADD,
+        )
+        for i, v in enumerate(rng.random((n, dim), dtype=np.float32).tolist())
+    ]
+
+
+def run(
+    batch_size: Optional[int],
+    data: Sequence[SubmitEmbeddingRecord],
+    persist_directory: Optional[str],
+) -> float:
+    """Return the number of records ingested per second. A batch size of None submits
+    each record with submit_embedding."""
+    if persist_directory is not None:
+        shutil.rmtree(persist_directory, ignore_errors=True)
+        settings = Settings(
+            allow_reset=True, is_persistent=True, persist_directory=persist_directory
+        )
+    else:
+        settings = Settings(allow_reset=True)
+    system = System(settings)
+    db = system.instance(SqliteDB)
+    system.start()
+
+    def consume(embeddings: Sequence[EmbeddingRecord]) -> None:
+        pass
+
+    db.subscribe("benchmark", consume, start=db.min_seqid())
+
+    start = time.perf_counter()
+    if batch_size is None:
+        for record in data:
+            db.submit_embedding("benchmark", record)
+    else:
+        for i in range(0, len(data), batch_size):
+            db.submit_embeddings("benchmark", data[i : i + batch_size])
+    elapsed = time.perf_counter() - start
+
+    db.reset_state()
+    system.stop()
+    return len(data) / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--persist-directory", default=None)
+    args = parser.parse_args()
+
+    data = records(args.records, args.dim)
+    persist_directory = args.persist_directory
+
+    print(f"{'batch_size':>16} {'records/s':>12}")
+    rate = run(None, data, persist_directory)
+    print(f"{'submit_embedding':>16} {rate:>12.0f}")
+    for batch_size in BATCH_SIZES:
+        rate = run(batch_size, data, persist_directory)
+        print(f"{batch_size:>16} {rate:>12.0f}")
@@ -0,0 +1,69 @@
+# Compares the ScalarEncodings a collection can store its vectors with
+# (hnsw:encoding): stored bytes per vector, decode throughput, and the recall@k and
+# latency of an HNSW index built from the decoded vectors. Recall is measured against
+# exact search over the original float32 vectors.
+#
+# Usage (from the chroma directory):
+#   PYTHONPATH=. python bin/benchmarks/vector_encodings.py [--n 20000] [--dim 1536]
+import argparse
+import time
+import hnswlib
+import numpy as np
+from chromadb.ingest import decode_vectors, encode_vector
+from chromadb.types import ScalarEncoding
+from chromadb.utils import distance_functions
+
+ENCODINGS = [ScalarEncoding.FLOAT32, ScalarEncoding.FLOAT16, ScalarEncoding.INT8]
+
+
+def run(
+    encoding: ScalarEncoding,
+    data: np.ndarray,  # type: ignore
+    queries: np.ndarray,  # type: ignore
+    truth: np.ndarray,  # type: ignore
+    k: int,
+) -> None:
+    blobs = [encode_vector(v, encoding) for v in data]
+    start = time.perf_counter()
+    decoded = np.asarray(decode_vectors(blobs, encoding), dtype=np.float32)
+    decode_time = time.perf_counter() - start
+
+    index = hnswlib.Index(space="l2", dim=data.shape[1])
+    index.init_index(max_elements=len(data), ef_construction=100, M=16)
+    index.set_ef(max(k, 50))
+    index.add_items(decoded, np.arange(len(data)))
+
+    start = time.perf_counter()
+    labels, _ = index.knn_query(queries, k=k)
+    query_time = (time.perf_counter() - start) / len(queries)
+
+    recall = np.mean(
+        [len(set(found) & set(expected)) / k for found, expected in zip(labels, truth)]
+    )
+    print(
+        f"{encoding.value:>8} {len(blobs[0]):>14} "
+        f"{len(data) / decode_time:>16.0f} {recall:>10.4f} {query_time * 1000:>11.3f}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    data = rng.standard_normal((args.n, args.dim), dtype=np.float32)
+    queries = rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+    truth, _ = distance_functions.nearest(
+        "l2", queries, data, distance_functions.squared_norms(data), args.k
+    )
+
+    print(
+        f"{'encoding':>8} {'bytes/vector':>14} {'decoded/s':>16} "
+        f"{'recall@' + str(args.k):>10} {'query (ms)':>11}"
+    )
+    for encoding in ENCODINGS:
+        run(encoding, data, queries, truth, args.k)
@@ -1,12 +1,14 @@
 from abc import ABC, abstractmethod
-from typing import Sequence, Optional
+from typing import List, Sequence, Optional
 from uuid import UUID
 from chromadb.api.models.Collection import Collection
 from chromadb.api.types import (
     CollectionMetadata,
+    CollectionStatistics,
     Documents,
     EmbeddingFunction,
     Embeddings,
+    Facet,
     IDs,
     Include,
     Metadatas,
@@ -243,14 +245,77 @@ class API(Component, ABC):
         pass
 
     @abstractmethod
-    def _count(self, collection_id: UUID) -> int:
+    def _count(
+        self,
+        collection_id: UUID,
+        where: Optional[Where] = {},
+        where_document: Optional[WhereDocument] = {},
+    ) -> int:
         """[Internal] Returns the number of entries in a collection specified by UUID.
 
         Args:
             collection_id: The UUID of the collection to count the embeddings in.
+            where: Conditional filtering on metadata. Defaults to {}.
+            where_document: Conditional filtering on documents. Defaults to {}.
+
+        Returns:
+            int: The number of embeddings in the collection, or of those matching
+                 the filters
+
+        """
+        pass
+
+    @abstractmethod
+    def _statistics(self, collection_id: UUID) -> CollectionStatistics:
+        """[Internal] Returns the statistics of a collection specified by UUID.
+
+        Args:
+            collection_id: The UUID of the collection.
+
+        Returns:
+            CollectionStatistics: The number of embeddings in the collection, the
+                                  total size of their documents in bytes, and the
+                                  number of operations applied to it
+
+        """
+        pass
+
+    @abstractmethod
+    def _facets(
+        self,
+        collection_id: UUID,
+        key: str,
+        where: Optional[Where] = {},
+        where_document: Optional[WhereDocument] = {},
+        limit: Optional[int] = None,
+    ) -> List[Facet]:
+        """[Internal] Returns the distinct values of a metadata key in a collection
+        specified by UUID, with the number of entries having each value.
+
+        Args:
+            collection_id: The UUID of the collection.
+            key: The metadata key.
+            where: Conditional filtering on metadata. Defaults to {}.
+            where_document: Conditional filtering on documents. Defaults to {}.
+            limit: The maximum number of values to return. Defaults to None.
+
+        Returns:
+            List[Facet]: The values and their counts, from the most to the least
+                         common value
+
+        """
+        pass
+
+    @abstractmethod
+    def _compact(self, collection_id: UUID) -> bool:
+        """[Internal] Rebuilds the vector index of a collection specified by UUID
+        without its deleted embeddings, reclaiming their space.
+
+        Args:
+            collection_id: The UUID of the collection to compact.
 
         Returns:
-            int: The number of embeddings in the collection
+            bool: True if the index was compacted, False if there was nothing to do.
 
         """
         pass
@@ -289,7 +354,9 @@ class API(Component, ABC):
         Args:
             ids: The IDs of the entries to get. Defaults to None.
             where: Conditional filtering on metadata. Defaults to {}.
-            sort: The column to sort the entries by. Defaults to None.
+            sort: The metadata key to sort the entries by, prefixed with - to sort in
+                  descending order. Entries without the key come last.
+                  Defaults to None.
             limit: The maximum number of entries to return. Defaults to None.
             offset: The number of entries to skip before returning. Defaults to None.
             page: The page number to return. Defaults to None.
@@ -1,4 +1,4 @@
-from typing import Optional, cast
+from typing import List, Optional, cast
 from chromadb.api import API
 from chromadb.config import Settings, System
 from chromadb.api.types import (
@@ -13,6 +13,8 @@ from chromadb.api.types import (
     GetResult,
     QueryResult,
     CollectionMetadata,
+    CollectionStatistics,
+    Facet,
 )
 import chromadb.utils.embedding_functions as ef
 import requests
@@ -145,13 +147,65 @@ class FastAPI(API):
         raise_chroma_error(resp)
 
     @override
-    def _count(self, collection_id: UUID) -> int:
+    def _count(
+        self,
+        collection_id: UUID,
+        where: Optional[Where] = {},
+        where_document: Optional[WhereDocument] = {},
+    ) -> int:
         """Returns the number of embeddings in the database"""
+        url = self._api_url + "/collections/" + str(collection_id) + "/count"
+        if where or where_document:
+            resp = self._session.post(
+                url,
+                data=json.dumps({"where": where, "where_document": where_document}),
+            )
+        else:
+            resp = self._session.get(url)
+        raise_chroma_error(resp)
+        return cast(int, resp.json())
+
+    @override
+    def _statistics(self, collection_id: UUID) -> CollectionStatistics:
+        """Returns the statistics of a collection"""
         resp = self._session.get(
-            self._api_url + "/collections/" + str(collection_id) + "/count"
+            self._api_url + "/collections/" + str(collection_id) + "/statistics"
         )
         raise_chroma_error(resp)
-        return cast(int, resp.json())
+        return cast(CollectionStatistics, resp.json())
+
+    @override
+    def _facets(
+        self,
+        collection_id: UUID,
+        key: str,
+        where: Optional[Where] = {},
+        where_document: Optional[WhereDocument] = {},
+        limit: Optional[int] = None,
+    ) -> List[Facet]:
+        """Returns the distinct values of a metadata key and their counts"""
+        resp = self._session.post(
+            self._api_url + "/collections/" + str(collection_id) + "/facets",
+            data=json.dumps(
+                {
+                    "key": key,
+                    "where": where,
+                    "where_document": where_document,
+                    "limit": limit,
+                }
+            ),
+        )
+        raise_chroma_error(resp)
+        return cast(List[Facet], resp.json())
+
+    @override
+    def _compact(self, collection_id: UUID) -> bool:
+        """Rebuilds the vector index of a collection without its deleted embeddings"""
+        resp = self._session.post(
+            self._api_url + "/collections/" + str(collection_id) + "/compact"
+        )
+        raise_chroma_error(resp)
+        return cast(bool, resp.json())
 
     @override
     def _peek(self, collection_id: UUID, n: int = 10) -> GetResult:
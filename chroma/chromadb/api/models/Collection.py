@@ -5,7 +5,9 @@ import chromadb.utils.embedding_functions as ef
 
 from chromadb.api.types import (
     CollectionMetadata,
+    CollectionStatistics,
     Embedding,
+    Facet,
     Include,
     Metadata,
     Document,
@@ -25,6 +27,9 @@ from chromadb.api.types import (
     validate_where,
     validate_where_document,
     validate_n_results,
+    validate_sort,
+    validate_facet_key,
+    validate_facet_limit,
     validate_embeddings,
 )
 import logging
@@ -57,14 +62,37 @@ class Collection(BaseModel):
     def __repr__(self) -> str:
         return f"Collection(name={self.name})"
 
-    def count(self) -> int:
+    def count(
+        self,
+        where: Optional[Where] = None,
+        where_document: Optional[WhereDocument] = None,
+    ) -> int:
         """The total number of embeddings added to the database
 
+        Args:
+            where: A Where type dict used to count only the matching embeddings. E.g. `{"color" : "red", "price": 4.20}`. Optional.
+            where_document: A WhereDocument type dict used to count only the embeddings with matching documents. E.g. `{$contains: {"text": "hello"}}`. Optional.
+
         Returns:
-            int: The total number of embeddings added to the database
+            int: The total number of embeddings added to the database, or of those matching the filters
+
+        """
+        where = validate_where(where) if where else None
+        where_document = (
+            validate_where_document(where_document) if where_document else None
+        )
+        return self._client._count(
+            collection_id=self.id, where=where, where_document=where_document
+        )
 
+    def statistics(self) -> CollectionStatistics:
+        """Statistics of the collection, maintained as it is written so that reading
+        them does not scan it
+
+        Returns:
+            CollectionStatistics: The number of embeddings in the collection (count), the total size of their documents in bytes (document_bytes), and the number of adds, updates, upserts and deletes applied to it
         """
-        return self._client._count(collection_id=self.id)
+        return self._client._statistics(self.id)
 
     def add(
         self,
@@ -106,6 +134,7 @@ class Collection(BaseModel):
         offset: Optional[int] = None,
         where_document: Optional[WhereDocument] = None,
         include: Include = ["metadatas", "documents"],
+        sort: Optional[str] = None,
     ) -> GetResult:
         """Get embeddings and their associate data from the data store. If no ids or where filter is provided returns
         all embeddings up to limit starting at offset.
@@ -117,6 +146,7 @@ class Collection(BaseModel):
             offset: The offset to start returning results from. Useful for paging results with limit. Optional.
             where_document: A WhereDocument type dict used to filter by the documents. E.g. `{$contains: {"text": "hello"}}`. Optional.
             include: A list of what to include in the results. Can contain `"embeddings"`, `"metadatas"`, `"documents"`. Ids are always included. Defaults to `["metadatas", "documents"]`. Optional.
+            sort: A metadata key to sort the results by, e.g. `"page"`, or `"-page"` for descending order. Embeddings without the key come last. Optional.
 
         Returns:
             GetResult: A GetResult object containing the results.
@@ -132,7 +162,7 @@ class Collection(BaseModel):
             self.id,
             ids,
             where,
-            None,
+            validate_sort(sort) if sort is not None else None,
             limit,
             offset,
             where_document=where_document,
@@ -326,6 +356,46 @@ class Collection(BaseModel):
         )
         self._client._delete(self.id, ids, where, where_document)
 
+    def facets(
+        self,
+        key: str,
+        where: Optional[Where] = None,
+        where_document: Optional[WhereDocument] = None,
+        limit: Optional[int] = None,
+    ) -> List[Facet]:
+        """Get the distinct values of a metadata key, with the number of embeddings having each value
+
+        Args:
+            key: The metadata key, e.g. `"source"`.
+            where: A Where type dict used to count only the matching embeddings. E.g. `{"color" : "red", "price": 4.20}`. Optional.
+            where_document: A WhereDocument type dict used to count only the embeddings with matching documents. E.g. `{$contains: {"text": "hello"}}`. Optional.
+            limit: The maximum number of values to return. Optional.
+
+        Returns:
+            List[Facet]: The values (value) and their counts (count), from the most to the least common value
+        """
+        where = validate_where(where) if where else None
+        where_document = (
+            validate_where_document(where_document) if where_document else None
+        )
+        return self._client._facets(
+            self.id,
+            validate_facet_key(key),
+            where=where,
+            where_document=where_document,
+            limit=validate_facet_limit(limit) if limit is not None else None,
+        )
+
+    def compact(self) -> bool:
+        """Rebuild the vector index of this collection without the embeddings that
+        have been deleted or overwritten, reclaiming the space they use. This also
+        happens automatically in the background once enough of the index is deleted.
+
+        Returns:
+            bool: True if the index was compacted, False if there was nothing to do
+        """
+        return self._client._compact(self.id)
+
     def _validate_embedding_set(
         self,
         ids: OneOrMany[ID],
@@ -22,10 +22,15 @@ from chromadb.api.types import (
     Include,
     GetResult,
     QueryResult,
+    CollectionStatistics,
+    Facet,
     validate_metadata,
     validate_update_metadata,
     validate_where,
     validate_where_document,
+    validate_sort,
+    validate_facet_key,
+    validate_facet_limit,
 )
 from chromadb.telemetry.events import CollectionAddEvent, CollectionDeleteEvent
 
@@ -34,6 +39,7 @@ import chromadb.types as t
 from typing import Optional, Sequence, Generator, List, cast, Set, Dict
 from overrides import override
 from uuid import UUID, uuid4
+import numpy as np
 import time
 import logging
 import re
@@ -242,9 +248,19 @@ class SegmentAPI(API):
         coll = self._get_collection(collection_id)
         self._manager.hint_use_collection(collection_id, t.Operation.ADD)
 
-        for r in _records(t.Operation.ADD, ids, embeddings, metadatas, documents):
+        records: List[t.SubmitEmbeddingRecord] = list(
+            _records(
+                t.Operation.ADD,
+                ids,
+                embeddings,
+                metadatas,
+                documents,
+                encoding=_encoding(coll),
+            )
+        )
+        for r in records:
             self._validate_embedding_record(coll, r)
-            self._producer.submit_embedding(coll["topic"], r)
+        self._producer.submit_embeddings(coll["topic"], records)
 
         self._telemetry_client.capture(CollectionAddEvent(str(collection_id), len(ids)))
         return True
@@ -261,9 +277,19 @@ class SegmentAPI(API):
         coll = self._get_collection(collection_id)
         self._manager.hint_use_collection(collection_id, t.Operation.UPDATE)
 
-        for r in _records(t.Operation.UPDATE, ids, embeddings, metadatas, documents):
+        records: List[t.SubmitEmbeddingRecord] = list(
+            _records(
+                t.Operation.UPDATE,
+                ids,
+                embeddings,
+                metadatas,
+                documents,
+                encoding=_encoding(coll),
+            )
+        )
+        for r in records:
             self._validate_embedding_record(coll, r)
-            self._producer.submit_embedding(coll["topic"], r)
+        self._producer.submit_embeddings(coll["topic"], records)
 
         return True
 
@@ -279,9 +305,19 @@ class SegmentAPI(API):
         coll = self._get_collection(collection_id)
         self._manager.hint_use_collection(collection_id, t.Operation.UPSERT)
 
-        for r in _records(t.Operation.UPSERT, ids, embeddings, metadatas, documents):
+        records: List[t.SubmitEmbeddingRecord] = list(
+            _records(
+                t.Operation.UPSERT,
+                ids,
+                embeddings,
+                metadatas,
+                documents,
+                encoding=_encoding(coll),
+            )
+        )
+        for r in records:
             self._validate_embedding_record(coll, r)
-            self._producer.submit_embedding(coll["topic"], r)
+        self._producer.submit_embeddings(coll["topic"], records)
 
         return True
 
@@ -305,12 +341,10 @@ class SegmentAPI(API):
             if where_document is not None and len(where_document) > 0
             else None
         )
+        sort = validate_sort(sort) if sort is not None else None
 
         metadata_segment = self._manager.get_segment(collection_id, MetadataReader)
 
-        if sort is not None:
-            raise NotImplementedError("Sorting is not yet supported")
-
         if page and page_size:
             offset = (page - 1) * page_size
             limit = page_size
@@ -321,6 +355,8 @@ class SegmentAPI(API):
             ids=ids,
             limit=limit,
             offset=offset,
+            keys=_metadata_keys(include),
+            sort=sort,
         )
 
         vectors: Sequence[t.VectorEmbeddingRecord] = []
@@ -369,16 +405,19 @@ class SegmentAPI(API):
         # time a bad idea?
         if (where or where_document) or not ids:
             metadata_segment = self._manager.get_segment(collection_id, MetadataReader)
-            records = metadata_segment.get_metadata(
-                where=where, where_document=where_document, ids=ids
+            matches = metadata_segment.get_metadata(
+                where=where, where_document=where_document, ids=ids, keys=[]
             )
-            ids_to_delete = [r["id"] for r in records]
+            ids_to_delete = [r["id"] for r in matches]
         else:
             ids_to_delete = ids
 
-        for r in _records(t.Operation.DELETE, ids_to_delete):
+        records: List[t.SubmitEmbeddingRecord] = list(
+            _records(t.Operation.DELETE, ids_to_delete)
+        )
+        for r in records:
             self._validate_embedding_record(coll, r)
-            self._producer.submit_embedding(coll["topic"], r)
+        self._producer.submit_embeddings(coll["topic"], records)
 
         self._telemetry_client.capture(
             CollectionDeleteEvent(str(collection_id), len(ids_to_delete))
@@ -386,9 +425,57 @@ class SegmentAPI(API):
         return ids_to_delete
 
     @override
-    def _count(self, collection_id: UUID) -> int:
+    def _count(
+        self,
+        collection_id: UUID,
+        where: Optional[Where] = {},
+        where_document: Optional[WhereDocument] = {},
+    ) -> int:
+        where = validate_where(where) if where is not None and len(where) > 0 else None
+        where_document = (
+            validate_where_document(where_document)
+            if where_document is not None and len(where_document) > 0
+            else None
+        )
+        metadata_segment = self._manager.get_segment(collection_id, MetadataReader)
+        return metadata_segment.count(where=where, where_document=where_document)
+
+    @override
+    def _statistics(self, collection_id: UUID) -> CollectionStatistics:
+        metadata_segment = self._manager.get_segment(collection_id, MetadataReader)
+        return metadata_segment.statistics()
+
+    @override
+    def _facets(
+        self,
+        collection_id: UUID,
+        key: str,
+        where: Optional[Where] = {},
+        where_document: Optional[WhereDocument] = {},
+        limit: Optional[int] = None,
+    ) -> List[Facet]:
+        key = validate_facet_key(key)
+        limit = validate_facet_limit(limit) if limit is not None else None
+        where = validate_where(where) if where is not None and len(where) > 0 else None
+        where_document = (
+            validate_where_document(where_document)
+            if where_document is not None and len(where_document) > 0
+            else None
+        )
         metadata_segment = self._manager.get_segment(collection_id, MetadataReader)
-        return metadata_segment.count()
+        return list(
+            metadata_segment.facets(
+                key, where=where, where_document=where_document, limit=limit
+            )
+        )
+
+    @override
+    def _compact(self, collection_id: UUID) -> bool:
+        self._get_collection(collection_id)
+        # Compaction rewrites the index but not the collection, so like reads it
+        # gives no write hint
+        vector_segment = self._manager.get_segment(collection_id, VectorReader)
+        return vector_segment.compact()
 
     @override
     def _query(
@@ -417,7 +504,7 @@ class SegmentAPI(API):
 
         if where or where_document:
             records = metadata_reader.get_metadata(
-                where=where, where_document=where_document
+                where=where, where_document=where_document, keys=[]
             )
             allowed_ids = [r["id"] for r in records]
 
@@ -443,13 +530,15 @@ class SegmentAPI(API):
             if "distances" in include:
                 distances.append([r["distance"] for r in result])
             if "embeddings" in include:
-                embeddings.append([cast(Embedding, r["embedding"]) for r in result])
+                embeddings.append([_embedding(r["embedding"]) for r in result])
 
         if "documents" in include or "metadatas" in include:
             all_ids: Set[str] = set()
             for id_list in ids:
                 all_ids.update(id_list)
-            records = metadata_reader.get_metadata(ids=list(all_ids))
+            records = metadata_reader.get_metadata(
+                ids=list(all_ids), keys=_metadata_keys(include)
+            )
             metadata_by_id = {r["id"]: r["metadata"] for r in records}
             for id_list in ids:
                 # In the segment based architecture, it is possible for one segment
@@ -546,6 +635,7 @@ def _records(
     embeddings: Optional[Embeddings] = None,
     metadatas: Optional[Metadatas] = None,
     documents: Optional[Documents] = None,
+    encoding: t.ScalarEncoding = t.ScalarEncoding.FLOAT32,
 ) -> Generator[t.SubmitEmbeddingRecord, None, None]:
     """Convert parallel lists of embeddings, metadatas and documents to a sequence of
     SubmitEmbeddingRecords"""
@@ -571,13 +661,38 @@ def _records(
         record = t.SubmitEmbeddingRecord(
             id=id,
             embedding=embeddings[i] if embeddings else None,
-            encoding=t.ScalarEncoding.FLOAT32,  # Hardcode for now
+            encoding=encoding,
             metadata=metadata,
             operation=operation,
         )
         yield record
 
 
+def _encoding(collection: t.Collection) -> t.ScalarEncoding:
+    """Return the encoding the vectors of a collection are stored with, set by its
+    hnsw:encoding metadata"""
+    metadata = collection["metadata"] or {}
+    return t.ScalarEncoding(metadata.get("hnsw:encoding", "FLOAT32"))
+
+
+def _embedding(vector: Optional[t.Vector]) -> Embedding:
+    """Convert a vector returned by a segment, which may be a numpy array, to an
+    Embedding"""
+    if isinstance(vector, np.ndarray):
+        return cast(Embedding, vector.tolist())
+    return cast(Embedding, vector)
+
+
+def _metadata_keys(include: Include) -> Optional[List[str]]:
+    """Return the metadata keys to read for the fields of an include list: all of
+    them for metadatas, only the document for documents, and none otherwise"""
+    if "metadatas" in include:
+        return None
+    elif "documents" in include:
+        return ["chroma:document"]
+    return []
+
+
 def _doc(metadata: Optional[t.Metadata]) -> Optional[str]:
     """Retrieve the document (if any) from a Metadata map"""
 
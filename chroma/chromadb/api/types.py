@@ -12,10 +12,18 @@ from chromadb.types import (
     Where,
     WhereDocumentOperator,
     WhereDocument,
+    SegmentStatistics,
+    Facet,
 )
 
 # Re-export types from chromadb.types
-__all__ = ["Metadata", "Where", "WhereDocument", "UpdateCollectionMetadata"]
+__all__ = [
+    "Metadata",
+    "Where",
+    "WhereDocument",
+    "UpdateCollectionMetadata",
+    "Facet",
+]
 
 ID = str
 IDs = List[ID]
@@ -28,6 +36,9 @@ Metadatas = List[Metadata]
 CollectionMetadata = Dict[str, Any]
 UpdateCollectionMetadata = UpdateMetadata
 
+# The statistics of a collection are those of its metadata segment
+CollectionStatistics = SegmentStatistics
+
 Document = str
 Documents = List[Document]
 
@@ -246,9 +257,9 @@ def validate_where_document(where_document: WhereDocument) -> WhereDocument:
             f"Expected where document to have exactly one operator, got {where_document}"
         )
     for operator, operand in where_document.items():
-        if operator not in ["$contains", "$and", "$or"]:
+        if operator not in ["$contains", "$search", "$and", "$or"]:
             raise ValueError(
-                f"Expected where document operator to be one of $contains, $and, $or, got {operator}"
+                f"Expected where document operator to be one of $contains, $search, $and, $or, got {operator}"
             )
         if operator == "$and" or operator == "$or":
             if not isinstance(operand, list):
@@ -261,10 +272,10 @@ def validate_where_document(where_document: WhereDocument) -> WhereDocument:
                 )
             for where_document_expression in operand:
                 validate_where_document(where_document_expression)
-        # Value is a $contains operator
+        # Value is a $contains or $search operator
         elif not isinstance(operand, str):
             raise ValueError(
-                f"Expected where document operand value for operator $contains to be a str, got {operand}"
+                f"Expected where document operand value for operator {operator} to be a str, got {operand}"
             )
     return where_document
 
@@ -302,6 +313,32 @@ def validate_n_results(n_results: int) -> int:
     return n_results
 
 
+def validate_sort(sort: str) -> str:
+    """Validates a sort to ensure it is a metadata key, optionally prefixed with - for
+    descending order"""
+    if not isinstance(sort, str):
+        raise ValueError(f"Expected sort to be a str, got {sort}")
+    if len(sort.lstrip("-")) == 0 or sort.startswith("--"):
+        raise ValueError(f"Expected sort to be a metadata key, got {sort}")
+    return sort
+
+
+def validate_facet_key(key: str) -> str:
+    """Validates the metadata key of facets to ensure it is a non empty str"""
+    if not isinstance(key, str) or len(key) == 0:
+        raise ValueError(f"Expected facet key to be a non empty str, got {key}")
+    return key
+
+
+def validate_facet_limit(limit: int) -> int:
+    """Validates the limit of facets to ensure it is a non-negative int"""
+    if not isinstance(limit, int) or isinstance(limit, bool):
+        raise ValueError(f"Expected facet limit to be an int, got {limit}")
+    if limit < 0:
+        raise ValueError(f"Expected facet limit to be non-negative, got {limit}")
+    return limit
+
+
 def validate_embeddings(embeddings: Embeddings) -> Embeddings:
     """Validates embeddings to ensure it is a list of list of ints, or floats"""
     if not isinstance(embeddings, list):
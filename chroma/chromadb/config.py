@@ -93,6 +93,50 @@ class Settings(BaseSettings):
 
     allow_reset: bool = False
 
+    # If enabled, writes return as soon as they are durable in the embeddings queue,
+    # and are applied to segments by a background thread per topic. At most
+    # async_ingest_buffer_size records per topic wait to be applied before writes
+    # block.
+    async_ingest: bool = False
+    async_ingest_buffer_size: int = 1000
+    # Maximum number of records delivered to a consumer in a single callback, both for
+    # new records and when backfilling a subscription
+    ingest_batch_size: int = 1000
+
+    # Delete records from the embeddings queue once every segment of their collection
+    # has persisted them. A background thread checks every
+    # embeddings_queue_purge_interval seconds, deleting at most
+    # embeddings_queue_purge_batch_size records per transaction. Only persistent
+    # databases are purged.
+    embeddings_queue_purge: bool = False
+    embeddings_queue_purge_interval: float = 10.0
+    embeddings_queue_purge_batch_size: int = 1000
+    # Return the space freed by purging to the OS with an incremental VACUUM (only
+    # for persistent databases). Enabling this for an existing database runs a full
+    # VACUUM once.
+    sqlite_incremental_vacuum: bool = False
+
+    # SQLite pragmas applied to every connection, see
+    # https://www.sqlite.org/pragma.html. Unset options keep SQLite's
+    # defaults. Journal modes other than the default (DELETE) only apply to
+    # persistent databases.
+    sqlite_journal_mode: Optional[
+        Literal["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"]
+    ] = None
+    sqlite_synchronous: Optional[Literal["OFF", "NORMAL", "FULL", "EXTRA"]] = None
+    # In bytes
+    sqlite_mmap_size: Optional[int] = None
+    # In pages if positive, in KiB if negative
+    sqlite_cache_size: Optional[int] = None
+    sqlite_temp_store: Optional[Literal["DEFAULT", "FILE", "MEMORY"]] = None
+    # In milliseconds
+    sqlite_busy_timeout: Optional[int] = None
+    # Persistent databases write through a single connection, and read through a
+    # pool of up to this many read-only connections (0 reads through the writer).
+    # Readers only run concurrently with the writer with sqlite_journal_mode set to
+    # WAL, which leaves -wal and -shm files next to the database file.
+    sqlite_read_pool_size: int = 0
+
     migrations: Literal["none", "validate", "apply"] = "apply"
 
     def require(self, key: str) -> Any:
@@ -1,4 +1,4 @@
-from typing import Any, Optional, Sequence, Tuple, Type
+from typing import Any, Callable, Dict, Hashable, Optional, Sequence, Tuple, Type
 from types import TracebackType
 from typing_extensions import Protocol, Self, Literal
 from abc import ABC, abstractmethod
@@ -26,6 +26,8 @@ class UniqueConstraintError(Exception):
 class Cursor(Protocol):
     """Reifies methods we use from a DBAPI2 Cursor since DBAPI2 is not typed."""
 
+    rowcount: int
+
     def execute(self, sql: str, params: Optional[Tuple[Any, ...]] = None) -> Self:
         ...
 
@@ -69,7 +71,11 @@ class TxWrapper(ABC, EnforceOverrides):
 class SqlDB(Component):
     """DBAPI 2.0 interface wrapper to ensure consistent behavior between implementations"""
 
+    # SQL text of compiled statements, see statement()
+    _statements: Dict[Hashable, str]
+
     def __init__(self, system: System):
+        self._statements = {}
         super().__init__(system)
 
     @abstractmethod
@@ -77,6 +83,13 @@ class SqlDB(Component):
         """Return a transaction wrapper"""
         pass
 
+    def read_tx(self) -> TxWrapper:
+        """Return a transaction wrapper for statements that do not write.
+        Implementations may serve these from separate connections, which see
+        everything committed before the transaction starts. By default this is the
+        same as tx()."""
+        return self.tx()
+
     @staticmethod
     @abstractmethod
     def querybuilder() -> Type[pypika.Query]:
@@ -117,6 +130,23 @@ class SqlDB(Component):
         """Return a PyPika Parameter object for the given index"""
         return pypika.Parameter(self.parameter_format().format(idx))
 
+    def statement(self, key: Hashable, build: Callable[[], str]) -> str:
+        """Return the SQL text of a compiled statement, calling build() to produce it
+        the first time the key is seen. The key identifies the statement and its
+        shape: everything that changes the generated SQL, such as which optional
+        clauses are present. build() should use param() placeholders rather than
+        ParameterValue, and callers pass the values in the order the placeholders
+        appear.
+
+        Building queries with pypika costs more than executing simple statements, so
+        hot paths compile each shape once. Reusing the exact same SQL text also lets
+        the driver reuse its prepared statements."""
+        sql = self._statements.get(key)
+        if sql is None:
+            sql = build()
+            self._statements[key] = sql
+        return sql
+
 
 _context = local()
 
@@ -190,3 +220,23 @@ def get_sql(
     sql = query.get_sql()
     params = tuple(_context.values)
     return sql, params
+
+
+def encode_seq_id(seq_id: int) -> bytes:
+    """Encode a SeqID into a byte array, as stored in the max_seq_id table"""
+    if seq_id.bit_length() < 64:
+        return int.to_bytes(seq_id, 8, "big")
+    elif seq_id.bit_length() < 192:
+        return int.to_bytes(seq_id, 24, "big")
+    else:
+        raise ValueError(f"Unsupported SeqID: {seq_id}")
+
+
+def decode_seq_id(seq_id_bytes: bytes) -> int:
+    """Decode a byte array into a SeqID"""
+    if len(seq_id_bytes) == 8:
+        return int.from_bytes(seq_id_bytes, "big")
+    elif len(seq_id_bytes) == 24:
+        return int.from_bytes(seq_id_bytes, "big")
+    else:
+        raise ValueError(f"Unknown SeqID type with length {len(seq_id_bytes)}")
@@ -1,4 +1,11 @@
-from chromadb.db.impl.sqlite_pool import Connection, LockPool, PerThreadPool, Pool
+from chromadb.db.impl.sqlite_pool import (
+    BoundedPool,
+    Connection,
+    LockPool,
+    Pool,
+    PoolMetrics,
+    SerializedPool,
+)
 from chromadb.db.migrations import MigratableDB, Migration
 from chromadb.config import System, Settings
 import chromadb.db.base as base
@@ -8,7 +15,7 @@ from chromadb.utils.delete_file import delete_file
 import sqlite3
 from overrides import override
 import pypika
-from typing import Sequence, cast, Optional, Type, Any
+from typing import Dict, List, Sequence, cast, Optional, Type, Any
 from typing_extensions import Literal
 from types import TracebackType
 import os
@@ -16,6 +23,9 @@ from uuid import UUID
 from threading import local
 from importlib_resources import files
 from importlib_resources.abc import Traversable
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 class TxWrapper(base.TxWrapper):
@@ -53,10 +63,13 @@ class TxWrapper(base.TxWrapper):
 
 class SqliteDB(MigratableDB, SqlEmbeddingsQueue, SqlSysDB):
     _conn_pool: Pool
+    # Read-only connections for read_tx(), if any
+    _read_pool: Optional[Pool]
     _settings: Settings
     _migration_imports: Sequence[Traversable]
     _db_file: str
     _tx_stack: local
+    _read_tx_stack: local
     _is_persistent: bool
 
     def __init__(self, system: System):
@@ -73,29 +86,113 @@ class SqliteDB(MigratableDB, SqlEmbeddingsQueue, SqlSysDB):
             # See https://www.sqlite.org/sharedcache.html
             # https://stackoverflow.com/questions/3315046/sharing-a-memory-database-between-different-threads-in-python-using-sqlite3-pa
             self._db_file = "file::memory:?cache=shared"
-            self._conn_pool = LockPool(self._db_file, is_uri=True)
+            self._conn_pool = LockPool(
+                self._db_file, is_uri=True, pragmas=self._pragmas()
+            )
+            self._read_pool = None
         else:
             self._db_file = (
                 self._settings.require("persist_directory") + "/chroma.sqlite3"
             )
             if not os.path.exists(self._db_file):
                 os.makedirs(os.path.dirname(self._db_file), exist_ok=True)
-            self._conn_pool = PerThreadPool(self._db_file)
+            self._conn_pool = SerializedPool(self._db_file, pragmas=self._pragmas())
+            read_pool_size = self._settings.sqlite_read_pool_size
+            self._read_pool = (
+                BoundedPool(
+                    self._db_file,
+                    read_pool_size,
+                    pragmas=self._pragmas(read_only=True),
+                )
+                if read_pool_size > 0
+                else None
+            )
+            if read_pool_size > 0 and self._settings.sqlite_journal_mode != "WAL":
+                logger.warning(
+                    "sqlite_read_pool_size is set without sqlite_journal_mode=WAL, "
+                    "readers and the writer will block each other"
+                )
         self._tx_stack = local()
+        self._read_tx_stack = local()
         super().__init__(system)
+        # Only persistent vector segments record the records they have persisted, so
+        # nothing would ever be purged from an in-memory database
+        self._purge = self._purge and self._is_persistent
 
     @override
     def start(self) -> None:
         super().start()
+        if self._is_persistent and self._settings.sqlite_incremental_vacuum:
+            self._enable_incremental_vacuum()
         with self.tx() as cur:
             cur.execute("PRAGMA foreign_keys = ON")
             cur.execute("PRAGMA case_sensitive_like = ON")
         self.initialize_migrations()
 
+    def _pragmas(self, read_only: bool = False) -> List[str]:
+        """The pragmas run on every new connection, per the sqlite_* settings"""
+        pragmas = ["PRAGMA case_sensitive_like = ON"]
+        settings = self._settings
+        journal_mode = settings.sqlite_journal_mode
+        # The journal mode is a property of the database file, the writer sets it
+        if journal_mode is not None and self._is_persistent and not read_only:
+            pragmas.append(f"PRAGMA journal_mode = {journal_mode}")
+        if settings.sqlite_synchronous is not None:
+            pragmas.append(f"PRAGMA synchronous = {settings.sqlite_synchronous}")
+        if settings.sqlite_mmap_size is not None:
+            pragmas.append(f"PRAGMA mmap_size = {int(settings.sqlite_mmap_size)}")
+        if settings.sqlite_cache_size is not None:
+            pragmas.append(f"PRAGMA cache_size = {int(settings.sqlite_cache_size)}")
+        if settings.sqlite_temp_store is not None:
+            pragmas.append(f"PRAGMA temp_store = {settings.sqlite_temp_store}")
+        if settings.sqlite_busy_timeout is not None:
+            pragmas.append(f"PRAGMA busy_timeout = {int(settings.sqlite_busy_timeout)}")
+        if read_only:
+            pragmas.append("PRAGMA query_only = ON")
+        return pragmas
+
+    def _enable_incremental_vacuum(self) -> None:
+        """Switch the database to incremental auto vacuum. This has to happen before
+        any table is created, or be followed by a full VACUUM."""
+        conn = self._conn_pool.connect()
+        try:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                has_tables = conn.execute(
+                    "SELECT count(*) FROM sqlite_master WHERE type='table'"
+                ).fetchone()[0]
+                if has_tables:
+                    logger.info("Running VACUUM to enable incremental auto vacuum")
+                    conn.execute("VACUUM")
+        finally:
+            self._conn_pool.return_to_pool(conn)
+
+    @override
+    def _reclaim_space(self) -> None:
+        if self._is_persistent and self._settings.sqlite_incremental_vacuum:
+            conn = self._conn_pool.connect()
+            try:
+                # Each step of the statement frees a single page, executescript runs it
+                # to completion
+                conn.cursor().executescript("PRAGMA incremental_vacuum")
+            finally:
+                self._conn_pool.return_to_pool(conn)
+
     @override
     def stop(self) -> None:
         super().stop()
+        logger.debug(f"SQLite connection pool metrics: {self.pool_metrics()}")
         self._conn_pool.close()
+        if self._read_pool is not None:
+            self._read_pool.close()
+
+    def pool_metrics(self) -> Dict[str, PoolMetrics]:
+        """Return connection wait time metrics of the writer pool, and of the reader
+        pool if there is one"""
+        metrics = {"writer": self._conn_pool.metrics()}
+        if self._read_pool is not None:
+            metrics["reader"] = self._read_pool.metrics()
+        return metrics
 
     @staticmethod
     @override
@@ -122,6 +219,19 @@ class SqliteDB(MigratableDB, SqlEmbeddingsQueue, SqlSysDB):
             self._tx_stack.stack = []
         return TxWrapper(self._conn_pool, stack=self._tx_stack)
 
+    @override
+    def read_tx(self) -> TxWrapper:
+        if not hasattr(self._tx_stack, "stack"):
+            self._tx_stack.stack = []
+        # Join the transaction this thread is writing in, if any, so it can read its
+        # own uncommitted writes
+        if self._read_pool is None or len(self._tx_stack.stack) > 0:
+            return self.tx()
+        if not hasattr(self._read_tx_stack, "stack"):
+            self._read_tx_stack.stack = []
+        # BEGIN is deferred: the read transaction starts with the first SELECT
+        return TxWrapper(self._read_pool, stack=self._read_tx_stack)
+
     @override
     def reset_state(self) -> None:
         if not self._settings.require("allow_reset"):
@@ -139,6 +249,8 @@ class SqliteDB(MigratableDB, SqlEmbeddingsQueue, SqlSysDB):
             for row in cur.fetchall():
                 cur.execute(f"DROP TABLE IF EXISTS {row[0]}")
         self._conn_pool.close()
+        if self._read_pool is not None:
+            self._read_pool.close()
         if self._is_persistent:
             delete_file(self._db_file)
         self.start()
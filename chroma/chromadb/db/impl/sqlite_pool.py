@@ -1,10 +1,69 @@
 import sqlite3
+import time
 from abc import ABC, abstractmethod
-from typing import Any, Set
+from typing import Any, List, Optional, Sequence, Set
+from typing_extensions import TypedDict
 import threading
 from overrides import override
 
 
+class PoolMetrics(TypedDict):
+    """How long callers of a pool's connect() waited for a connection"""
+
+    connections: int
+    acquisitions: int
+    # Acquisitions that had to wait for another thread to return a connection
+    waits: int
+    wait_seconds_total: float
+    wait_seconds_max: float
+
+
+class _WaitStats:
+    """Thread safe accumulator of connection wait times"""
+
+    _lock: threading.Lock
+    _acquisitions: int
+    _waits: int
+    _total: float
+    _max: float
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._acquisitions = 0
+        self._waits = 0
+        self._total = 0.0
+        self._max = 0.0
+
+    def record(self, seconds: float) -> None:
+        """Record an acquisition that waited the given number of seconds"""
+        with self._lock:
+            self._acquisitions += 1
+            if seconds > 0:
+                self._waits += 1
+                self._total += seconds
+                self._max = max(self._max, seconds)
+
+    def metrics(self, connections: int) -> PoolMetrics:
+        with self._lock:
+            return PoolMetrics(
+                connections=connections,
+                acquisitions=self._acquisitions,
+                waits=self._waits,
+                wait_seconds_total=self._total,
+                wait_seconds_max=self._max,
+            )
+
+
+def _acquire(lock: Any, stats: _WaitStats) -> None:
+    """Acquire the given lock, recording how long it took"""
+    start = time.perf_counter()
+    if lock.acquire(blocking=False):
+        stats.record(0.0)
+    else:
+        lock.acquire()
+        stats.record(time.perf_counter() - start)
+
+
 class Connection:
     """A threadpool connection that returns itself to the pool on close()"""
 
@@ -13,7 +72,13 @@ class Connection:
     _conn: sqlite3.Connection
 
     def __init__(
-        self, pool: "Pool", db_file: str, is_uri: bool, *args: Any, **kwargs: Any
+        self,
+        pool: "Pool",
+        db_file: str,
+        is_uri: bool,
+        pragmas: Sequence[str] = (),
+        *args: Any,
+        **kwargs: Any,
     ):
         self._pool = pool
         self._db_file = db_file
@@ -21,6 +86,8 @@ class Connection:
             db_file, timeout=1000, check_same_thread=False, uri=is_uri, *args, **kwargs
         )  # type: ignore
         self._conn.isolation_level = None  # Handle commits explicitly
+        for pragma in pragmas:
+            self._conn.execute(pragma).fetchall()
 
     def execute(self, sql: str, parameters=...) -> sqlite3.Cursor:  # type: ignore
         if parameters is ...:
@@ -45,7 +112,8 @@ class Pool(ABC):
     """Abstract base class for a pool of connections to a sqlite database."""
 
     @abstractmethod
-    def __init__(self, db_file: str, is_uri: bool) -> None:
+    def __init__(self, db_file: str, is_uri: bool, pragmas: Sequence[str]) -> None:
+        """pragmas are statements run on every new connection"""
         pass
 
     @abstractmethod
@@ -63,6 +131,11 @@ class Pool(ABC):
         """Return a connection to the pool."""
         pass
 
+    @abstractmethod
+    def metrics(self) -> PoolMetrics:
+        """Return connection wait time metrics for this pool."""
+        pass
+
 
 class LockPool(Pool):
     """A pool that has a single connection per thread but uses a lock to ensure that only one thread can use it at a time.
@@ -75,22 +148,26 @@ class LockPool(Pool):
     _connection: threading.local
     _db_file: str
     _is_uri: bool
+    _pragmas: Sequence[str]
+    _stats: _WaitStats
 
-    def __init__(self, db_file: str, is_uri: bool = False):
+    def __init__(self, db_file: str, is_uri: bool = False, pragmas: Sequence[str] = ()):
         self._connections = set()
         self._connection = threading.local()
         self._lock = threading.RLock()
         self._db_file = db_file
         self._is_uri = is_uri
+        self._pragmas = pragmas
+        self._stats = _WaitStats()
 
     @override
     def connect(self, *args: Any, **kwargs: Any) -> Connection:
-        self._lock.acquire()
+        _acquire(self._lock, self._stats)
         if hasattr(self._connection, "conn") and self._connection.conn is not None:
             return self._connection.conn  # type: ignore # cast doesn't work here for some reason
         else:
             new_connection = Connection(
-                self, self._db_file, self._is_uri, *args, **kwargs
+                self, self._db_file, self._is_uri, self._pragmas, *args, **kwargs
             )
             self._connection.conn = new_connection
             self._connections.add(new_connection)
@@ -114,6 +191,10 @@ class LockPool(Pool):
         except RuntimeError:
             pass
 
+    @override
+    def metrics(self) -> PoolMetrics:
+        return self._stats.metrics(len(self._connections))
+
 
 class PerThreadPool(Pool):
     """Maintains a connection per thread. For now this does not maintain a cap on the number of connections, but it could be
@@ -125,21 +206,27 @@ class PerThreadPool(Pool):
     _connection: threading.local
     _db_file: str
     _is_uri_: bool
+    _pragmas: Sequence[str]
+    _stats: _WaitStats
 
-    def __init__(self, db_file: str, is_uri: bool = False):
+    def __init__(self, db_file: str, is_uri: bool = False, pragmas: Sequence[str] = ()):
         self._connections = set()
         self._connection = threading.local()
         self._lock = threading.Lock()
         self._db_file = db_file
         self._is_uri = is_uri
+        self._pragmas = pragmas
+        self._stats = _WaitStats()
 
     @override
     def connect(self, *args: Any, **kwargs: Any) -> Connection:
+        # Threads never wait for each other's connections
+        self._stats.record(0.0)
         if hasattr(self._connection, "conn") and self._connection.conn is not None:
             return self._connection.conn  # type: ignore # cast doesn't work here for some reason
         else:
             new_connection = Connection(
-                self, self._db_file, self._is_uri, *args, **kwargs
+                self, self._db_file, self._is_uri, self._pragmas, *args, **kwargs
             )
             self._connection.conn = new_connection
             with self._lock:
@@ -157,3 +244,154 @@ class PerThreadPool(Pool):
     @override
     def return_to_pool(self, conn: Connection) -> None:
         pass  # Each thread gets its own connection, so we don't need to return it to the pool
+
+    @override
+    def metrics(self) -> PoolMetrics:
+        with self._lock:
+            connections = len(self._connections)
+        return self._stats.metrics(connections)
+
+
+class SerializedPool(Pool):
+    """A pool of a single connection shared by all threads, which use it one at a
+    time: connect() blocks until the thread currently holding the connection has
+    returned it as many times as it connected. Used for writes to persistent
+    databases, as SQLite only allows one writer at a time anyway.
+    """
+
+    _lock: threading.RLock
+    _conn: Optional[Connection]
+    _db_file: str
+    _is_uri: bool
+    _pragmas: Sequence[str]
+    _stats: _WaitStats
+
+    def __init__(self, db_file: str, is_uri: bool = False, pragmas: Sequence[str] = ()):
+        self._lock = threading.RLock()
+        self._conn = None
+        self._db_file = db_file
+        self._is_uri = is_uri
+        self._pragmas = pragmas
+        self._stats = _WaitStats()
+
+    @override
+    def connect(self, *args: Any, **kwargs: Any) -> Connection:
+        _acquire(self._lock, self._stats)
+        if self._conn is None:
+            try:
+                self._conn = Connection(
+                    self, self._db_file, self._is_uri, self._pragmas, *args, **kwargs
+                )
+            except BaseException:
+                self._lock.release()
+                raise
+        return self._conn
+
+    @override
+    def return_to_pool(self, conn: Connection) -> None:
+        try:
+            self._lock.release()
+        except RuntimeError:
+            pass
+
+    @override
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close_actual()
+                self._conn = None
+
+    @override
+    def metrics(self) -> PoolMetrics:
+        return self._stats.metrics(0 if self._conn is None else 1)
+
+
+class BoundedPool(Pool):
+    """A pool of at most size connections shared by all threads. A thread holds a
+    connection from connect() until the matching return_to_pool(), and nested
+    connect() calls return the connection the thread already holds. connect() blocks
+    while every connection is held by other threads.
+    """
+
+    _size: int
+    _condition: threading.Condition
+    _connections: Set[Connection]
+    _idle: List[Connection]
+    _held: threading.local
+    _db_file: str
+    _is_uri: bool
+    _pragmas: Sequence[str]
+    _stats: _WaitStats
+
+    def __init__(
+        self,
+        db_file: str,
+        size: int,
+        is_uri: bool = False,
+        pragmas: Sequence[str] = (),
+    ):
+        if size < 1:
+            raise ValueError(f"Pool size must be at least 1, got {size}")
+        self._size = size
+        self._condition = threading.Condition()
+        self._connections = set()
+        self._idle = []
+        self._held = threading.local()
+        self._db_file = db_file
+        self._is_uri = is_uri
+        self._pragmas = pragmas
+        self._stats = _WaitStats()
+
+    @override
+    def connect(self, *args: Any, **kwargs: Any) -> Connection:
+        held = getattr(self._held, "conn", None)
+        if held is not None:
+            self._held.depth += 1
+            return held  # type: ignore
+
+        start = time.perf_counter()
+        waited = False
+        with self._condition:
+            while not self._idle and len(self._connections) >= self._size:
+                waited = True
+                self._condition.wait()
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                conn = Connection(
+                    self, self._db_file, self._is_uri, self._pragmas, *args, **kwargs
+                )
+                self._connections.add(conn)
+        self._stats.record(time.perf_counter() - start if waited else 0.0)
+        self._held.conn = conn
+        self._held.depth = 1
+        return conn
+
+    @override
+    def return_to_pool(self, conn: Connection) -> None:
+        depth = getattr(self._held, "depth", 1) - 1
+        self._held.depth = depth
+        if depth > 0:
+            return
+        self._held.conn = None
+        with self._condition:
+            # Connections closed while they were held are not reused
+            if conn in self._connections:
+                self._idle.append(conn)
+            self._condition.notify()
+
+    @override
+    def close(self) -> None:
+        with self._condition:
+            for conn in self._connections:
+                conn.close_actual()
+            self._connections.clear()
+            self._idle.clear()
+            self._held = threading.local()
+            self._condition.notify_all()
+
+    @override
+    def metrics(self) -> PoolMetrics:
+        with self._condition:
+            connections = len(self._connections)
+        return self._stats.metrics(connections)
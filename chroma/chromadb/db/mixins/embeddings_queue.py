@@ -1,9 +1,17 @@
-from chromadb.db.base import SqlDB, ParameterValue, get_sql
+from chromadb.db.base import (
+    Cursor,
+    SqlDB,
+    ParameterValue,
+    get_sql,
+    encode_seq_id,
+    decode_seq_id,
+)
 from chromadb.ingest import (
     Producer,
     Consumer,
     encode_vector,
     decode_vector,
+    decode_vectors,
     ConsumerCallbackFn,
 )
 from chromadb.types import (
@@ -12,13 +20,16 @@ from chromadb.types import (
     SeqId,
     ScalarEncoding,
     Operation,
+    Vector,
 )
 from chromadb.config import System
 from overrides import override
 from collections import defaultdict
-from typing import Tuple, Optional, Dict, Set, cast
+from typing import Any, Callable, List, Sequence, Tuple, Optional, Dict, Set, cast
 from uuid import UUID
 from pypika import Table, functions
+from queue import Queue, Empty
+from threading import Event, Lock, RLock, Thread
 import uuid
 import json
 import logging
@@ -34,6 +45,63 @@ _operation_codes = {
 _operation_codes_inv = {v: k for k, v in _operation_codes.items()}
 
 
+class _TopicApplier:
+    """Applies the records submitted to a topic to its subscribers on a background
+    thread, in the order they were submitted. Records that are submitted while a batch
+    is being applied are applied together as the next batch. Submitting blocks while
+    the buffer is full."""
+
+    _topic: str
+    _queue: "Queue[Optional[EmbeddingRecord]]"
+    _max_batch_size: int
+    _notify: Callable[[str, Sequence[EmbeddingRecord]], None]
+    _thread: Thread
+
+    def __init__(
+        self,
+        topic: str,
+        buffer_size: int,
+        max_batch_size: int,
+        notify: Callable[[str, Sequence[EmbeddingRecord]], None],
+    ):
+        self._topic = topic
+        self._queue = Queue(maxsize=buffer_size)
+        self._max_batch_size = max_batch_size
+        self._notify = notify
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, embeddings: Sequence[EmbeddingRecord]) -> None:
+        for embedding in embeddings:
+            self._queue.put(embedding)
+
+    def stop(self) -> None:
+        """Apply the records already submitted, then stop"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            batch: List[EmbeddingRecord] = []
+            stopping = False
+            record = self._queue.get()
+            while True:
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+                if len(batch) >= self._max_batch_size:
+                    break
+                try:
+                    record = self._queue.get_nowait()
+                except Empty:
+                    break
+            if len(batch) > 0:
+                self._notify(self._topic, batch)
+            if stopping:
+                return
+
+
 class SqlEmbeddingsQueue(SqlDB, Producer, Consumer):
     """A SQL database that stores embeddings, allowing a traditional RDBMS to be used as
     the primary ingest queue and satisfying the top level Producer/Consumer interfaces.
@@ -68,15 +136,73 @@ class SqlEmbeddingsQueue(SqlDB, Producer, Consumer):
             self.callback = callback
 
     _subscriptions: Dict[str, Set[Subscription]]
+    # Serializes backfilling new subscriptions with the delivery of records by the
+    # appliers, so that no record is missed or delivered twice
+    _subscriptions_lock: RLock
+    _async_ingest: bool
+    _async_ingest_buffer_size: int
+    # Maximum number of records passed to a consumer callback
+    _batch_size: int
+    _appliers: Dict[str, _TopicApplier]
+    _appliers_lock: Lock
+    # Held from inserting a record until it has been handed to its applier, so that
+    # the appliers see records in the order they were committed
+    _submit_lock: Lock
+    _purge: bool
+    _purge_interval: float
+    _purge_batch_size: int
+    _purge_thread: Optional[Thread]
+    _purge_stopped: Event
+    # Persisted SeqIDs reported by segments, written to the max_seq_id table when the
+    # queue is next purged
+    _persisted_seq_ids: Dict[UUID, SeqId]
+    _persisted_seq_ids_lock: Lock
 
     def __init__(self, system: System):
         self._subscriptions = defaultdict(set)
+        self._subscriptions_lock = RLock()
+        self._async_ingest = system.settings.async_ingest
+        self._async_ingest_buffer_size = system.settings.async_ingest_buffer_size
+        self._batch_size = max(system.settings.ingest_batch_size, 1)
+        self._appliers = {}
+        self._appliers_lock = Lock()
+        self._submit_lock = Lock()
+        self._purge = system.settings.embeddings_queue_purge
+        self._purge_interval = system.settings.embeddings_queue_purge_interval
+        self._purge_batch_size = max(
+            system.settings.embeddings_queue_purge_batch_size, 1
+        )
+        self._purge_thread = None
+        self._purge_stopped = Event()
+        self._persisted_seq_ids = {}
+        self._persisted_seq_ids_lock = Lock()
         super().__init__(system)
 
+    @override
+    def start(self) -> None:
+        super().start()
+        if self._purge and self._purge_thread is None:
+            self._purge_stopped.clear()
+            self._purge_thread = Thread(target=self._purge_periodically, daemon=True)
+            self._purge_thread.start()
+
+    @override
+    def stop(self) -> None:
+        if self._purge_thread is not None:
+            self._purge_stopped.set()
+            self._purge_thread.join()
+            self._purge_thread = None
+        self._stop_appliers()
+        self._write_persisted_seq_ids()
+        super().stop()
+
     @override
     def reset_state(self) -> None:
-        super().reset_state()
         self._subscriptions = defaultdict(set)
+        self._stop_appliers()
+        with self._persisted_seq_ids_lock:
+            self._persisted_seq_ids = {}
+        super().reset_state()
 
     @override
     def create_topic(self, topic_name: str) -> None:
@@ -95,52 +221,140 @@ class SqlEmbeddingsQueue(SqlDB, Producer, Consumer):
         with self.tx() as cur:
             sql, params = get_sql(q, self.parameter_format())
             cur.execute(sql, params)
+        with self._appliers_lock:
+            applier = self._appliers.pop(topic_name, None)
+        if applier is not None:
+            applier.stop()
 
     @override
     def submit_embedding(
         self, topic_name: str, embedding: SubmitEmbeddingRecord
     ) -> SeqId:
+        return self.submit_embeddings(topic_name, [embedding])[0]
+
+    @override
+    def submit_embeddings(
+        self, topic_name: str, embeddings: Sequence[SubmitEmbeddingRecord]
+    ) -> Sequence[SeqId]:
         if not self._running:
             raise RuntimeError("Component not running")
 
-        if embedding["embedding"]:
-            encoding_type = cast(ScalarEncoding, embedding["encoding"])
-            encoding = encoding_type.value
-            embedding_bytes = encode_vector(embedding["embedding"], encoding_type)
+        if len(embeddings) == 0:
+            return []
+
+        insert = self.statement("submit_embeddings", self._build_insert)
+        blobs = [self._encode_vector(e) for e in embeddings]
+        params = [
+            self._encode_embedding(topic_name, embedding, blob)
+            for embedding, blob in zip(embeddings, blobs)
+        ]
+        # Consumers receive exactly what they would when reading the records back
+        vectors = [
+            decode_vector(blob, cast(ScalarEncoding, embedding["encoding"]))
+            if blob is not None
+            else None
+            for embedding, blob in zip(embeddings, blobs)
+        ]
+
+        if self._async_ingest:
+            # Return once the records are committed, leaving them to the topic's
+            # applier
+            with self._submit_lock:
+                with self.tx() as cur:
+                    seq_ids = self._insert_embeddings(cur, insert, params)
+                self._get_applier(topic_name).submit(
+                    self._embedding_records(embeddings, vectors, seq_ids)
+                )
+            return seq_ids
 
-        else:
-            embedding_bytes = None
-            encoding = None
-        metadata = json.dumps(embedding["metadata"]) if embedding["metadata"] else None
+        with self.tx() as cur:
+            seq_ids = self._insert_embeddings(cur, insert, params)
+            self._notify_all(
+                topic_name, self._embedding_records(embeddings, vectors, seq_ids)
+            )
+            return seq_ids
+
+    def _insert_embeddings(
+        self, cur: Cursor, sql: str, params: Sequence[Tuple[Any, ...]]
+    ) -> List[SeqId]:
+        """Insert a batch of records into the queue, returning their SeqIDs.
+
+        seq_id is an INTEGER PRIMARY KEY without AUTOINCREMENT, so SQLite gives each
+        inserted row the largest seq_id so far plus one, and the caller's write
+        transaction keeps other inserts out until commit. The batch thus takes the
+        SeqIDs right after the largest one before the insert. This is checked, since
+        SQLite picks random rowids instead once the largest possible one is used."""
+        max_seq_id_sql = self.statement("max_queue_seq_id", self._build_max_seq_id)
+        max_seq_id = int(cur.execute(max_seq_id_sql).fetchone()[0] or 0)
+        cur.executemany(sql, params)
+        new_max_seq_id = int(cur.execute(max_seq_id_sql).fetchone()[0])
+        if new_max_seq_id - max_seq_id != len(params):
+            raise RuntimeError(
+                f"Inserted {len(params)} records into the embeddings queue but its "
+                f"largest SeqID went from {max_seq_id} to {new_max_seq_id}"
+            )
+        return list(range(max_seq_id + 1, new_max_seq_id + 1))
 
+    def _build_insert(self) -> str:
         t = Table("embeddings_queue")
-        insert = (
+        return str(
             self.querybuilder()
             .into(t)
             .columns(t.operation, t.topic, t.id, t.vector, t.encoding, t.metadata)
-            .insert(
-                ParameterValue(_operation_codes[embedding["operation"]]),
-                ParameterValue(topic_name),
-                ParameterValue(embedding["id"]),
-                ParameterValue(embedding_bytes),
-                ParameterValue(encoding),
-                ParameterValue(metadata),
-            )
+            .insert(*[self.param(i) for i in range(6)])
+            .get_sql()
         )
-        with self.tx() as cur:
-            sql, params = get_sql(insert, self.parameter_format())
-            sql = f"{sql} RETURNING seq_id"  # Pypika doesn't support RETURNING
-            seq_id = int(cur.execute(sql, params).fetchone()[0])
-            embedding_record = EmbeddingRecord(
+
+    def _build_max_seq_id(self) -> str:
+        t = Table("embeddings_queue")
+        q = self.querybuilder().from_(t).select(functions.Max(t.seq_id))
+        return str(q.get_sql())
+
+    @staticmethod
+    def _encode_vector(embedding: SubmitEmbeddingRecord) -> Optional[bytes]:
+        if embedding["embedding"] is None or len(embedding["embedding"]) == 0:
+            return None
+        encoding = cast(ScalarEncoding, embedding["encoding"])
+        return encode_vector(embedding["embedding"], encoding)
+
+    @staticmethod
+    def _encode_embedding(
+        topic_name: str, embedding: SubmitEmbeddingRecord, blob: Optional[bytes]
+    ) -> Tuple[Any, ...]:
+        """Return the embeddings_queue column values of a record"""
+        if blob is not None:
+            encoding = cast(ScalarEncoding, embedding["encoding"]).value
+            embedding_bytes = blob
+        else:
+            embedding_bytes = None
+            encoding = None
+        metadata = json.dumps(embedding["metadata"]) if embedding["metadata"] else None
+        return (
+            _operation_codes[embedding["operation"]],
+            topic_name,
+            embedding["id"],
+            embedding_bytes,
+            encoding,
+            metadata,
+        )
+
+    @staticmethod
+    def _embedding_records(
+        embeddings: Sequence[SubmitEmbeddingRecord],
+        vectors: Sequence[Optional[Vector]],
+        seq_ids: Sequence[SeqId],
+    ) -> List[EmbeddingRecord]:
+        return [
+            EmbeddingRecord(
                 id=embedding["id"],
                 seq_id=seq_id,
-                embedding=embedding["embedding"],
+                embedding=vector,
                 encoding=embedding["encoding"],
                 metadata=embedding["metadata"],
                 operation=embedding["operation"],
             )
-            self._notify_all(topic_name, embedding_record)
-            return seq_id
+            for embedding, vector, seq_id in zip(embeddings, vectors, seq_ids)
+        ]
 
     @override
     def subscribe(
@@ -162,8 +376,9 @@ class SqlEmbeddingsQueue(SqlDB, Producer, Consumer):
         )
 
         # Backfill first, so if it errors we do not add the subscription
-        self._backfill(subscription)
-        self._subscriptions[topic_name].add(subscription)
+        with self._subscriptions_lock:
+            self._backfill(subscription)
+            self._subscriptions[topic_name].add(subscription)
 
         return subscription_id
 
@@ -185,41 +400,178 @@ class SqlEmbeddingsQueue(SqlDB, Producer, Consumer):
     def max_seqid(self) -> SeqId:
         return 2**63 - 1
 
-    def _backfill(self, subscription: Subscription) -> None:
-        """Backfill the given subscription with any currently matching records in the
-        DB"""
-        t = Table("embeddings_queue")
+    def record_persisted_seq_id(self, segment_id: UUID, seq_id: SeqId) -> None:
+        """Record that a segment which does not store its data in this database has
+        persisted every record of its topic up to the given SeqID. Segments that do
+        store their data here update the max_seq_id table in the same transaction as
+        their data instead.
+
+        This does not touch the database, since segments call it while holding their
+        own locks, which writers to this database may be waiting for. The SeqID is
+        written to the max_seq_id table by the next purge()."""
+        with self._persisted_seq_ids_lock:
+            self._persisted_seq_ids[segment_id] = seq_id
+
+    def _write_persisted_seq_ids(self) -> None:
+        with self._persisted_seq_ids_lock:
+            persisted = self._persisted_seq_ids
+            self._persisted_seq_ids = {}
+        if len(persisted) == 0:
+            return
+        params = [
+            (self.uuid_to_db(segment_id), encode_seq_id(seq_id))
+            for segment_id, seq_id in persisted.items()
+        ]
+        sql = self.statement("record_persisted_seq_id", self._build_replace_seq_id)
+        with self.tx() as cur:
+            cur.executemany(sql, params)
+
+    def _build_replace_seq_id(self) -> str:
+        t = Table("max_seq_id")
+        return str(
+            self.querybuilder()
+            .into(t)
+            .columns(t.segment_id, t.seq_id)
+            .replace(self.param(0), self.param(1))
+            .get_sql()
+        )
+
+    def purge(self) -> int:
+        """Delete the records that every segment of their topic has persisted, as
+        recorded in the max_seq_id table. Topics with a segment that has not recorded
+        any progress are left untouched. Returns the number of records deleted.
+
+        The most recent record is never deleted, since new SeqIDs are allocated after
+        the largest one in the table."""
+        self._write_persisted_seq_ids()
+        segments_t = Table("segments")
+        max_seq_id_t = Table("max_seq_id")
         q = (
             self.querybuilder()
-            .from_(t)
-            .where(t.topic == ParameterValue(subscription.topic_name))
-            .where(t.seq_id > ParameterValue(subscription.start))
-            .where(t.seq_id <= ParameterValue(subscription.end))
-            .select(t.seq_id, t.operation, t.id, t.vector, t.encoding, t.metadata)
-            .orderby(t.seq_id)
+            .from_(segments_t)
+            .left_join(max_seq_id_t)
+            .on(max_seq_id_t.segment_id == segments_t.id)
+            .select(segments_t.topic, max_seq_id_t.seq_id)
+            .where(segments_t.topic.notnull())
         )
         with self.tx() as cur:
-            sql, params = get_sql(q, self.parameter_format())
-            cur.execute(sql, params)
-            rows = cur.fetchall()
-            for row in rows:
-                if row[3]:
-                    encoding = ScalarEncoding(row[4])
-                    vector = decode_vector(row[3], encoding)
-                else:
-                    encoding = None
-                    vector = None
-                self._notify_one(
-                    subscription,
-                    EmbeddingRecord(
-                        seq_id=row[0],
-                        operation=_operation_codes_inv[row[1]],
-                        id=row[2],
-                        embedding=vector,
-                        encoding=encoding,
-                        metadata=json.loads(row[5]) if row[5] else None,
-                    ),
+            rows = cur.execute(q.get_sql()).fetchall()
+
+        persisted: Dict[str, Optional[SeqId]] = {}
+        for topic, encoded in rows:
+            previous = persisted.get(topic)
+            if encoded is None or (topic in persisted and previous is None):
+                persisted[topic] = None
+            else:
+                seq_id = decode_seq_id(encoded)
+                persisted[topic] = seq_id if previous is None else min(previous, seq_id)
+
+        t = Table("embeddings_queue")
+        with self.tx() as cur:
+            q = self.querybuilder().from_(t).select(functions.Max(t.seq_id))
+            last_seq_id = cur.execute(q.get_sql()).fetchone()[0]
+        if last_seq_id is None:
+            return 0
+
+        deleted = 0
+        for topic, max_seq_id in persisted.items():
+            if max_seq_id is None:
+                continue
+            # Delete in small transactions so that writers are not blocked for long
+            while not self._purge_stopped.is_set():
+                batch = (
+                    self.querybuilder()
+                    .from_(t)
+                    .select(t.seq_id)
+                    .where(t.topic == ParameterValue(topic))
+                    .where(t.seq_id <= ParameterValue(max_seq_id))
+                    .where(t.seq_id < ParameterValue(last_seq_id))
+                    .orderby(t.seq_id)
+                    .limit(self._purge_batch_size)
                 )
+                q = self.querybuilder().from_(t).where(t.seq_id.isin(batch)).delete()
+                sql, params = get_sql(q, self.parameter_format())
+                with self.tx() as cur:
+                    count = cur.execute(sql, params).rowcount
+                deleted += count
+                if count < self._purge_batch_size:
+                    break
+
+        if deleted > 0:
+            logger.debug(f"Purged {deleted} records from the embeddings queue")
+            self._reclaim_space()
+        return deleted
+
+    def _reclaim_space(self) -> None:
+        """Called after records have been purged, to return the space they used"""
+        pass
+
+    def _purge_periodically(self) -> None:
+        while not self._purge_stopped.wait(self._purge_interval):
+            try:
+                self.purge()
+            except Exception as e:
+                logger.error(f"Failed to purge the embeddings queue: {e}")
+
+    def _backfill(self, subscription: Subscription) -> None:
+        """Backfill the given subscription with any currently matching records in the
+        DB. Records are read a page of batch_size records at a time (paginating on
+        SeqID) and delivered as they are read, so memory use does not depend on the
+        number of records."""
+        t = Table("embeddings_queue")
+        last_seq_id = subscription.start
+        with self.tx() as cur:
+            while True:
+                q = (
+                    self.querybuilder()
+                    .from_(t)
+                    .where(t.topic == ParameterValue(subscription.topic_name))
+                    .where(t.seq_id > ParameterValue(last_seq_id))
+                    .where(t.seq_id <= ParameterValue(subscription.end))
+                    .select(
+                        t.seq_id, t.operation, t.id, t.vector, t.encoding, t.metadata
+                    )
+                    .orderby(t.seq_id)
+                    .limit(self._batch_size)
+                )
+                sql, params = get_sql(q, self.parameter_format())
+                rows = cur.execute(sql, params).fetchall()
+                if len(rows) == 0:
+                    break
+                self._notify_one(subscription, self._decode_rows(rows))
+                last_seq_id = rows[-1][0]
+                if len(rows) < self._batch_size:
+                    break
+        # Records that are still waiting in an applier were backfilled already
+        subscription.start = max(subscription.start, last_seq_id)
+
+    @staticmethod
+    def _decode_rows(rows: Sequence[Tuple[Any, ...]]) -> List[EmbeddingRecord]:
+        """Decode embeddings_queue rows into records, decoding the vectors of each
+        encoding in bulk"""
+        by_encoding: Dict[str, List[int]] = defaultdict(list)
+        for i, row in enumerate(rows):
+            if row[3]:
+                by_encoding[row[4]].append(i)
+        vectors: List[Optional[Vector]] = [None] * len(rows)
+        for encoding, indexes in by_encoding.items():
+            decoded = decode_vectors(
+                [rows[i][3] for i in indexes], ScalarEncoding(encoding)
+            )
+            for i, vector in zip(indexes, decoded):
+                vectors[i] = vector
+
+        return [
+            EmbeddingRecord(
+                seq_id=row[0],
+                operation=_operation_codes_inv[row[1]],
+                id=row[2],
+                embedding=vector,
+                encoding=ScalarEncoding(row[4]) if vector is not None else None,
+                metadata=json.loads(row[5]) if row[5] else None,
+            )
+            for row, vector in zip(rows, vectors)
+        ]
 
     def _validate_range(
         self, start: Optional[SeqId], end: Optional[SeqId]
@@ -236,35 +588,60 @@ class SqlEmbeddingsQueue(SqlDB, Producer, Consumer):
 
     def _next_seq_id(self) -> int:
         """Get the next SeqID for this database."""
-        t = Table("embeddings_queue")
-        q = self.querybuilder().from_(t).select(functions.Max(t.seq_id))
         with self.tx() as cur:
-            cur.execute(q.get_sql())
+            cur.execute(self.statement("max_queue_seq_id", self._build_max_seq_id))
             return int(cur.fetchone()[0]) + 1
 
-    def _notify_all(self, topic: str, embedding: EmbeddingRecord) -> None:
+    def _get_applier(self, topic: str) -> _TopicApplier:
+        with self._appliers_lock:
+            if topic not in self._appliers:
+                self._appliers[topic] = _TopicApplier(
+                    topic,
+                    self._async_ingest_buffer_size,
+                    self._batch_size,
+                    self._apply,
+                )
+            return self._appliers[topic]
+
+    def _stop_appliers(self) -> None:
+        with self._appliers_lock:
+            appliers = list(self._appliers.values())
+            self._appliers = {}
+        for applier in appliers:
+            applier.stop()
+
+    def _apply(self, topic: str, embeddings: Sequence[EmbeddingRecord]) -> None:
+        """Deliver records from an applier to the subscribers of their topic"""
+        with self._subscriptions_lock:
+            self._notify_all(topic, embeddings)
+
+    def _notify_all(self, topic: str, embeddings: Sequence[EmbeddingRecord]) -> None:
         """Send a notification to each subscriber of the given topic."""
         if self._running:
-            for sub in self._subscriptions[topic]:
-                self._notify_one(sub, embedding)
+            for sub in list(self._subscriptions[topic]):
+                self._notify_one(sub, embeddings)
+
+    def _notify_one(
+        self, sub: Subscription, embeddings: Sequence[EmbeddingRecord]
+    ) -> None:
+        """Send a notification to a single subscriber, with the records in the range of
+        its subscription, in batches of at most batch_size records. The records must be
+        in SeqID order."""
+        selected = [e for e in embeddings if sub.start < e["seq_id"] <= sub.end]
+
+        for i in range(0, len(selected), self._batch_size):
+            batch = selected[i : i + self._batch_size]
+            # Log errors instead of throwing them to preserve async semantics
+            # for consistency between local and distributed configurations
+            try:
+                sub.callback(batch)
+            except BaseException as e:
+                ids = [r.get("id", r.get("delete_id")) for r in batch]
+                logger.error(
+                    f"Exception occurred invoking consumer for subscription {sub.id}"
+                    + f"to topic {sub.topic_name} for embedding ids {ids} ",
+                    e,
+                )
 
-    def _notify_one(self, sub: Subscription, embedding: EmbeddingRecord) -> None:
-        """Send a notification to a single subscriber."""
-        if embedding["seq_id"] > sub.end:
+        if embeddings[-1]["seq_id"] > sub.end:
             self.unsubscribe(sub.id)
-            return
-
-        if embedding["seq_id"] <= sub.start:
-            return
-
-        # Log errors instead of throwing them to preserve async semantics
-        # for consistency between local and distributed configurations
-        try:
-            sub.callback([embedding])
-        except BaseException as e:
-            id = embedding.get("id", embedding.get("delete_id"))
-            logger.error(
-                f"Exception occurred invoking consumer for subscription {sub.id}"
-                + f"to topic {sub.topic_name} for embedding id {id} ",
-                e,
-            )
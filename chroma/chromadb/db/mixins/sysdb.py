@@ -2,7 +2,7 @@ from typing import Optional, Sequence, Any, Tuple, cast, Dict, Union, Set
 from uuid import UUID
 from overrides import override
 from pypika import Table, Column
-from itertools import groupby
+from itertools import count, groupby
 
 from chromadb.config import System
 from chromadb.db.base import (
@@ -148,7 +148,7 @@ class SqlSysDB(SqlDB, SysDB):
                 segments_t.collection == ParameterValue(self.uuid_to_db(collection))
             )
 
-        with self.tx() as cur:
+        with self.read_tx() as cur:
             sql, params = get_sql(q, self.parameter_format())
             rows = cur.execute(sql, params).fetchall()
             by_segment = groupby(rows, lambda r: cast(object, r[0]))
@@ -182,34 +182,17 @@ class SqlSysDB(SqlDB, SysDB):
         name: Optional[str] = None,
     ) -> Sequence[Collection]:
         """Get collections by name, embedding function and/or metadata"""
-        collections_t = Table("collections")
-        metadata_t = Table("collection_metadata")
-        q = (
-            self.querybuilder()
-            .from_(collections_t)
-            .select(
-                collections_t.id,
-                collections_t.name,
-                collections_t.topic,
-                collections_t.dimension,
-                metadata_t.key,
-                metadata_t.str_value,
-                metadata_t.int_value,
-                metadata_t.float_value,
-            )
-            .left_join(metadata_t)
-            .on(collections_t.id == metadata_t.collection_id)
-            .orderby(collections_t.id)
+        filters = (bool(id), bool(topic), bool(name))
+        sql = self.statement(
+            ("get_collections", filters), lambda: self._build_get_collections(*filters)
+        )
+        params = tuple(
+            value
+            for value, present in zip((self.uuid_to_db(id), topic, name), filters)
+            if present
         )
-        if id:
-            q = q.where(collections_t.id == ParameterValue(self.uuid_to_db(id)))
-        if topic:
-            q = q.where(collections_t.topic == ParameterValue(topic))
-        if name:
-            q = q.where(collections_t.name == ParameterValue(name))
 
-        with self.tx() as cur:
-            sql, params = get_sql(q, self.parameter_format())
+        with self.read_tx() as cur:
             rows = cur.execute(sql, params).fetchall()
             by_collection = groupby(rows, lambda r: cast(object, r[0]))
             collections = []
@@ -232,6 +215,36 @@ class SqlSysDB(SqlDB, SysDB):
 
             return collections
 
+    def _build_get_collections(self, id: bool, topic: bool, name: bool) -> str:
+        """Build the get_collections statement, filtering on the given columns"""
+        collections_t = Table("collections")
+        metadata_t = Table("collection_metadata")
+        q = (
+            self.querybuilder()
+            .from_(collections_t)
+            .select(
+                collections_t.id,
+                collections_t.name,
+                collections_t.topic,
+                collections_t.dimension,
+                metadata_t.key,
+                metadata_t.str_value,
+                metadata_t.int_value,
+                metadata_t.float_value,
+            )
+            .left_join(metadata_t)
+            .on(collections_t.id == metadata_t.collection_id)
+            .orderby(collections_t.id)
+        )
+        placeholders = (self.param(i) for i in count(1))
+        if id:
+            q = q.where(collections_t.id == next(placeholders))
+        if topic:
+            q = q.where(collections_t.topic == next(placeholders))
+        if name:
+            q = q.where(collections_t.name == next(placeholders))
+        return str(q.get_sql())
+
     @override
     def delete_segment(self, id: UUID) -> None:
         """Delete a segment from the SysDB"""
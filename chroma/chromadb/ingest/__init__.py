@@ -1,5 +1,5 @@
 from abc import abstractmethod
-from typing import Callable, Optional, Sequence
+from typing import Callable, List, Optional, Sequence, Tuple, cast
 from chromadb.types import (
     SubmitEmbeddingRecord,
     EmbeddingRecord,
@@ -9,29 +9,79 @@ from chromadb.types import (
 )
 from chromadb.config import Component
 from uuid import UUID
-import array
+import numpy as np
+import numpy.typing as npt
 
+_dtypes = {
+    ScalarEncoding.FLOAT32: np.float32,
+    ScalarEncoding.INT32: np.int32,
+    ScalarEncoding.FLOAT16: np.float16,
+    ScalarEncoding.INT8: np.int8,
+}
 
-def encode_vector(vector: Vector, encoding: ScalarEncoding) -> bytes:
-    """Encode a vector into a byte array."""
 
-    if encoding == ScalarEncoding.FLOAT32:
-        return array.array("f", vector).tobytes()
-    elif encoding == ScalarEncoding.INT32:
-        return array.array("i", vector).tobytes()
-    else:
+def _dtype(encoding: ScalarEncoding) -> "np.dtype[np.generic]":
+    if encoding not in _dtypes:
         raise ValueError(f"Unsupported encoding: {encoding.value}")
+    return np.dtype(_dtypes[encoding])
 
 
-def decode_vector(vector: bytes, encoding: ScalarEncoding) -> Vector:
-    """Decode a byte array into a vector"""
+def quantize_int8(
+    vectors: npt.ArrayLike,
+) -> Tuple[npt.NDArray[np.int8], npt.NDArray[np.float32]]:
+    """Scale each row of a 2-D array into int8 by its largest magnitude. Returns the
+    int8 rows and the float32 scale of each row, see dequantize_int8."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    max_abs = np.abs(vectors).max(axis=1, initial=0)
+    scales = np.where(max_abs > 0, max_abs / 127, 1).astype(np.float32)
+    quantized = np.rint(vectors / scales[:, np.newaxis]).clip(-127, 127)
+    return quantized.astype(np.int8), scales
+
+
+def dequantize_int8(
+    quantized: npt.NDArray[np.int8], scales: npt.NDArray[np.float32]
+) -> npt.NDArray[np.float32]:
+    """Recover the float32 rows of quantize_int8 output"""
+    return quantized.astype(np.float32) * scales[:, np.newaxis]
+
+
+def encode_vector(vector: Vector, encoding: ScalarEncoding) -> bytes:
+    """Encode a vector into a byte array. INT8 vectors are prefixed by their float32
+    scale."""
+    if encoding == ScalarEncoding.INT8:
+        quantized, scales = quantize_int8(np.asarray(vector).reshape(1, -1))
+        return scales.tobytes() + quantized.tobytes()
+    return np.asarray(vector, dtype=_dtype(encoding)).tobytes()
+
 
-    if encoding == ScalarEncoding.FLOAT32:
-        return array.array("f", vector).tolist()
-    elif encoding == ScalarEncoding.INT32:
-        return array.array("i", vector).tolist()
+def decode_vector(vector: bytes, encoding: ScalarEncoding) -> Vector:
+    """Decode a byte array into a read-only numpy array. FLOAT32 and INT32 vectors
+    are views of the given bytes, FLOAT16 and INT8 vectors are decoded to float32."""
+    return decode_vectors([vector], encoding)[0]
+
+
+def decode_vectors(vectors: Sequence[bytes], encoding: ScalarEncoding) -> List[Vector]:
+    """Decode a sequence of byte arrays with the same encoding into vectors, see
+    decode_vector. Vectors of the same length are decoded into the rows of a single
+    2-D numpy array."""
+    dtype = _dtype(encoding)
+    if len(vectors) == 0:
+        return []
+    width = len(vectors[0])
+    if any(len(v) != width for v in vectors):
+        return [decode_vectors([v], encoding)[0] for v in vectors]
+
+    data = np.frombuffer(b"".join(vectors), dtype=np.uint8).reshape(-1, width)
+    if encoding == ScalarEncoding.INT8:
+        scales = data[:, :4].copy().view(np.float32).ravel()
+        matrix = dequantize_int8(data[:, 4:].view(np.int8), scales)
+        matrix.flags.writeable = False
+    elif encoding == ScalarEncoding.FLOAT16:
+        matrix = data.view(dtype).astype(np.float32)
+        matrix.flags.writeable = False
     else:
-        raise ValueError(f"Unsupported encoding: {encoding.value}")
+        matrix = data.view(dtype)
+    return cast(List[Vector], list(matrix))
 
 
 class Producer(Component):
@@ -52,6 +102,14 @@ class Producer(Component):
         """Add an embedding record to the given topic. Returns the SeqID of the record."""
         pass
 
+    @abstractmethod
+    def submit_embeddings(
+        self, topic_name: str, embeddings: Sequence[SubmitEmbeddingRecord]
+    ) -> Sequence[SeqId]:
+        """Add a batch of embedding records to the given topic, atomically. Returns the
+        SeqIDs of the records, in the same order."""
+        pass
+
 
 ConsumerCallbackFn = Callable[[Sequence[EmbeddingRecord]], None]
 
@@ -0,0 +1,6 @@
+-- Covering indexes for where filters, which select the IDs of embeddings with a
+-- given key and value of a given type
+CREATE INDEX embedding_metadata_string_value ON embedding_metadata (key, string_value, id);
+CREATE INDEX embedding_metadata_int_value ON embedding_metadata (key, int_value, id);
+CREATE INDEX embedding_metadata_float_value ON embedding_metadata (key, float_value, id);
+CREATE INDEX embedding_metadata_bool_value ON embedding_metadata (key, bool_value, id);
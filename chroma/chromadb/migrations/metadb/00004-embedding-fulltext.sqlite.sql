@@ -0,0 +1,10 @@
+-- Replace the full text table with one that is keyed by the embedding's id (as its
+-- rowid) and indexes trigrams, so that substring ($contains) filters are index lookups
+-- that keep their case sensitive substring semantics.
+CREATE VIRTUAL TABLE embedding_fulltext_search USING fts5(
+    string_value, tokenize='trigram case_sensitive 1'
+);
+INSERT OR REPLACE INTO embedding_fulltext_search (rowid, string_value)
+    SELECT CAST(id AS INTEGER), string_value FROM embedding_fulltext
+    WHERE CAST(id AS INTEGER) IN (SELECT id FROM embeddings);
+DROP TABLE embedding_fulltext;
@@ -0,0 +1,3 @@
+-- Index to sort embeddings by the value of a metadata key, whatever its type. Each
+-- metadata row has exactly one non NULL value column.
+CREATE INDEX embedding_metadata_sort ON embedding_metadata (key, COALESCE(string_value, int_value, float_value, bool_value), id);
@@ -0,0 +1,24 @@
+-- Statistics of each metadata segment, maintained as records are written so that
+-- reading them does not scan the segment
+CREATE TABLE segment_statistics (
+    segment_id TEXT PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0,
+    document_bytes INTEGER NOT NULL DEFAULT 0,
+    adds INTEGER NOT NULL DEFAULT 0,
+    updates INTEGER NOT NULL DEFAULT 0,
+    upserts INTEGER NOT NULL DEFAULT 0,
+    deletes INTEGER NOT NULL DEFAULT 0
+);
+
+-- Existing records are counted as adds
+INSERT INTO segment_statistics (segment_id, count, document_bytes, adds)
+SELECT
+    embeddings.segment_id,
+    count(*),
+    coalesce(sum(length(CAST(embedding_metadata.string_value AS BLOB))), 0),
+    count(*)
+FROM embeddings
+LEFT JOIN embedding_metadata
+    ON embedding_metadata.id = embeddings.id
+    AND embedding_metadata.key = 'chroma:document'
+GROUP BY embeddings.segment_id;
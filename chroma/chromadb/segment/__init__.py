@@ -1,7 +1,9 @@
 from typing import Optional, Sequence, TypeVar, Type
 from abc import abstractmethod
+from overrides import override
 from chromadb.types import (
     Collection,
+    Facet,
     MetadataEmbeddingRecord,
     Operation,
     VectorEmbeddingRecord,
@@ -10,6 +12,7 @@ from chromadb.types import (
     VectorQuery,
     VectorQueryResult,
     Segment,
+    SegmentStatistics,
     SeqId,
     Metadata,
 )
@@ -46,6 +49,36 @@ S = TypeVar("S", bound=SegmentImplementation)
 class MetadataReader(SegmentImplementation):
     """Embedding Metadata segment interface"""
 
+    @override
+    @abstractmethod
+    def count(
+        self,
+        where: Optional[Where] = None,
+        where_document: Optional[WhereDocument] = None,
+    ) -> int:
+        """Get the number of embeddings in this segment, or of those matching the
+        given filters"""
+        pass
+
+    @abstractmethod
+    def statistics(self) -> SegmentStatistics:
+        """Get the statistics of the records of this segment"""
+        pass
+
+    @abstractmethod
+    def facets(
+        self,
+        key: str,
+        where: Optional[Where] = None,
+        where_document: Optional[WhereDocument] = None,
+        limit: Optional[int] = None,
+    ) -> Sequence[Facet]:
+        """Get the distinct values of a metadata key among the records matching the
+        given filters, with the number of records having each value. Facets are
+        returned from the most to the least common value, at most limit of them
+        unless it is None."""
+        pass
+
     @abstractmethod
     def get_metadata(
         self,
@@ -54,8 +87,22 @@ class MetadataReader(SegmentImplementation):
         ids: Optional[Sequence[str]] = None,
         limit: Optional[int] = None,
         offset: Optional[int] = None,
+        after: Optional[str] = None,
+        keys: Optional[Sequence[str]] = None,
+        sort: Optional[str] = None,
     ) -> Sequence[MetadataEmbeddingRecord]:
-        """Query for embedding metadata."""
+        """Query for embedding metadata. Records are returned in the order they
+        were first added. To page through records, pass the ID of the last record of
+        the previous page as after: unlike offset, the cost of such a page does not
+        depend on how many records precede it, and a ValueError is raised if that
+        record does not exist (for instance because it was deleted). If keys is
+        given, the metadata of the records is limited to those keys (an empty list
+        returns no metadata).
+
+        If sort is given, records are returned in ascending order of the value of
+        that metadata key, or descending order if it is prefixed with a -. Records
+        with the same value, and records without the key (which come last), are in
+        the order they were added."""
         pass
 
 
@@ -78,6 +125,12 @@ class VectorReader(SegmentImplementation):
         query."""
         pass
 
+    @abstractmethod
+    def compact(self) -> bool:
+        """Reclaim the space used by deleted embeddings. Returns whether any work was
+        done."""
+        pass
+
 
 class SegmentManager(Component):
     """Interface for a pluggable strategy for creating, retrieving and instantiating
@@ -1,4 +1,16 @@
-from typing import Optional, Sequence, Any, Tuple, cast, Generator, Union, Dict
+from typing import (
+    Optional,
+    Sequence,
+    Any,
+    Tuple,
+    cast,
+    Generator,
+    Union,
+    Dict,
+    List,
+    Callable,
+    Counter as TypingCounter,
+)
 from chromadb.segment import MetadataReader
 from chromadb.ingest import Consumer
 from chromadb.config import System
@@ -9,6 +21,8 @@ from chromadb.db.base import (
     Cursor,
     ParameterValue,
     get_sql,
+    encode_seq_id,
+    decode_seq_id,
 )
 from chromadb.types import (
     Where,
@@ -20,13 +34,16 @@ from chromadb.types import (
     UpdateMetadata,
     LiteralValue,
     WhereOperator,
+    SegmentStatistics,
+    Facet,
 )
 from uuid import UUID
-from pypika import Table, Tables
+from pypika import Order, Table, Tables
 from pypika.queries import QueryBuilder
 import pypika.functions as fn
-from pypika.terms import Criterion, Function
-from itertools import islice, groupby
+from pypika.terms import Case, Criterion, ExistsCriterion, Function, Term, ValueWrapper
+from itertools import groupby
+from collections import Counter
 from functools import reduce
 import sqlite3
 
@@ -35,6 +52,25 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+_WhereExpression = Union[LiteralValue, Dict[WhereOperator, LiteralValue]]
+
+# Kinds of the numeric values of facets, in the order facets of equal values are
+# returned
+_FACET_KINDS: List[Callable[[Any], LiteralValue]] = [bool, int, float]
+
+# Most metadata rows counted for a key predicate when planning a where filter
+_ESTIMATE_LIMIT = 1000
+
+# Columns of the segment_statistics table, and the ones counting each operation
+_STATISTICS = ["count", "document_bytes", "adds", "updates", "upserts", "deletes"]
+_OPERATION_STATISTICS = {
+    Operation.ADD: "adds",
+    Operation.UPDATE: "updates",
+    Operation.UPSERT: "upserts",
+    Operation.DELETE: "deletes",
+}
+
+
 class SqliteMetadataSegment(MetadataReader):
     _consumer: Consumer
     _db: SqliteDB
@@ -63,37 +99,139 @@ class SqliteMetadataSegment(MetadataReader):
 
     @override
     def max_seqid(self) -> SeqId:
-        t = Table("max_seq_id")
-        q = (
-            self._db.querybuilder()
-            .from_(t)
-            .select(t.seq_id)
-            .where(t.segment_id == ParameterValue(self._db.uuid_to_db(self._id)))
-        )
-        sql, params = get_sql(q)
-        with self._db.tx() as cur:
-            result = cur.execute(sql, params).fetchone()
+        sql = self._db.statement("metadata_max_seqid", self._build_max_seqid)
+        with self._db.read_tx() as cur:
+            result = cur.execute(sql, (self._db.uuid_to_db(self._id),)).fetchone()
 
             if result is None:
                 return self._consumer.min_seqid()
             else:
-                return _decode_seq_id(result[0])
+                return decode_seq_id(result[0])
 
     @override
-    def count(self) -> int:
-        embeddings_t = Table("embeddings")
+    def count(
+        self,
+        where: Optional[Where] = None,
+        where_document: Optional[WhereDocument] = None,
+    ) -> int:
+        if not where and not where_document:
+            return self.statistics()["count"]
+
+        # Counts the matching embeddings without reading their metadata
+        q = self._get_query(where, where_document, None, None, None, None, [])
+        count_q = self._db.querybuilder().from_(q).select(fn.Count("*"))
+        sql, params = get_sql(count_q)
+        with self._db.read_tx() as cur:
+            return cast(int, cur.execute(sql, params).fetchone()[0])
+
+    @override
+    def statistics(self) -> SegmentStatistics:
+        sql = self._db.statement("metadata_statistics", self._build_statistics)
+        with self._db.read_tx() as cur:
+            row = cur.execute(sql, (self._db.uuid_to_db(self._id),)).fetchone()
+        values = row if row is not None else (0,) * len(_STATISTICS)
+        return cast(SegmentStatistics, dict(zip(_STATISTICS, values)))
+
+    @override
+    def facets(
+        self,
+        key: str,
+        where: Optional[Where] = None,
+        where_document: Optional[WhereDocument] = None,
+        limit: Optional[int] = None,
+    ) -> Sequence[Facet]:
+        q = self._facets_query(key, where, where_document, limit)
+        sql, params = get_sql(q)
+        with self._db.read_tx() as cur:
+            rows = cur.execute(sql, params).fetchall()
+
+        facets = []
+        for value, kind, count in rows:
+            if not isinstance(value, str):
+                value = _FACET_KINDS[kind](value)
+            facets.append(Facet(value=value, count=count))
+        return facets
+
+    def _facets_query(
+        self,
+        key: str,
+        where: Optional[Where],
+        where_document: Optional[WhereDocument],
+        limit: Optional[int] = None,
+    ) -> QueryBuilder:
+        """Build the query of facets, returning rows of a value, its kind (an index
+        of _FACET_KINDS, ignored for strings) and its count, from the most to the
+        least common value and then in order of value"""
+        embeddings_t, metadata_t, fulltext_t = Tables(
+            "embeddings", "embedding_metadata", "embedding_fulltext_search"
+        )
+        facet_t = metadata_t.as_("facet")
+        # Grouping by the value walks the (key, value, id) embedding_metadata_sort
+        # index in order. SQLite compares True, 1 and 1.0 as equal there, so each
+        # group counts its bools and ints, and is split by kind of value below.
+        value = fn.Coalesce(
+            facet_t.string_value,
+            facet_t.int_value,
+            facet_t.float_value,
+            facet_t.bool_value,
+        )
+        count = fn.Count("*")
         q = (
             self._db.querybuilder()
-            .from_(embeddings_t)
+            .from_(facet_t)
+            .join(embeddings_t)
+            .on(embeddings_t.id == facet_t.id)
+            .select(
+                value.as_("value"),
+                fn.Sum(facet_t.bool_value.notnull()).as_("bools"),
+                fn.Sum(facet_t.int_value.notnull()).as_("ints"),
+                count.as_("count"),
+            )
+            .where(facet_t.key == ParameterValue(key))
             .where(
-                embeddings_t.segment_id == ParameterValue(self._db.uuid_to_db(self._id))
+                self.Unindexed(embeddings_t.segment_id)
+                == ParameterValue(self._db.uuid_to_db(self._id))
             )
-            .select(fn.Count(embeddings_t.id))
+            .groupby(value)
         )
-        sql, params = get_sql(q)
-        with self._db.tx() as cur:
-            result = cur.execute(sql, params).fetchone()[0]
-            return cast(int, result)
+        if where:
+            q = q.where(self._where_map_criterion(q, where, embeddings_t, metadata_t))
+        if where_document:
+            q = q.where(
+                self._where_doc_criterion(q, where_document, embeddings_t, fulltext_t)
+            )
+
+        # One row per group and kind, so that the limit applies to facets
+        kinds = reduce(
+            lambda x, y: x * y,
+            [
+                self._db.querybuilder().select(
+                    ValueWrapper(i).as_("kind"), wrap_set_operation_queries=False
+                )
+                for i in range(len(_FACET_KINDS))
+            ],
+        ).as_("kinds")
+        groups = q.as_("groups")
+        kind_count = (
+            Case()
+            .when(kinds.kind == 0, groups.bools)
+            .when(kinds.kind == 1, groups.ints)
+            .else_(groups.count - groups.bools - groups.ints)
+        )
+        facets_q = (
+            self._db.querybuilder()
+            .from_(groups)
+            .join(kinds)
+            .cross()
+            .select(groups.value, kinds.kind, kind_count)
+            .where(kind_count > 0)
+            .orderby(kind_count, order=Order.desc)
+            .orderby(groups.value)
+            .orderby(kinds.kind)
+        )
+        if limit is not None:
+            facets_q = facets_q.limit(limit)
+        return facets_q
 
     @override
     def get_metadata(
@@ -103,54 +241,244 @@ class SqliteMetadataSegment(MetadataReader):
         ids: Optional[Sequence[str]] = None,
         limit: Optional[int] = None,
         offset: Optional[int] = None,
+        after: Optional[str] = None,
+        keys: Optional[Sequence[str]] = None,
+        sort: Optional[str] = None,
     ) -> Sequence[MetadataEmbeddingRecord]:
         """Query for embedding metadata."""
+        with self._db.read_tx() as cur:
+            after_id = self._cursor_id(cur, after) if after is not None else None
+            q = self._get_query(
+                where, where_document, ids, limit, offset, after_id, keys, sort
+            )
+            records = list(self._records(cur, q))
+            if sort is None or (limit is not None and len(records) == limit):
+                return records
 
+            # Records without the sort key come after the sorted ones, in the order
+            # they were added
+            if records or not offset:
+                missing_offset = 0
+            else:
+                # The page starts after every sorted record, which must be counted
+                sorted_q = self._get_query(
+                    where, where_document, ids, None, None, None, [], sort
+                )
+                count_q = self._db.querybuilder().from_(sorted_q).select(fn.Count("*"))
+                sql, params = get_sql(count_q)
+                missing_offset = offset - cur.execute(sql, params).fetchone()[0]
+            missing_q = self._get_query(
+                where,
+                where_document,
+                ids,
+                limit - len(records) if limit is not None else None,
+                missing_offset,
+                None,
+                keys,
+                sort,
+                sort_missing=True,
+            )
+            records.extend(self._records(cur, missing_q))
+            return records
+
+    def _cursor_id(self, cur: Cursor, after: str) -> int:
+        """Return the primary key of the record with the given ID, which keyset
+        pagination continues after"""
+        sql = self._db.statement("metadata_cursor_id", self._build_cursor_id)
+        result = cur.execute(sql, (self._db.uuid_to_db(self._id), after)).fetchone()
+        if result is None:
+            # An empty page would look like the end of the records
+            raise ValueError(
+                f"Cannot continue after record {after}, which does not exist or was"
+                " deleted"
+            )
+        return cast(int, result[0])
+
+    def _build_cursor_id(self) -> str:
+        embeddings_t = Table("embeddings")
+        # Looked up in the (segment_id, embedding_id) unique index
+        q = (
+            self._db.querybuilder()
+            .from_(embeddings_t)
+            .select(embeddings_t.id)
+            .where(embeddings_t.segment_id == self._db.param(1))
+            .where(embeddings_t.embedding_id == self._db.param(2))
+        )
+        return str(q.get_sql())
+
+    def _get_query(
+        self,
+        where: Optional[Where],
+        where_document: Optional[WhereDocument],
+        ids: Optional[Sequence[str]],
+        limit: Optional[int],
+        offset: Optional[int],
+        after: Optional[int],
+        keys: Optional[Sequence[str]] = None,
+        sort: Optional[str] = None,
+        sort_missing: bool = False,
+    ) -> QueryBuilder:
+        """Build the query of get_metadata, returning rows of embedding and metadata
+        columns in ID order, in order of relevance for a $search, or in order of the
+        value of the sort key for the embeddings that have it (sort_missing selects
+        the others instead, in ID order). after is the primary key of the record to
+        continue after. Only the metadata rows of the given keys are joined, and with
+        no keys only the embedding columns are returned."""
         embeddings_t, metadata_t, fulltext_t = Tables(
-            "embeddings", "embedding_metadata", "embedding_fulltext"
+            "embeddings", "embedding_metadata", "embedding_fulltext_search"
         )
+        segment_id = self._db.uuid_to_db(self._id)
 
-        q = (
-            (
-                self._db.querybuilder()
-                .from_(embeddings_t)
-                .left_join(metadata_t)
-                .on(embeddings_t.id == metadata_t.id)
-            )
-            .select(
-                embeddings_t.id,
-                embeddings_t.embedding_id,
-                embeddings_t.seq_id,
-                metadata_t.key,
-                metadata_t.string_value,
-                metadata_t.int_value,
-                metadata_t.float_value,
-                metadata_t.bool_value,
-            )
-            .where(
-                embeddings_t.segment_id == ParameterValue(self._db.uuid_to_db(self._id))
-            )
-            .orderby(embeddings_t.id)
+        by_key = sort is not None and not sort_missing
+        if sort is not None:
+            if after is not None:
+                raise ValueError("Keyset pagination is not supported with sort")
+            sort_key, order = _sort_order(sort)
+
+        # When the where filter selects the candidate embeddings from a metadata
+        # index, they are looked up by primary key. SQLite would otherwise rather
+        # scan the whole segment through the segment_id index, testing each
+        # embedding against the candidates.
+        # Likewise, sorted embeddings are looked up by primary key while walking the
+        # sort index in order.
+        if not ids and (by_key or (where and _has_key_predicate(where))):
+            segment_col: Term = self.Unindexed(embeddings_t.segment_id)
+        else:
+            segment_col = embeddings_t.segment_id
+
+        # Select the matching embeddings first, so that pagination applies to
+        # embeddings (using the primary key) rather than to their metadata rows
+        ids_q = (
+            self._db.querybuilder()
+            .from_(embeddings_t)
+            .select(embeddings_t.id)
+            .where(segment_col == ParameterValue(segment_id))
         )
 
         if where:
-            q = q.where(self._where_map_criterion(q, where, embeddings_t, metadata_t))
+            # Given IDs are looked up in the (segment_id, embedding_id) index, leaving
+            # the where filter to be checked per embedding
+            ids_q = ids_q.where(
+                self._where_map_criterion(
+                    ids_q, where, embeddings_t, metadata_t, probe_only=bool(ids)
+                )
+            )
 
-        if where_document:
-            q = q.where(
-                self._where_doc_criterion(q, where_document, embeddings_t, fulltext_t)
+        # A top level $search ranks the matching embeddings by relevance (bm25),
+        # unless they are sorted
+        ranked = (
+            sort is None and where_document is not None and "$search" in where_document
+        )
+        if ranked:
+            if after is not None:
+                raise ValueError("Keyset pagination is not supported with $search")
+            search = cast(str, cast(WhereDocument, where_document)["$search"])
+            ids_q = (
+                ids_q.join(fulltext_t)
+                .on(fulltext_t.rowid == embeddings_t.id)
+                .select(fulltext_t.rank)
+                .where(
+                    self.Match(
+                        fulltext_t.string_value,
+                        ParameterValue(_fts_search_query(search)),
+                    )
+                )
+                .orderby(fulltext_t.rank)
+                .orderby(embeddings_t.id)
+            )
+        elif where_document:
+            ids_q = ids_q.where(
+                self._where_doc_criterion(
+                    ids_q, where_document, embeddings_t, fulltext_t
+                )
             )
-            pass
-            # q = self._where_document_query(q, where_document, embeddings_t, fulltext_t)
 
         if ids:
-            q = q.where(embeddings_t.embedding_id.isin(ParameterValue(ids)))
+            ids_q = ids_q.where(embeddings_t.embedding_id.isin(ParameterValue(ids)))
 
-        limit = limit or 2**63 - 1
-        offset = offset or 0
+        if after is not None:
+            # Keyset pagination: continue from the primary key of the given record
+            ids_q = ids_q.where(embeddings_t.id > ParameterValue(after))
 
-        with self._db.tx() as cur:
-            return list(islice(self._records(cur, q), offset, offset + limit))
+        if sort is not None:
+            sort_t = metadata_t.as_("sort")
+            has_key = (sort_t.id == embeddings_t.id) & (
+                sort_t.key == ParameterValue(sort_key)
+            )
+            if by_key:
+                # Walks the (key, value, id) embedding_metadata_sort index
+                sort_value = fn.Coalesce(
+                    sort_t.string_value,
+                    sort_t.int_value,
+                    sort_t.float_value,
+                    sort_t.bool_value,
+                )
+                # Ties are in the order the records were added, in either order
+                ids_q = (
+                    ids_q.join(sort_t)
+                    .on(has_key)
+                    .select(sort_value.as_("sort_value"))
+                    .orderby(sort_value, order=order)
+                    .orderby(sort_t.id)
+                )
+            else:
+                ids_q = ids_q.where(
+                    ExistsCriterion(
+                        self._db.querybuilder()
+                        .from_(sort_t)
+                        .select(sort_t.id)
+                        .where(has_key)
+                    ).negate()
+                )
+
+        if limit or offset:
+            # SQLite requires a LIMIT for OFFSET, and treats a negative one as none
+            if not ranked and not by_key:
+                ids_q = ids_q.orderby(embeddings_t.id)
+            ids_q = ids_q.limit(limit or -1)
+            if offset:
+                ids_q = ids_q.offset(offset)
+
+        q = self._db.querybuilder().from_(embeddings_t)
+        if ranked:
+            page = ids_q.as_("page")
+            q = (
+                q.join(page)
+                .on(embeddings_t.id == page.id)
+                .orderby(page.rank)
+                .orderby(embeddings_t.id)
+            )
+        elif by_key:
+            page = ids_q.as_("page")
+            q = (
+                q.join(page)
+                .on(embeddings_t.id == page.id)
+                .orderby(page.sort_value, order=order)
+                .orderby(embeddings_t.id)
+            )
+        else:
+            q = q.where(embeddings_t.id.isin(ids_q)).orderby(embeddings_t.id)
+
+        q = q.select(embeddings_t.id, embeddings_t.embedding_id, embeddings_t.seq_id)
+        if keys is not None and len(keys) == 0:
+            return q
+
+        join = embeddings_t.id == metadata_t.id
+        if keys is not None:
+            # Looked up in the (id, key) primary key
+            join &= metadata_t.key.isin(ParameterValue(list(keys)))
+        q = (
+            q.left_join(metadata_t)
+            .on(join)
+            .select(
+                metadata_t.key,
+                metadata_t.string_value,
+                metadata_t.int_value,
+                metadata_t.float_value,
+                metadata_t.bool_value,
+            )
+        )
+        return q
 
     def _records(
         self, cur: Cursor, q: QueryBuilder
@@ -172,7 +500,8 @@ class SqliteMetadataSegment(MetadataReader):
         MetadataEmbeddingRecord"""
         _, embedding_id, seq_id = rows[0][:3]
         metadata = {}
-        for row in rows:
+        # Rows without metadata columns when no metadata keys were requested
+        for row in rows if len(rows[0]) > 3 else []:
             key, string_value, int_value, float_value, bool_value = row[3:]
             if string_value is not None:
                 metadata[key] = string_value
@@ -188,46 +517,57 @@ class SqliteMetadataSegment(MetadataReader):
 
         return MetadataEmbeddingRecord(
             id=embedding_id,
-            seq_id=_decode_seq_id(seq_id),
+            seq_id=decode_seq_id(seq_id),
             metadata=metadata or None,
         )
 
     def _insert_record(
-        self, cur: Cursor, record: EmbeddingRecord, upsert: bool
-    ) -> None:
-        """Add or update a single EmbeddingRecord into the DB"""
-
-        t = Table("embeddings")
-        q = (
-            self._db.querybuilder()
-            .into(t)
-            .columns(t.segment_id, t.embedding_id, t.seq_id)
-            .where(t.segment_id == ParameterValue(self._db.uuid_to_db(self._id)))
-            .where(t.embedding_id == ParameterValue(record["id"]))
-        ).insert(
-            ParameterValue(self._db.uuid_to_db(self._id)),
-            ParameterValue(record["id"]),
-            ParameterValue(_encode_seq_id(record["seq_id"])),
+        self,
+        cur: Cursor,
+        record: EmbeddingRecord,
+        upsert: bool,
+        statistics: TypingCounter[str],
+    ) -> bool:
+        """Add or update a single EmbeddingRecord into the DB, returning whether it
+        was written"""
+        sql = self._db.statement("metadata_insert_record", self._build_insert_record)
+        params = (
+            self._db.uuid_to_db(self._id),
+            record["id"],
+            encode_seq_id(record["seq_id"]),
         )
-        sql, params = get_sql(q)
-        sql = sql + "RETURNING id"
         try:
             id = cur.execute(sql, params).fetchone()[0]
         except sqlite3.IntegrityError:
             # Can't use INSERT OR REPLACE here because it changes the primary key.
             if upsert:
-                return self._update_record(cur, record)
+                return self._update_record(cur, record, statistics)
             else:
                 logger.warning(f"Insert of existing embedding ID: {record['id']}")
                 # We are trying to add for a record that already exists. Fail the call.
                 # We don't throw an exception since this is in principal an async path
-                return
+                return False
 
+        statistics["count"] += 1
         if record["metadata"]:
-            self._update_metadata(cur, id, record["metadata"])
+            # A new record has no metadata to update or delete
+            self._insert_metadata(cur, id, record["metadata"])
+            statistics["document_bytes"] += _document_bytes(record["metadata"])
+        return True
 
-    def _update_metadata(self, cur: Cursor, id: int, metadata: UpdateMetadata) -> None:
+    def _update_metadata(
+        self,
+        cur: Cursor,
+        id: int,
+        metadata: UpdateMetadata,
+        statistics: TypingCounter[str],
+    ) -> None:
         """Update the metadata for a single EmbeddingRecord"""
+        if "chroma:document" in metadata:
+            statistics["document_bytes"] += _document_bytes(
+                metadata
+            ) - self._stored_document_bytes(cur, id)
+
         t = Table("embedding_metadata")
         to_delete = [k for k, v in metadata.items() if v is None]
         if to_delete:
@@ -242,172 +582,393 @@ class SqliteMetadataSegment(MetadataReader):
             cur.execute(sql, params)
 
         if "chroma:document" in metadata:
-            t = Table("embedding_fulltext")
-            q = (
-                self._db.querybuilder()
-                .from_(t)
-                .where(t.id == ParameterValue(id))
-                .delete()
+            sql = self._db.statement(
+                "metadata_delete_fulltext", self._build_delete_fulltext
             )
-            sql, params = get_sql(q)
-            cur.execute(sql, params)
+            cur.execute(sql, (id,))
 
         self._insert_metadata(cur, id, metadata)
 
     def _insert_metadata(self, cur: Cursor, id: int, metadata: UpdateMetadata) -> None:
         """Insert or update each metadata row for a single embedding record"""
-        t = Table("embedding_metadata")
-        q = (
-            self._db.querybuilder()
-            .into(t)
-            .columns(
-                t.id, t.key, t.string_value, t.int_value, t.float_value, t.bool_value
-            )
-        )
+        rows: List[Tuple[Any, ...]] = []
         for key, value in metadata.items():
             if isinstance(value, str):
-                q = q.insert(
-                    ParameterValue(id),
-                    ParameterValue(key),
-                    ParameterValue(value),
-                    None,
-                    None,
-                    None,
-                )
+                rows.append((id, key, value, None, None, None))
             # isinstance(True, int) evaluates to True, so we need to check for bools separately
             elif isinstance(value, bool):
-                q = q.insert(
-                    ParameterValue(id),
-                    ParameterValue(key),
-                    None,
-                    None,
-                    None,
-                    ParameterValue(value),
-                )
+                rows.append((id, key, None, None, None, value))
             elif isinstance(value, int):
-                q = q.insert(
-                    ParameterValue(id),
-                    ParameterValue(key),
-                    None,
-                    ParameterValue(value),
-                    None,
-                    None,
-                )
+                rows.append((id, key, None, value, None, None))
             elif isinstance(value, float):
-                q = q.insert(
-                    ParameterValue(id),
-                    ParameterValue(key),
-                    None,
-                    None,
-                    ParameterValue(value),
-                    None,
-                )
+                rows.append((id, key, None, None, value, None))
 
-        sql, params = get_sql(q)
-        sql = sql.replace("INSERT", "INSERT OR REPLACE")
-        if sql:
-            cur.execute(sql, params)
+        if rows:
+            sql = self._db.statement(
+                "metadata_insert_metadata", self._build_insert_metadata
+            )
+            cur.executemany(sql, rows)
 
         if "chroma:document" in metadata:
-            t = Table("embedding_fulltext")
-            q = (
-                self._db.querybuilder()
-                .into(t)
-                .columns(t.id, t.string_value)
-                .insert(ParameterValue(id), ParameterValue(metadata["chroma:document"]))
+            sql = self._db.statement(
+                "metadata_insert_fulltext", self._build_insert_fulltext
             )
-            sql, params = get_sql(q)
-            cur.execute(sql, params)
+            cur.execute(sql, (id, metadata["chroma:document"]))
 
-    def _delete_record(self, cur: Cursor, record: EmbeddingRecord) -> None:
-        """Delete a single EmbeddingRecord from the DB"""
-        t = Table("embeddings")
-        q = (
-            self._db.querybuilder()
-            .from_(t)
-            .where(t.segment_id == ParameterValue(self._db.uuid_to_db(self._id)))
-            .where(t.embedding_id == ParameterValue(record["id"]))
-            .delete()
-        )
-        sql, params = get_sql(q)
-        sql = sql + " RETURNING id"
+    def _stored_document_bytes(self, cur: Cursor, id: int) -> int:
+        """Return the size in bytes of the stored document of an embedding"""
+        sql = self._db.statement("metadata_document_bytes", self._build_document_bytes)
+        result = cur.execute(sql, (id,)).fetchone()
+        return 0 if result is None else cast(int, result[0])
+
+    def _delete_record(
+        self, cur: Cursor, record: EmbeddingRecord, statistics: TypingCounter[str]
+    ) -> bool:
+        """Delete a single EmbeddingRecord from the DB, returning whether it
+        existed"""
+        sql = self._db.statement("metadata_delete_record", self._build_delete_record)
+        params = (self._db.uuid_to_db(self._id), record["id"])
         result = cur.execute(sql, params).fetchone()
         if result is None:
             logger.warning(f"Delete of nonexisting embedding ID: {record['id']}")
+            return False
         else:
             id = result[0]
+            statistics["count"] -= 1
+            statistics["document_bytes"] -= self._stored_document_bytes(cur, id)
 
             # Manually delete metadata; cannot use cascade because
             # that triggers on replace
-            metadata_t = Table("embedding_metadata")
-            q = (
-                self._db.querybuilder()
-                .from_(metadata_t)
-                .where(metadata_t.id == ParameterValue(id))
-                .delete()
+            sql = self._db.statement(
+                "metadata_delete_metadata", self._build_delete_metadata
             )
-            sql, params = get_sql(q)
-            cur.execute(sql, params)
+            cur.execute(sql, (id,))
+            sql = self._db.statement(
+                "metadata_delete_fulltext", self._build_delete_fulltext
+            )
+            cur.execute(sql, (id,))
+            return True
 
-    def _update_record(self, cur: Cursor, record: EmbeddingRecord) -> None:
-        """Update a single EmbeddingRecord in the DB"""
-        t = Table("embeddings")
-        q = (
-            self._db.querybuilder()
-            .update(t)
-            .set(t.seq_id, ParameterValue(_encode_seq_id(record["seq_id"])))
-            .where(t.segment_id == ParameterValue(self._db.uuid_to_db(self._id)))
-            .where(t.embedding_id == ParameterValue(record["id"]))
+    def _update_record(
+        self, cur: Cursor, record: EmbeddingRecord, statistics: TypingCounter[str]
+    ) -> bool:
+        """Update a single EmbeddingRecord in the DB, returning whether it existed"""
+        sql = self._db.statement("metadata_update_record", self._build_update_record)
+        params = (
+            encode_seq_id(record["seq_id"]),
+            self._db.uuid_to_db(self._id),
+            record["id"],
         )
-        sql, params = get_sql(q)
-        sql = sql + " RETURNING id"
         result = cur.execute(sql, params).fetchone()
         if result is None:
             logger.warning(f"Update of nonexisting embedding ID: {record['id']}")
+            return False
         else:
             id = result[0]
             if record["metadata"]:
-                self._update_metadata(cur, id, record["metadata"])
+                self._update_metadata(cur, id, record["metadata"], statistics)
+            return True
 
     def _write_metadata(self, records: Sequence[EmbeddingRecord]) -> None:
         """Write embedding metadata to the database. Care should be taken to ensure
         records are append-only (that is, that seq-ids should increase monotonically)"""
+        if len(records) == 0:
+            return
         with self._db.tx() as cur:
-            for record in records:
-                q = (
-                    self._db.querybuilder()
-                    .into(Table("max_seq_id"))
-                    .columns("segment_id", "seq_id")
-                    .insert(
-                        ParameterValue(self._db.uuid_to_db(self._id)),
-                        ParameterValue(_encode_seq_id(record["seq_id"])),
-                    )
+            # Records arrive in SeqID order, and the transaction makes the batch
+            # atomic, so recording the last SeqID once covers the whole batch
+            sql = self._db.statement(
+                "metadata_upsert_max_seq_id", self._build_upsert_max_seq_id
+            )
+            params = (
+                self._db.uuid_to_db(self._id),
+                encode_seq_id(records[-1]["seq_id"]),
+            )
+            cur.execute(sql, params)
+
+            # Changes to the segment statistics, applied once for the batch
+            statistics: TypingCounter[str] = Counter()
+            # This may be nested in the caller's transaction, which an exception would
+            # not roll back, so the batch is undone with a savepoint
+            cur.execute("SAVEPOINT metadata_batch")
+            try:
+                self._write_records(cur, records, statistics)
+            except Exception:
+                # Write the records one at a time, so that a bad record doesn't take
+                # the rest of the batch down with it
+                cur.execute("ROLLBACK TO metadata_batch")
+                logger.warning(
+                    f"Failed to write a batch of {len(records)} records to metadata "
+                    f"segment {self._id}, retrying them one at a time"
                 )
-                sql, params = get_sql(q)
-                sql = sql.replace("INSERT", "INSERT OR REPLACE")
-                cur.execute(sql, params)
-
-                if record["operation"] == Operation.ADD:
-                    self._insert_record(cur, record, False)
-                elif record["operation"] == Operation.UPSERT:
-                    self._insert_record(cur, record, True)
-                elif record["operation"] == Operation.DELETE:
-                    self._delete_record(cur, record)
-                elif record["operation"] == Operation.UPDATE:
-                    self._update_record(cur, record)
+                statistics.clear()
+                for record in records:
+                    cur.execute("SAVEPOINT metadata_record")
+                    record_statistics: TypingCounter[str] = Counter()
+                    try:
+                        self._write_records(cur, [record], record_statistics)
+                        statistics.update(record_statistics)
+                    except Exception as e:
+                        cur.execute("ROLLBACK TO metadata_record")
+                        logger.error(
+                            f"Failed to write embedding ID {record['id']} to metadata "
+                            f"segment {self._id}: {e}"
+                        )
+                    cur.execute("RELEASE metadata_record")
+            cur.execute("RELEASE metadata_batch")
+            self._update_statistics(cur, statistics)
+
+    def _write_records(
+        self,
+        cur: Cursor,
+        records: Sequence[EmbeddingRecord],
+        statistics: TypingCounter[str],
+    ) -> None:
+        """Apply records to the database, adding their changes to the statistics"""
+        for record in records:
+            if record["operation"] == Operation.ADD:
+                written = self._insert_record(cur, record, False, statistics)
+            elif record["operation"] == Operation.UPSERT:
+                written = self._insert_record(cur, record, True, statistics)
+            elif record["operation"] == Operation.DELETE:
+                written = self._delete_record(cur, record, statistics)
+            elif record["operation"] == Operation.UPDATE:
+                written = self._update_record(cur, record, statistics)
+            if written:
+                statistics[_OPERATION_STATISTICS[record["operation"]]] += 1
+
+    def _update_statistics(self, cur: Cursor, statistics: TypingCounter[str]) -> None:
+        """Add changes to the statistics of the segment"""
+        params = (*[statistics[s] for s in _STATISTICS], self._db.uuid_to_db(self._id))
+        sql = self._db.statement(
+            "metadata_update_statistics", self._build_update_statistics
+        )
+        cur.execute(sql, params)
+        if cur.rowcount == 0:
+            sql = self._db.statement(
+                "metadata_insert_statistics", self._build_insert_statistics
+            )
+            cur.execute(sql, params)
+
+    def _build_max_seqid(self) -> str:
+        t = Table("max_seq_id")
+        q = (
+            self._db.querybuilder()
+            .from_(t)
+            .select(t.seq_id)
+            .where(t.segment_id == self._db.param(1))
+        )
+        return str(q.get_sql())
+
+    def _build_statistics(self) -> str:
+        t = Table("segment_statistics")
+        q = (
+            self._db.querybuilder()
+            .from_(t)
+            .select(*[t.field(s) for s in _STATISTICS])
+            .where(t.segment_id == self._db.param(1))
+        )
+        return str(q.get_sql())
+
+    def _build_update_statistics(self) -> str:
+        t = Table("segment_statistics")
+        q = self._db.querybuilder().update(t)
+        for i, s in enumerate(_STATISTICS, 1):
+            q = q.set(t.field(s), t.field(s) + self._db.param(i))
+        q = q.where(t.segment_id == self._db.param(len(_STATISTICS) + 1))
+        return str(q.get_sql())
+
+    def _build_insert_statistics(self) -> str:
+        t = Table("segment_statistics")
+        q = (
+            self._db.querybuilder()
+            .into(t)
+            .columns(*[t.field(s) for s in _STATISTICS], t.segment_id)
+            .insert(*[self._db.param(i) for i in range(1, len(_STATISTICS) + 2)])
+        )
+        return str(q.get_sql())
+
+    def _build_document_bytes(self) -> str:
+        t = Table("embedding_metadata")
+        q = (
+            self._db.querybuilder()
+            .from_(t)
+            .select(fn.Length(fn.Cast(t.string_value, "BLOB")))
+            .where(t.id == self._db.param(1))
+            .where(t.key == "chroma:document")
+        )
+        return str(q.get_sql())
+
+    def _build_insert_record(self) -> str:
+        t = Table("embeddings")
+        q = (
+            self._db.querybuilder()
+            .into(t)
+            .columns(t.segment_id, t.embedding_id, t.seq_id)
+            .insert(self._db.param(1), self._db.param(2), self._db.param(3))
+        )
+        return f"{q.get_sql()} RETURNING id"
+
+    def _build_insert_metadata(self) -> str:
+        t = Table("embedding_metadata")
+        q = (
+            self._db.querybuilder()
+            .into(t)
+            .columns(
+                t.id, t.key, t.string_value, t.int_value, t.float_value, t.bool_value
+            )
+            .replace(*[self._db.param(i) for i in range(1, 7)])
+        )
+        return str(q.get_sql())
+
+    def _build_insert_fulltext(self) -> str:
+        t = Table("embedding_fulltext_search")
+        q = (
+            self._db.querybuilder()
+            .into(t)
+            .columns(t.rowid, t.string_value)
+            .insert(self._db.param(1), self._db.param(2))
+        )
+        return str(q.get_sql())
+
+    def _build_delete_fulltext(self) -> str:
+        t = Table("embedding_fulltext_search")
+        q = (
+            self._db.querybuilder()
+            .from_(t)
+            .where(t.rowid == self._db.param(1))
+            .delete()
+        )
+        return str(q.get_sql())
+
+    def _build_delete_record(self) -> str:
+        t = Table("embeddings")
+        q = (
+            self._db.querybuilder()
+            .from_(t)
+            .where(t.segment_id == self._db.param(1))
+            .where(t.embedding_id == self._db.param(2))
+            .delete()
+        )
+        return f"{q.get_sql()} RETURNING id"
+
+    def _build_delete_metadata(self) -> str:
+        t = Table("embedding_metadata")
+        q = self._db.querybuilder().from_(t).where(t.id == self._db.param(1)).delete()
+        return str(q.get_sql())
+
+    def _build_update_record(self) -> str:
+        t = Table("embeddings")
+        q = (
+            self._db.querybuilder()
+            .update(t)
+            .set(t.seq_id, self._db.param(1))
+            .where(t.segment_id == self._db.param(2))
+            .where(t.embedding_id == self._db.param(3))
+        )
+        return f"{q.get_sql()} RETURNING id"
+
+    def _build_upsert_max_seq_id(self) -> str:
+        t = Table("max_seq_id")
+        q = (
+            self._db.querybuilder()
+            .into(t)
+            .columns(t.segment_id, t.seq_id)
+            .replace(self._db.param(1), self._db.param(2))
+        )
+        return str(q.get_sql())
 
     def _where_map_criterion(
-        self, q: QueryBuilder, where: Where, embeddings_t: Table, metadata_t: Table
+        self,
+        q: QueryBuilder,
+        where: Where,
+        embeddings_t: Table,
+        metadata_t: Table,
+        probe_only: bool = False,
     ) -> Criterion:
-        clause: list[Criterion] = []
+        """Return a criterion for the embeddings matching a where filter.
+
+        The key predicates of a conjunction (the keys of a where, including those of
+        nested $and operands) are ordered by the number of metadata rows they match,
+        see _estimate_matches. The most selective one selects the candidate
+        embeddings from its covering index, and
+        the others are checked per candidate with an EXISTS probe of the (id, key)
+        primary key, rather than each of them materializing all the embeddings it
+        matches. With probe_only, the candidates come from elsewhere (e.g. a list of
+        IDs) and every predicate is a probe."""
+        predicates: List[Tuple[str, _WhereExpression]] = []
+        clause: List[Criterion] = []
+        self._conjunction(q, where, embeddings_t, metadata_t, predicates, clause)
+        if len(predicates) > 1:
+            matches = self._estimate_matches(predicates)
+            order = sorted(
+                range(len(predicates)),
+                key=lambda i: (matches[i], _operator_rank(predicates[i])),
+            )
+            predicates = [predicates[i] for i in order]
+
+        criteria: List[Criterion] = []
+        for i, (k, expr) in enumerate(predicates):
+            if i == 0 and not probe_only:
+                sq = (
+                    self._db.querybuilder()
+                    .from_(metadata_t)
+                    .select(metadata_t.id)
+                    .where(_where_clause(k, expr, metadata_t))
+                )
+                criteria.append(embeddings_t.id.isin(sq))
+            else:
+                probe_t = metadata_t.as_("probe")
+                sq = (
+                    self._db.querybuilder()
+                    .from_(probe_t)
+                    .select(probe_t.id)
+                    .where(probe_t.id == embeddings_t.id)
+                    .where(_where_clause(k, expr, probe_t))
+                )
+                criteria.append(ExistsCriterion(sq))
+        return reduce(lambda x, y: x & y, criteria + clause)
 
+    def _estimate_matches(
+        self, predicates: Sequence[Tuple[str, _WhereExpression]]
+    ) -> List[int]:
+        """Count the metadata rows matching each key predicate in its covering index,
+        across segments. Counting stops at _ESTIMATE_LIMIT rows, which bounds the
+        cost of planning while still telling a predicate that matches a handful of
+        rows from one that matches most of them."""
+        metadata_t = Table("embedding_metadata")
+        matches: List[int] = []
+        with self._db.read_tx() as cur:
+            for k, expr in predicates:
+                sq = (
+                    self._db.querybuilder()
+                    .from_(metadata_t)
+                    .select(metadata_t.id)
+                    .where(_where_clause(k, expr, metadata_t))
+                    .limit(_ESTIMATE_LIMIT)
+                )
+                q = self._db.querybuilder().from_(sq).select(fn.Count("*"))
+                sql, params = get_sql(q)
+                matches.append(cur.execute(sql, params).fetchone()[0])
+        return matches
+
+    def _conjunction(
+        self,
+        q: QueryBuilder,
+        where: Where,
+        embeddings_t: Table,
+        metadata_t: Table,
+        predicates: List[Tuple[str, _WhereExpression]],
+        clause: List[Criterion],
+    ) -> None:
+        """Flatten the conjunction of a where filter into its key predicates and the
+        criteria of its $or operators"""
         for k, v in where.items():
             if k == "$and":
-                criteria = [
-                    self._where_map_criterion(q, w, embeddings_t, metadata_t)
-                    for w in cast(Sequence[Where], v)
-                ]
-                clause.append(reduce(lambda x, y: x & y, criteria))
+                for w in cast(Sequence[Where], v):
+                    self._conjunction(
+                        q, w, embeddings_t, metadata_t, predicates, clause
+                    )
             elif k == "$or":
                 criteria = [
                     self._where_map_criterion(q, w, embeddings_t, metadata_t)
@@ -415,16 +976,7 @@ class SqliteMetadataSegment(MetadataReader):
                 ]
                 clause.append(reduce(lambda x, y: x | y, criteria))
             else:
-                expr = cast(Union[LiteralValue, Dict[WhereOperator, LiteralValue]], v)
-                sq = (
-                    self._db.querybuilder()
-                    .from_(metadata_t)
-                    .select(metadata_t.id)
-                    .where(metadata_t.key == ParameterValue(k))
-                    .where(_where_clause(expr, metadata_t))
-                )
-                clause.append(embeddings_t.id.isin(sq))
-        return reduce(lambda x, y: x & y, clause)
+                predicates.append((k, cast(_WhereExpression, v)))
 
     class EscapedLike(Function):  # type: ignore
         def __init__(self, column_name: str, search_term: str, escape_char: str = "\\"):
@@ -436,6 +988,24 @@ class SqliteMetadataSegment(MetadataReader):
         def get_function_sql(self, **kwargs: Any) -> str:
             return f"{self.column_name} LIKE {self.search_term} ESCAPE '{self.escape_char}'"
 
+    class Unindexed(Function):  # type: ignore
+        def __init__(self, column: Term):
+            self.column = column
+            super().__init__("+", column)
+
+        def get_function_sql(self, **kwargs: Any) -> str:
+            # A unary + keeps SQLite from using an index on the column
+            return f"+{self.column.get_sql(**kwargs)}"
+
+    class Match(Function):  # type: ignore
+        def __init__(self, column: Term, query: Term):
+            self.column = column
+            self.query = query
+            super().__init__("MATCH", column, query)
+
+        def get_function_sql(self, **kwargs: Any) -> str:
+            return f"{self.column} MATCH {self.query}"
+
     def _where_doc_criterion(
         self,
         q: QueryBuilder,
@@ -458,16 +1028,35 @@ class SqliteMetadataSegment(MetadataReader):
                 return reduce(lambda x, y: x | y, criteria)
             elif k == "$contains":
                 v = cast(str, v)
-                search_term = f"%{_escape_characters(v)}%"
-
+                criterion: Criterion
+                if len(v) >= _TRIGRAM:
+                    # A phrase of the term's trigrams matches documents containing
+                    # the term
+                    criterion = self.Match(
+                        fulltext_t.string_value, ParameterValue(_fts_phrase(v))
+                    )
+                else:
+                    # Too short to be looked up in a trigram index
+                    criterion = self.EscapedLike(
+                        fulltext_t.string_value,
+                        ParameterValue(f"%{_escape_characters(v)}%"),
+                    )
                 sq = (
                     self._db.querybuilder()
                     .from_(fulltext_t)
-                    .select(fulltext_t.id)
+                    .select(fulltext_t.rowid)
+                    .where(criterion)
+                )
+                return embeddings_t.id.isin(sq)
+            elif k == "$search":
+                sq = (
+                    self._db.querybuilder()
+                    .from_(fulltext_t)
+                    .select(fulltext_t.rowid)
                     .where(
-                        self.EscapedLike(
+                        self.Match(
                             fulltext_t.string_value,
-                            ParameterValue(search_term),
+                            ParameterValue(_fts_search_query(cast(str, v))),
                         )
                     )
                 )
@@ -477,6 +1066,34 @@ class SqliteMetadataSegment(MetadataReader):
         raise ValueError("Empty where_doc")
 
 
+# Length of the tokens of the full text index
+_TRIGRAM = 3
+
+
+def _fts_phrase(term: str) -> str:
+    """Quote a term as an FTS5 phrase, which matches it literally"""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _fts_search_query(search: str) -> str:
+    """Return an FTS5 query matching documents that contain any of the whitespace
+    separated terms of a $search. Terms shorter than a trigram cannot be looked up
+    and are ignored."""
+    terms = [_fts_phrase(t) for t in search.split() if len(t) >= _TRIGRAM]
+    if not terms:
+        raise ValueError(
+            f"Expected $search to contain a term of at least {_TRIGRAM} characters, "
+            f"got {search}"
+        )
+    return " OR ".join(terms)
+
+
+def _document_bytes(metadata: UpdateMetadata) -> int:
+    """Return the size in bytes of the document of a metadata map, if any"""
+    document = metadata.get("chroma:document")
+    return len(document.encode()) if isinstance(document, str) else 0
+
+
 def _escape_characters(string: str) -> str:
     """Escape % and _ characters in a string with a backslash as they are reserved in
     LIKE clauses"""
@@ -488,44 +1105,68 @@ def _escape_characters(string: str) -> str:
     return escaped_string
 
 
-def _encode_seq_id(seq_id: SeqId) -> bytes:
-    """Encode a SeqID into a byte array"""
-    if seq_id.bit_length() < 64:
-        return int.to_bytes(seq_id, 8, "big")
-    elif seq_id.bit_length() < 192:
-        return int.to_bytes(seq_id, 24, "big")
-    else:
-        raise ValueError(f"Unsupported SeqID: {seq_id}")
+def _sort_order(sort: str) -> Tuple[str, Order]:
+    """Return the metadata key and the order of a sort, which is descending when the
+    key is prefixed with a -"""
+    if sort.startswith("-"):
+        return sort[1:], Order.desc
+    return sort, Order.asc
+
+
+def _has_key_predicate(where: Where) -> bool:
+    """Return whether the conjunction of a where filter has a key predicate, i.e.
+    whether _where_map_criterion selects candidates from a metadata index"""
+    for k, v in where.items():
+        if k == "$and":
+            if any(_has_key_predicate(w) for w in cast(Sequence[Where], v)):
+                return True
+        elif k != "$or":
+            return True
+    return False
 
 
-def _decode_seq_id(seq_id_bytes: bytes) -> SeqId:
-    """Decode a byte array into a SeqID"""
-    if len(seq_id_bytes) == 8:
-        return int.from_bytes(seq_id_bytes, "big")
-    elif len(seq_id_bytes) == 24:
-        return int.from_bytes(seq_id_bytes, "big")
+def _operator_rank(predicate: Tuple[str, _WhereExpression]) -> int:
+    """Rank a key predicate by the selectivity its operator usually has, lower being
+    more selective: equality on a string or number, range comparisons, equality on a
+    bool (only two values), and $ne (matching every other value). This breaks ties
+    between predicates matching as many rows."""
+    _, expr = predicate
+    if isinstance(expr, (str, int, float, bool)):
+        operator, value = "$eq", expr
+    else:
+        operator, value = next(iter(expr.items()))
+    if operator == "$eq":
+        return 2 if isinstance(value, bool) else 0
+    elif operator == "$ne":
+        return 3
     else:
-        raise ValueError(f"Unknown SeqID type with length {len(seq_id_bytes)}")
+        return 1
 
 
 def _where_clause(
-    expr: Union[LiteralValue, Dict[WhereOperator, LiteralValue]],
+    key: str,
+    expr: _WhereExpression,
     table: Table,
 ) -> Criterion:
     """Given a field name, an expression, and a table, construct a Pypika Criterion"""
 
     # Literal value case
     if isinstance(expr, (str, int, float, bool)):
-        return _where_clause({"$eq": expr}, table)
+        return _where_clause(key, {"$eq": expr}, table)
 
     # Operator dict case
     operator, value = next(iter(expr.items()))
-    return _value_criterion(value, operator, table)
+    return _value_criterion(key, value, operator, table)
 
 
-def _value_criterion(value: LiteralValue, op: WhereOperator, table: Table) -> Criterion:
-    """Return a criterion to compare a value with the appropriate columns given its type
-    and the operation type."""
+def _value_criterion(
+    key: str, value: LiteralValue, op: WhereOperator, table: Table
+) -> Criterion:
+    """Return a criterion to compare the value of a key with the appropriate columns
+    given its type and the operation type. Every comparison is paired with the key
+    (key = ? AND column op ?), so that SQLite can use the (key, column, id) covering
+    index of each column, including when numbers are compared with both the int
+    and float columns."""
 
     if isinstance(value, str):
         cols = [table.string_value]
@@ -553,6 +1194,11 @@ def _value_criterion(value: LiteralValue, op: WhereOperator, table: Table) -> Cr
         col_exprs = [col <= ParameterValue(value) for col in cols]
 
     if op == "$ne":
-        return reduce(lambda x, y: x & y, col_exprs)
+        return (table.key == ParameterValue(key)) & reduce(
+            lambda x, y: x & y, col_exprs
+        )
     else:
-        return reduce(lambda x, y: x | y, col_exprs)
+        return reduce(
+            lambda x, y: x | y,
+            [(table.key == ParameterValue(key)) & e for e in col_exprs],
+        )
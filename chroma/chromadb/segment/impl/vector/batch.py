@@ -47,6 +47,10 @@ class Batch:
         """Check if a given ID is deleted"""
         return id in self._deleted_ids
 
+    def is_written(self, id: str) -> bool:
+        """Check if a given ID is written"""
+        return id in self._written_ids
+
     @property
     def delete_count(self) -> int:
         return len(self._deleted_ids)
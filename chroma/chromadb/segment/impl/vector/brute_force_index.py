@@ -1,11 +1,14 @@
-from typing import Any, Callable, Dict, List, Optional, Sequence, Set
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
 import numpy as np
 import numpy.typing as npt
+from chromadb.ingest import dequantize_int8, quantize_int8
 from chromadb.types import (
     EmbeddingRecord,
+    ScalarEncoding,
     VectorEmbeddingRecord,
     VectorQuery,
     VectorQueryResult,
+    Vector,
 )
 
 from chromadb.utils import distance_functions
@@ -13,10 +16,23 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+_dtypes = {
+    ScalarEncoding.FLOAT32: np.float32,
+    ScalarEncoding.FLOAT16: np.float16,
+    ScalarEncoding.INT8: np.int8,
+}
+
 
 class BruteForceIndex:
     """A lightweight, numpy based brute force index that is used for batches that have not been indexed into hnsw yet. It is not
     thread safe and callers should ensure that only one thread is accessing it at a time.
+
+    Queries are answered with a single matrix product against the occupied rows of the
+    index followed by a partial sort, so the cost of a query is proportional to the number
+    of live records rather than the capacity of the index.
+
+    Vectors are stored in the given encoding (FLOAT32, FLOAT16 or INT8) and decoded to
+    float32 to be searched.
     """
 
     id_to_index: Dict[str, int]
@@ -26,19 +42,31 @@ class BruteForceIndex:
     free_indices: List[int]
     size: int
     dimensionality: int
-    distance_fn: Callable[[npt.NDArray[Any], npt.NDArray[Any]], float]
+    space: str
+    encoding: ScalarEncoding
+    # Stored in the encoding of the index, see embeddings_at
     vectors: npt.NDArray[Any]
-
-    def __init__(self, size: int, dimensionality: int, space: str = "l2"):
-        if space == "l2":
-            self.distance_fn = distance_functions.l2
-        elif space == "ip":
-            self.distance_fn = distance_functions.ip
-        elif space == "cosine":
-            self.distance_fn = distance_functions.cosine
-        else:
+    # Scale of each row of vectors, for the INT8 encoding
+    scales: Optional[npt.NDArray[np.float32]]
+    # Squared L2 norm of each row of vectors, maintained on write so that queries
+    # don't need to recompute them
+    squared_norms: npt.NDArray[np.float32]
+    # Which rows of vectors hold a live record
+    occupied: npt.NDArray[np.bool_]
+
+    def __init__(
+        self,
+        size: int,
+        dimensionality: int,
+        space: str = "l2",
+        encoding: ScalarEncoding = ScalarEncoding.FLOAT32,
+    ):
+        if space not in distance_functions.distance_functions:
             raise Exception(f"Unknown distance function: {space}")
+        if encoding not in _dtypes:
+            raise ValueError(f"Unsupported encoding: {encoding.value}")
 
+        self.space = space
         self.id_to_index = {}
         self.index_to_id = {}
         self.id_to_seq_id = {}
@@ -46,7 +74,13 @@ class BruteForceIndex:
         self.free_indices = list(range(size))
         self.size = size
         self.dimensionality = dimensionality
-        self.vectors = np.zeros((size, dimensionality))
+        self.encoding = encoding
+        self.vectors = np.zeros((size, dimensionality), dtype=_dtypes[encoding])
+        self.scales = (
+            np.ones(size, dtype=np.float32) if encoding == ScalarEncoding.INT8 else None
+        )
+        self.squared_norms = np.zeros(size, dtype=np.float32)
+        self.occupied = np.zeros(size, dtype=np.bool_)
 
     def __len__(self) -> int:
         return len(self.id_to_index)
@@ -57,7 +91,7 @@ class BruteForceIndex:
         self.id_to_seq_id = {}
         self.deleted_ids.clear()
         self.free_indices = list(range(self.size))
-        self.vectors.fill(0)
+        self.occupied.fill(False)
 
     def upsert(self, records: List[EmbeddingRecord]) -> None:
         if len(records) + len(self) > self.size:
@@ -67,24 +101,36 @@ class BruteForceIndex:
                 )
             )
 
-        for i, record in enumerate(records):
+        indices = []
+        for record in records:
             id = record["id"]
-            vector = record["embedding"]
             self.id_to_seq_id[id] = record["seq_id"]
             if id in self.deleted_ids:
                 self.deleted_ids.remove(id)
 
-            # TODO: It may be faster to use multi-index selection on the vectors array
             if id in self.id_to_index:
                 # Update
                 index = self.id_to_index[id]
-                self.vectors[index] = vector
             else:
                 # Add
-                next_index = self.free_indices.pop()
-                self.id_to_index[id] = next_index
-                self.index_to_id[next_index] = id
-                self.vectors[next_index] = vector
+                index = self.free_indices.pop()
+                self.id_to_index[id] = index
+                self.index_to_id[index] = id
+            indices.append(index)
+
+        if len(indices) == 0:
+            return
+
+        rows = np.array(indices)
+        vectors = np.asarray([record["embedding"] for record in records], np.float32)
+        if self.scales is not None:
+            self.vectors[rows], self.scales[rows] = quantize_int8(vectors)
+        else:
+            self.vectors[rows] = vectors
+        self.squared_norms[rows] = distance_functions.squared_norms(
+            self.embeddings_at(rows)
+        )
+        self.occupied[rows] = True
 
     def delete(self, records: List[EmbeddingRecord]) -> None:
         for record in records:
@@ -95,7 +141,7 @@ class BruteForceIndex:
                 del self.id_to_index[id]
                 del self.index_to_id[index]
                 del self.id_to_seq_id[id]
-                self.vectors[index].fill(np.NaN)
+                self.occupied[index] = False
                 self.free_indices.append(index)
             else:
                 logger.warning(f"Delete of nonexisting embedding ID: {id}")
@@ -112,42 +158,93 @@ class BruteForceIndex:
         return [
             VectorEmbeddingRecord(
                 id=id,
-                embedding=self.vectors[self.id_to_index[id]].tolist(),
+                embedding=self.embeddings_at(self.id_to_index[id]).tolist(),
                 seq_id=self.id_to_seq_id[id],
             )
             for id in target_ids
         ]
 
-    def query(self, query: VectorQuery) -> Sequence[Sequence[VectorQueryResult]]:
-        np_query = np.array(query["vectors"])
-        allowed_ids = (
-            None if query["allowed_ids"] is None else set(query["allowed_ids"])
+    def get_embeddings(self, ids: Sequence[str]) -> npt.NDArray[np.float32]:
+        """Return a 2-D array holding a copy of the vector of each of the given IDs, in
+        order. All IDs must be present in the index."""
+        rows = [self.id_to_index[id] for id in ids]
+        return self.embeddings_at(rows)
+
+    def embeddings_at(self, rows: npt.ArrayLike) -> npt.NDArray[np.float32]:
+        """Return the float32 vectors of the given row or rows"""
+        rows = np.asarray(rows)
+        if self.scales is not None:
+            flat = rows.ravel()
+            vectors = dequantize_int8(self.vectors[flat], self.scales[flat])
+            return vectors.reshape(rows.shape + (self.dimensionality,))
+        return self.vectors[rows].astype(np.float32, copy=False)
+
+    def _allowed_mask(self, allowed_ids: Sequence[str]) -> npt.NDArray[np.bool_]:
+        """Return a mask over the rows of the index selecting the given IDs"""
+        mask = np.zeros(self.size, dtype=np.bool_)
+        rows = [self.id_to_index[id] for id in allowed_ids if id in self.id_to_index]
+        mask[rows] = True
+        return mask
+
+    def search(
+        self,
+        vectors: Sequence[Vector],
+        k: int,
+        allowed_ids: Optional[Sequence[str]] = None,
+    ) -> Tuple[npt.NDArray[np.intp], npt.NDArray[np.float32]]:
+        """Return the rows and distances of the k nearest live records to each query
+        vector, as two (n_queries, k') arrays sorted nearest first. k' is k, or fewer if
+        the index holds fewer (allowed) records."""
+        np_query = np.asarray(vectors, dtype=np.float32).reshape(
+            -1, self.dimensionality
         )
-        distances = np.apply_along_axis(
-            lambda query: np.apply_along_axis(self.distance_fn, 1, self.vectors, query),
-            1,
-            np_query,
+
+        mask = self.occupied
+        if allowed_ids is not None:
+            mask = mask & self._allowed_mask(allowed_ids)
+        rows = np.flatnonzero(mask)
+
+        k = min(k, len(rows))
+        if k <= 0:
+            return (
+                np.empty((len(np_query), 0), dtype=np.intp),
+                np.empty((len(np_query), 0), dtype=np.float32),
+            )
+
+        if len(rows) == self.size and self.encoding == ScalarEncoding.FLOAT32:
+            index_vectors, squared_norms = self.vectors, self.squared_norms
+        else:
+            index_vectors = self.embeddings_at(rows)
+            squared_norms = self.squared_norms[rows]
+        top, top_distances = distance_functions.nearest(
+            self.space, np_query, index_vectors, squared_norms, k
         )
+        return rows[top], top_distances
 
-        indices = np.argsort(distances).tolist()
-        # Filter out deleted labels
-        filtered_results = []
-        for i, index_list in enumerate(indices):
+    def ids_for(self, rows: npt.ArrayLike) -> List[str]:
+        """Return the IDs of an array of live rows. The rows are flattened."""
+        return [self.index_to_id[row] for row in np.asarray(rows).ravel().tolist()]
+
+    def query(self, query: VectorQuery) -> Sequence[Sequence[VectorQueryResult]]:
+        rows, distances = self.search(
+            query["vectors"], query["k"], query["allowed_ids"]
+        )
+        result_distances = distances.tolist()
+
+        results: List[List[VectorQueryResult]] = []
+        for row_list, distance_list in zip(rows.tolist(), result_distances):
             curr_results = []
-            for j in index_list:
-                # If the index is in the index_to_id map, then it has been added
-                if j in self.index_to_id:
-                    id = self.index_to_id[j]
-                    if id not in self.deleted_ids and (
-                        allowed_ids is None or id in allowed_ids
-                    ):
-                        curr_results.append(
-                            VectorQueryResult(
-                                id=id,
-                                distance=distances[i][j].item(),
-                                seq_id=self.id_to_seq_id[id],
-                                embedding=self.vectors[j].tolist(),
-                            )
-                        )
-            filtered_results.append(curr_results)
-        return filtered_results
+            for row, distance in zip(row_list, distance_list):
+                id = self.index_to_id[row]
+                curr_results.append(
+                    VectorQueryResult(
+                        id=id,
+                        distance=distance,
+                        seq_id=self.id_to_seq_id[id],
+                        embedding=self.embeddings_at(row).tolist()
+                        if query["include_embeddings"]
+                        else None,
+                    )
+                )
+            results.append(curr_results)
+        return results
@@ -2,7 +2,7 @@ import multiprocessing
 import re
 from typing import Any, Callable, Dict, Union
 
-from chromadb.types import Metadata
+from chromadb.types import Metadata, ScalarEncoding
 
 
 Validator = Callable[[Union[str, int, float]], bool]
@@ -14,6 +14,9 @@ param_validators: Dict[str, Validator] = {
     "hnsw:M": lambda p: isinstance(p, int),
     "hnsw:num_threads": lambda p: isinstance(p, int),
     "hnsw:resize_factor": lambda p: isinstance(p, (int, float)),
+    "hnsw:exact_search_ratio": lambda p: isinstance(p, (int, float)) and 0 <= p <= 1,
+    "hnsw:compaction_threshold": lambda p: isinstance(p, (int, float)) and 0 < p <= 1,
+    "hnsw:encoding": lambda p: p in ("FLOAT32", "FLOAT16", "INT8"),
 }
 
 # Extra params used for persistent hnsw
@@ -50,6 +53,15 @@ class HnswParams(Params):
     M: int
     num_threads: int
     resize_factor: float
+    # Filtered queries whose allowed set is at most this fraction of the index are
+    # answered by exact search over the allowed vectors instead of by HNSW
+    exact_search_ratio: float
+    # The index is compacted in the background once more than this fraction of its
+    # elements are deleted. 1 disables background compaction.
+    compaction_threshold: float
+    # How vectors are stored in the embeddings queue and the brute force layer. They
+    # are always indexed by HNSW as float32.
+    encoding: ScalarEncoding
 
     def __init__(self, metadata: Metadata):
         metadata = metadata or {}
@@ -61,6 +73,11 @@ class HnswParams(Params):
             metadata.get("hnsw:num_threads", multiprocessing.cpu_count())
         )
         self.resize_factor = float(metadata.get("hnsw:resize_factor", 1.2))
+        self.exact_search_ratio = float(metadata.get("hnsw:exact_search_ratio", 0.1))
+        self.compaction_threshold = float(
+            metadata.get("hnsw:compaction_threshold", 0.5)
+        )
+        self.encoding = ScalarEncoding(metadata.get("hnsw:encoding", "FLOAT32"))
 
     @staticmethod
     def extract(metadata: Metadata) -> Metadata:
@@ -0,0 +1,397 @@
+from typing import Generator, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+import numpy.typing as npt
+from chromadb.types import SeqId
+
+# Sentinel values for slots of the hash table
+_EMPTY = -1
+_TOMBSTONE = -2
+# Rebuild the hash table once this fraction of its slots is in use (including
+# tombstones), with enough slots for the live IDs to use at most half of them
+_MAX_LOAD_FACTOR = 0.6
+_REBUILT_LOAD_FACTOR = 0.5
+_INITIAL_CAPACITY = 1024
+# Number of consecutive slots looked at in each round of probing a batch of IDs
+_PROBE_WINDOW = 8
+
+
+class IdLabelMap:
+    """A compact bidirectional mapping between embedding IDs and HNSW labels, with the
+    SeqID of each embedding.
+
+    IDs are stored UTF-8 encoded in a single contiguous bytearray (the arena), and
+    everything else lives in numpy arrays: per-label arena offsets, lengths, hashes and
+    SeqIDs, plus an open addressing hash table of labels used to look up IDs. No
+    Python object is kept per ID, so this takes about a fifth of the memory of three
+    dicts and the ID strings they keep alive (see bin/benchmarks/id_label_map.py),
+    and mapping a whole matrix of labels returned by hnswlib back to IDs and SeqIDs
+    is a gather over the label arrays.
+
+    Lookups are slower than with dicts, about 0.7us per ID one at a time and half
+    that when probing, inserting or deleting a batch of IDs with the *_many
+    methods, which is what the write path uses. Both are small next to adding the
+    vectors to hnswlib.
+
+    SeqIDs are stored as 64-bit integers. This is not thread safe, callers must
+    synchronize access.
+    """
+
+    _arena: bytearray
+    # Bytes of the arena belonging to IDs that have since been removed
+    _garbage_bytes: int
+
+    # Indexed by label. A negative length marks a label that is not in use.
+    _offsets: npt.NDArray[np.int64]
+    _lengths: npt.NDArray[np.int32]
+    _hashes: npt.NDArray[np.int64]
+    _seq_ids: npt.NDArray[np.int64]
+
+    # Open addressing hash table (linear probing) of labels, keyed by the hash of
+    # their ID
+    _table: npt.NDArray[np.int64]
+    _count: int
+    _tombstones: int
+
+    def __init__(self) -> None:
+        self._arena = bytearray()
+        self._garbage_bytes = 0
+        self._offsets = np.zeros(_INITIAL_CAPACITY, dtype=np.int64)
+        self._lengths = np.full(_INITIAL_CAPACITY, -1, dtype=np.int32)
+        self._hashes = np.zeros(_INITIAL_CAPACITY, dtype=np.int64)
+        self._seq_ids = np.zeros(_INITIAL_CAPACITY, dtype=np.int64)
+        self._table = np.full(_INITIAL_CAPACITY, _EMPTY, dtype=np.int64)
+        self._count = 0
+        self._tombstones = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, id: str) -> bool:
+        return self._find(id) >= 0
+
+    def get_label(self, id: str) -> Optional[int]:
+        """Return the label of the given ID, or None if it is not in the map"""
+        slot = self._find(id)
+        if slot < 0:
+            return None
+        return int(self._table[slot])
+
+    def get_labels(self, ids: Sequence[str]) -> npt.NDArray[np.int64]:
+        """Return the labels of the given IDs, with -1 for IDs not in the map"""
+        return self._find_many(ids)[1]
+
+    def get_id(self, label: int) -> str:
+        """Return the ID with the given label"""
+        length = int(self._lengths[label])
+        if length < 0:
+            raise KeyError(label)
+        offset = int(self._offsets[label])
+        return self._arena[offset : offset + length].decode("utf-8")
+
+    def get_seq_id(self, id: str) -> SeqId:
+        """Return the SeqID of the given ID"""
+        label = self.get_label(id)
+        if label is None:
+            raise KeyError(id)
+        return int(self._seq_ids[label])
+
+    def put(self, id: str, label: int, seq_id: SeqId) -> None:
+        """Set the label and SeqID of an ID. If the ID already had a different label,
+        the previous label is released."""
+        self.put_many([id], [label], [seq_id])
+
+    def put_many(
+        self, ids: Sequence[str], labels: Sequence[int], seq_ids: Sequence[SeqId]
+    ) -> None:
+        """Set the labels and SeqIDs of distinct IDs, as put() does for each"""
+        if len(ids) == 0:
+            return
+        label_array = np.asarray(labels, dtype=np.int64)
+        max_label = int(label_array.max())
+        if max_label >= len(self._offsets):
+            self._grow(max_label)
+
+        hashes, encoded, starts, lengths = _encode(ids)
+        slots, previous = self._find_many(ids, hashes, encoded, starts, lengths)
+
+        moved = (previous >= 0) & (previous != label_array)
+        if moved.any():
+            moved_from, moved_to = previous[moved], label_array[moved]
+            self._offsets[moved_to] = self._offsets[moved_from]
+            self._lengths[moved_to] = self._lengths[moved_from]
+            self._hashes[moved_to] = self._hashes[moved_from]
+            self._lengths[np.setdiff1d(moved_from, label_array)] = -1
+            self._table[slots[moved]] = moved_to
+
+        added = np.flatnonzero(previous < 0)
+        if len(added) > 0:
+            if len(added) < len(ids):
+                encoded = b"".join(
+                    encoded[start : start + length]
+                    for start, length in zip(
+                        starts[added].tolist(), lengths[added].tolist()
+                    )
+                )
+                lengths = lengths[added]
+                starts = np.cumsum(lengths) - lengths
+            table_load = self._count + self._tombstones + len(added)
+            # New IDs take the empty slot their lookup ended at, or the next free
+            # one if several of them ended at the same slot
+            probes = slots[added]
+            if table_load > _MAX_LOAD_FACTOR * len(self._table):
+                self._rebuild_table(self._count + len(added))
+                probes = hashes[added] & (len(self._table) - 1)
+            added_labels = label_array[added]
+            self._offsets[added_labels] = len(self._arena) + starts
+            self._lengths[added_labels] = lengths
+            self._hashes[added_labels] = hashes[added]
+            self._arena += encoded
+            self._insert_many(added_labels, probes)
+            self._count += len(added)
+
+        self._seq_ids[label_array] = seq_ids
+
+    def delete(self, id: str) -> Optional[int]:
+        """Remove an ID from the map, returning the label it had (if any)"""
+        labels = self.delete_many([id])
+        return labels[0] if len(labels) > 0 else None
+
+    def delete_many(self, ids: Iterable[str]) -> List[int]:
+        """Remove IDs from the map, returning the labels of those that were in it"""
+        distinct = list(dict.fromkeys(ids))
+        if len(distinct) == 0:
+            return []
+        slots, labels = self._find_many(distinct)
+        found = labels >= 0
+        slots, labels = slots[found], labels[found]
+        if len(labels) == 0:
+            return []
+        self._table[slots] = _TOMBSTONE
+        self._garbage_bytes += int(self._lengths[labels].sum())
+        self._lengths[labels] = -1
+        self._count -= len(labels)
+        self._tombstones += len(labels)
+        if self._garbage_bytes > max(len(self._arena) // 2, 1 << 20):
+            self._compact_arena()
+        return labels.tolist()  # type: ignore[no-any-return]
+
+    def labels(self) -> npt.NDArray[np.int64]:
+        """Return all labels in use, in ascending order"""
+        return np.flatnonzero(self._lengths >= 0)
+
+    def ids(self) -> List[str]:
+        """Return all IDs in the map, in label order"""
+        return self.ids_for(self.labels())
+
+    def items(self) -> Generator[Tuple[str, int, SeqId], None, None]:
+        """Yield (id, label, seq_id) for every entry in the map, in label order"""
+        labels = self.labels()
+        for id, label, seq_id in zip(
+            self.ids_for(labels), labels.tolist(), self._seq_ids[labels].tolist()
+        ):
+            yield id, label, seq_id
+
+    def ids_for(self, labels: npt.ArrayLike) -> List[str]:
+        """Return the IDs for an array of labels, all of which must be in use. The
+        labels are flattened."""
+        labels = np.asarray(labels, dtype=np.int64).ravel()
+        offsets = self._offsets[labels].tolist()
+        ends = (self._offsets[labels] + self._lengths[labels]).tolist()
+        arena = self._arena
+        return [arena[start:end].decode("utf-8") for start, end in zip(offsets, ends)]
+
+    def seq_ids_for(self, labels: npt.ArrayLike) -> npt.NDArray[np.int64]:
+        """Return the SeqIDs for an array of labels, with the same shape"""
+        return self._seq_ids[np.asarray(labels, dtype=np.int64)]
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by this map, in bytes"""
+        return (
+            len(self._arena)
+            + self._offsets.nbytes
+            + self._lengths.nbytes
+            + self._hashes.nbytes
+            + self._seq_ids.nbytes
+            + self._table.nbytes
+        )
+
+    def _find(self, id: str) -> int:
+        """Return the hash table slot holding the given ID, or -1"""
+        h = hash(id)
+        encoded = id.encode("utf-8")
+        table = self._table
+        mask = len(table) - 1
+        slot = h & mask
+        while True:
+            # item() returns a Python int without creating a numpy scalar
+            label = table.item(slot)
+            if label == _EMPTY:
+                return -1
+            if (
+                label != _TOMBSTONE
+                and self._hashes.item(label) == h
+                and self._lengths.item(label) == len(encoded)
+            ):
+                offset = self._offsets.item(label)
+                if self._arena[offset : offset + len(encoded)] == encoded:
+                    return slot
+            slot = (slot + 1) & mask
+
+    def _find_many(
+        self,
+        ids: Sequence[str],
+        hashes: Optional[npt.NDArray[np.int64]] = None,
+        encoded: Optional[bytes] = None,
+        starts: Optional[npt.NDArray[np.int64]] = None,
+        lengths: Optional[npt.NDArray[np.int64]] = None,
+    ) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+        """Return the hash table slots and labels of the given IDs. IDs that are not
+        in the map get label -1, and the empty slot their probing ended at.
+
+        All IDs are probed at once, _PROBE_WINDOW slots further per round, until a
+        label with the same hash or an empty slot is reached. The bytes of the
+        candidates are then compared all at once, and the rare IDs whose candidate
+        turns out to be a hash collision are probed again one by one."""
+        if hashes is None or encoded is None or starts is None or lengths is None:
+            hashes, encoded, starts, lengths = _encode(ids)
+        n = len(ids)
+        found_slots = np.empty(n, dtype=np.int64)
+        found_labels = np.full(n, -1, dtype=np.int64)
+        table = self._table
+        mask = len(table) - 1
+        pending = np.arange(n)
+        probes = hashes & mask
+        window = np.arange(_PROBE_WINDOW)
+        while len(pending) > 0:
+            slots = (probes[:, np.newaxis] + window) & mask
+            labels = table[slots]
+            # Sentinels index the last slots of _hashes, and are masked out
+            matched = (labels >= 0) & (
+                self._hashes[labels] == hashes[pending, np.newaxis]
+            )
+            stops = matched | (labels == _EMPTY)
+            # The first slot of its window where the probing of each ID stops
+            first = stops.argmax(axis=1)
+            rows = np.flatnonzero(stops[np.arange(len(pending)), first])
+            found_slots[pending[rows]] = slots[rows, first[rows]]
+            found = rows[matched[rows, first[rows]]]
+            found_labels[pending[found]] = labels[found, first[found]]
+            done = np.zeros(len(pending), dtype=np.bool_)
+            done[rows] = True
+            pending = pending[~done]
+            probes = (probes[~done] + _PROBE_WINDOW) & mask
+
+        candidates = np.flatnonzero(found_labels >= 0)
+        if len(candidates) > 0:
+            labels = found_labels[candidates]
+            same_length = self._lengths[labels] == lengths[candidates]
+            equal = np.zeros(len(candidates), dtype=np.bool_)
+            equal[same_length] = self._equal_ids(
+                labels[same_length],
+                encoded,
+                starts[candidates[same_length]],
+                lengths[candidates[same_length]],
+            )
+            for i in candidates[~equal].tolist():
+                slot = self._find(ids[i])
+                if slot < 0:
+                    found_slots[i] = hashes[i] & mask
+                    found_labels[i] = -1
+                else:
+                    found_slots[i] = slot
+                    found_labels[i] = table[slot]
+        return found_slots, found_labels
+
+    def _equal_ids(
+        self,
+        labels: npt.NDArray[np.int64],
+        encoded: bytes,
+        starts: npt.NDArray[np.int64],
+        lengths: npt.NDArray[np.int64],
+    ) -> npt.NDArray[np.bool_]:
+        """Return whether the IDs of the given labels equal the IDs encoded at starts
+        in encoded, comparing every byte at once. The lengths must already match."""
+        total = int(lengths.sum())
+        if total == 0:
+            return np.ones(len(labels), dtype=np.bool_)
+        group_starts = np.cumsum(lengths) - lengths
+        within = np.arange(total) - np.repeat(group_starts, lengths)
+        arena = np.frombuffer(self._arena, dtype=np.uint8)
+        stored = arena[np.repeat(self._offsets[labels], lengths) + within]
+        del arena  # Releases the arena buffer so that it can be resized
+        given = np.frombuffer(encoded, dtype=np.uint8)[
+            np.repeat(starts, lengths) + within
+        ]
+        groups = np.repeat(np.arange(len(labels)), lengths)
+        mismatches = np.bincount(groups, weights=stored != given, minlength=len(labels))
+        return mismatches == 0
+
+    def _insert_many(
+        self, labels: npt.NDArray[np.int64], probes: npt.NDArray[np.int64]
+    ) -> None:
+        """Add labels of IDs that are not in the hash table yet, probing from the
+        given slots on. Each round, the first of the labels probing each free slot
+        takes it and the others probe the next one."""
+        table = self._table
+        mask = len(table) - 1
+        pending = np.arange(len(labels))
+        while len(pending) > 0:
+            free = np.flatnonzero(table[probes] < 0)
+            slots, first = np.unique(probes[free], return_index=True)
+            winners = free[first]
+            self._tombstones -= int(np.count_nonzero(table[slots] == _TOMBSTONE))
+            table[slots] = labels[pending[winners]]
+            placed = np.zeros(len(pending), dtype=np.bool_)
+            placed[winners] = True
+            pending = pending[~placed]
+            probes = (probes[~placed] + 1) & mask
+
+    def _grow(self, label: int) -> None:
+        """Grow the label arrays to hold at least the given label"""
+        capacity = len(self._offsets)
+        new_capacity = max(label + 1, 2 * capacity)
+        extra = new_capacity - capacity
+        self._offsets = np.concatenate([self._offsets, np.zeros(extra, np.int64)])
+        self._lengths = np.concatenate([self._lengths, np.full(extra, -1, np.int32)])
+        self._hashes = np.concatenate([self._hashes, np.zeros(extra, np.int64)])
+        self._seq_ids = np.concatenate([self._seq_ids, np.zeros(extra, np.int64)])
+
+    def _rebuild_table(self, min_count: int) -> None:
+        """Rebuild the hash table with room for at least the given number of IDs,
+        dropping tombstones"""
+        capacity = _INITIAL_CAPACITY
+        while capacity * _REBUILT_LOAD_FACTOR < min_count:
+            capacity *= 2
+        self._table = np.full(capacity, _EMPTY, dtype=np.int64)
+        self._tombstones = 0
+        labels = self.labels()
+        self._insert_many(labels, self._hashes[labels] & (capacity - 1))
+
+    def _compact_arena(self) -> None:
+        """Rewrite the arena without the bytes of removed IDs"""
+        labels = self.labels()
+        lengths = self._lengths[labels].astype(np.int64)
+        starts = np.cumsum(lengths) - lengths
+        within = np.arange(int(lengths.sum())) - np.repeat(starts, lengths)
+        arena = np.frombuffer(self._arena, dtype=np.uint8)
+        compacted = arena[np.repeat(self._offsets[labels], lengths) + within]
+        del arena
+        self._offsets[labels] = starts
+        self._arena = bytearray(compacted.tobytes())
+        self._garbage_bytes = 0
+
+
+def _encode(
+    ids: Sequence[str],
+) -> Tuple[npt.NDArray[np.int64], bytes, npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+    """Return the hashes of the given IDs, their concatenated UTF-8 encodings, and the
+    start and length in bytes of each one"""
+    n = len(ids)
+    hashes = np.fromiter(map(hash, ids), np.int64, n)
+    encoded = "".join(ids).encode("utf-8")
+    lengths = np.fromiter(map(len, ids), np.int64, n)
+    if len(encoded) != int(lengths.sum()):
+        # Not all ASCII, the lengths in bytes differ from those in characters
+        lengths = np.fromiter((len(id.encode("utf-8")) for id in ids), np.int64, n)
+    return hashes, encoded, np.cumsum(lengths) - lengths, lengths
@@ -0,0 +1,102 @@
+import os
+import pickle
+from typing import Generator, Iterable, List, Sequence, Tuple
+from chromadb.types import SeqId
+import logging
+
+logger = logging.getLogger(__name__)
+
+# (id, label, seq_id)
+IdMapEntry = Tuple[str, int, SeqId]
+# Entries written and IDs deleted by a single sync
+IdMapDelta = Tuple[List[IdMapEntry], List[str]]
+
+# Maximum number of entries per frame when writing a compacted log, which bounds the
+# memory needed to decode a single frame while loading
+COMPACTION_FRAME_SIZE = 100_000
+
+
+class IdMapLog:
+    """An append-only, log-structured file storing the id <-> label mappings of a
+    persistent HNSW segment.
+
+    Each sync appends a frame holding only the entries that changed since the previous
+    sync, so the cost of a sync is proportional to the size of the change rather than to
+    the size of the collection. The log is loaded by streaming frames in order and
+    replaying them. When the log holds many more entries than there are live IDs it is
+    compacted by rewriting it as a snapshot of the live entries.
+    """
+
+    _filename: str
+    # Number of entries (writes and deletes) currently stored in the log file
+    _entry_count: int
+    _compaction_factor: float
+
+    def __init__(self, filename: str, compaction_factor: float = 2.0):
+        self._filename = filename
+        self._entry_count = 0
+        self._compaction_factor = compaction_factor
+
+    def exists(self) -> bool:
+        return os.path.exists(self._filename)
+
+    def load(self) -> Generator[IdMapDelta, None, None]:
+        """Stream the deltas stored in the log, in the order they were written. A frame
+        that was only partially written (e.g, because the process died mid-sync) is
+        discarded and truncated from the file."""
+        self._entry_count = 0
+        if not self.exists():
+            return
+
+        size = os.path.getsize(self._filename)
+        with open(self._filename, "rb") as f:
+            while True:
+                offset = f.tell()
+                if offset == size:
+                    return
+                try:
+                    written, deleted = pickle.load(f)
+                except Exception:
+                    logger.warning(
+                        f"Discarding incomplete frame at offset {offset} of {self._filename}"
+                    )
+                    break
+                self._entry_count += len(written) + len(deleted)
+                yield written, deleted
+
+        with open(self._filename, "r+b") as f:
+            f.truncate(offset)
+
+    def append(self, written: Sequence[IdMapEntry], deleted: Sequence[str]) -> None:
+        """Append a delta to the log"""
+        if len(written) == 0 and len(deleted) == 0:
+            return
+        with open(self._filename, "ab") as f:
+            pickle.dump((list(written), list(deleted)), f, pickle.HIGHEST_PROTOCOL)
+        self._entry_count += len(written) + len(deleted)
+
+    def should_compact(self, live_count: int, pending_count: int = 0) -> bool:
+        """Whether the log, plus pending_count entries about to be appended, holds
+        enough superseded entries to be worth rewriting"""
+        entry_count = self._entry_count + pending_count
+        return entry_count > self._compaction_factor * max(live_count, 1)
+
+    def compact(self, entries: Iterable[IdMapEntry]) -> None:
+        """Atomically replace the log with a snapshot of the given live entries"""
+        tmp_filename = self._filename + ".tmp"
+        count = 0
+        with open(tmp_filename, "wb") as f:
+            frame: List[IdMapEntry] = []
+            for entry in entries:
+                frame.append(entry)
+                if len(frame) >= COMPACTION_FRAME_SIZE:
+                    pickle.dump((frame, []), f, pickle.HIGHEST_PROTOCOL)
+                    count += len(frame)
+                    frame = []
+            if frame:
+                pickle.dump((frame, []), f, pickle.HIGHEST_PROTOCOL)
+                count += len(frame)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self._filename)
+        self._entry_count = count
@@ -1,11 +1,14 @@
 from overrides import override
-from typing import Optional, Sequence, Dict, Set, List, cast
+from typing import Dict, Optional, Sequence, List, Set, Tuple, cast
+from typing import Counter as TypingCounter
+from collections import Counter
 from uuid import UUID
 from chromadb.segment import VectorReader
 from chromadb.ingest import Consumer
 from chromadb.config import System, Settings
 from chromadb.segment.impl.vector.batch import Batch
 from chromadb.segment.impl.vector.hnsw_params import HnswParams
+from chromadb.segment.impl.vector.id_label_map import IdLabelMap
 from chromadb.types import (
     EmbeddingRecord,
     VectorEmbeddingRecord,
@@ -18,7 +21,11 @@ from chromadb.types import (
     Vector,
 )
 from chromadb.errors import InvalidDimensionException
+from chromadb.utils import distance_functions
 import hnswlib
+import threading
+import numpy as np
+import numpy.typing as npt
 from chromadb.utils.read_write_lock import ReadWriteLock, ReadRWLock, WriteRWLock
 import logging
 
@@ -42,9 +49,18 @@ class LocalHnswSegment(VectorReader):
 
     _lock: ReadWriteLock
 
-    _id_to_label: Dict[str, int]
-    _label_to_id: Dict[int, str]
-    _id_to_seq_id: Dict[str, SeqId]
+    _id_map: IdLabelMap
+
+    # Held for the duration of a compaction, so only one runs at a time
+    _compaction_lock: threading.Lock
+    _compaction_thread: Optional[threading.Thread]
+    # IDs written or deleted while a compaction is running. These are caught up on
+    # the compacted index before it replaces the current one.
+    _compaction_dirty_ids: Optional[Set[str]]
+
+    # Number of query vectors answered by each search path, see _search
+    _search_paths: TypingCounter[str]
+    _search_paths_lock: threading.Lock
 
     def __init__(self, system: System, segment: Segment):
         self._consumer = system.instance(Consumer)
@@ -58,11 +74,14 @@ class LocalHnswSegment(VectorReader):
         self._total_elements_added = 0
         self._max_seq_id = self._consumer.min_seqid()
 
-        self._id_to_seq_id = {}
-        self._id_to_label = {}
-        self._label_to_id = {}
+        self._id_map = IdLabelMap()
 
         self._lock = ReadWriteLock()
+        self._compaction_lock = threading.Lock()
+        self._compaction_thread = None
+        self._compaction_dirty_ids = None
+        self._search_paths = Counter()
+        self._search_paths_lock = threading.Lock()
         super().__init__(system, segment)
 
     @staticmethod
@@ -84,119 +103,199 @@ class LocalHnswSegment(VectorReader):
     @override
     def stop(self) -> None:
         super().stop()
+        logger.debug(
+            f"Search paths of segment {self._id}: {self.search_path_metrics()}"
+        )
         if self._subscription:
             self._consumer.unsubscribe(self._subscription)
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
 
     @override
     def get_vectors(
         self, ids: Optional[Sequence[str]] = None
     ) -> Sequence[VectorEmbeddingRecord]:
-        if ids is None:
-            labels = list(self._label_to_id.keys())
-        else:
-            labels = []
-            for id in ids:
-                if id in self._id_to_label:
-                    labels.append(self._id_to_label[id])
-
-        results = []
-        if self._index is not None:
-            vectors = cast(Sequence[Vector], self._index.get_items(labels))
-
-            for label, vector in zip(labels, vectors):
-                id = self._label_to_id[label]
-                seq_id = self._id_to_seq_id[id]
-                results.append(
-                    VectorEmbeddingRecord(id=id, seq_id=seq_id, embedding=vector)
-                )
+        with ReadRWLock(self._lock):
+            if ids is None:
+                labels = self._id_map.labels().tolist()
+            else:
+                found = self._id_map.get_labels(ids)
+                labels = found[found >= 0].tolist()
+
+            results = []
+            if self._index is not None:
+                vectors = cast(Sequence[Vector], self._index.get_items(labels))
+                result_ids = self._id_map.ids_for(labels)
+                seq_ids = self._id_map.seq_ids_for(labels).tolist()
+
+                for id, seq_id, vector in zip(result_ids, seq_ids, vectors):
+                    results.append(
+                        VectorEmbeddingRecord(id=id, seq_id=seq_id, embedding=vector)
+                    )
 
-        return results
+            return results
 
     @override
     def query_vectors(
         self, query: VectorQuery
     ) -> Sequence[Sequence[VectorQueryResult]]:
-        if self._index is None:
-            return [[] for _ in range(len(query["vectors"]))]
-
-        k = query["k"]
-        size = len(self._id_to_label)
+        # Compactions swap the index and the id map under the write lock, so labels
+        # must be resolved under the same read lock as the search
+        with ReadRWLock(self._lock):
+            if self._index is None:
+                return [[] for _ in range(len(query["vectors"]))]
 
-        if k > size:
-            logger.warning(
-                f"Number of requested results {k} is greater than number of elements in index {size}, updating n_results = {size}"
-            )
-            k = size
+            k = query["k"]
+            size = len(self._id_map)
 
-        labels: Set[int] = set()
-        ids = query["allowed_ids"]
-        if ids is not None:
-            labels = {self._id_to_label[id] for id in ids if id in self._id_to_label}
-            if len(labels) < k:
-                k = len(labels)
+            if k > size:
+                logger.warning(
+                    f"Number of requested results {k} is greater than number of elements in index {size}, updating n_results = {size}"
+                )
+                k = size
 
-        def filter_function(label: int) -> bool:
-            return label in labels
+            allowed_labels: Optional[npt.NDArray[np.int64]] = None
+            if query["allowed_ids"] is not None:
+                allowed_labels = self._get_labels(query["allowed_ids"])
+                k = min(k, len(allowed_labels))
 
-        query_vectors = query["vectors"]
+            result_labels, distances = self._search(query["vectors"], k, allowed_labels)
 
-        with ReadRWLock(self._lock):
-            result_labels, distances = self._index.knn_query(
-                query_vectors, k=k, filter=filter_function if ids else None
-            )
-
-            # TODO: these casts are not correct, hnswlib returns np
-            # distances = cast(List[List[float]], distances)
-            # result_labels = cast(List[List[int]], result_labels)
+            # Translate the whole result matrix at once
+            n_results = result_labels.shape[1]
+            result_ids = self._id_map.ids_for(result_labels)
+            result_seq_ids = self._id_map.seq_ids_for(result_labels).tolist()
+            result_distances = distances.tolist()
+            if query["include_embeddings"]:
+                embeddings = self._get_embeddings(result_labels)
 
             all_results: List[List[VectorQueryResult]] = []
             for result_i in range(len(result_labels)):
                 results: List[VectorQueryResult] = []
-                for label, distance in zip(
-                    result_labels[result_i], distances[result_i]
-                ):
-                    id = self._label_to_id[label]
-                    seq_id = self._id_to_seq_id[id]
-                    if query["include_embeddings"]:
-                        embedding = self._index.get_items([label])[0]
-                    else:
-                        embedding = None
+                for j in range(n_results):
                     results.append(
                         VectorQueryResult(
-                            id=id,
-                            seq_id=seq_id,
-                            distance=distance.item(),
-                            embedding=embedding,
+                            id=result_ids[result_i * n_results + j],
+                            seq_id=result_seq_ids[result_i][j],
+                            distance=result_distances[result_i][j],
+                            embedding=embeddings[result_i * n_results + j]
+                            if query["include_embeddings"]
+                            else None,
                         )
                     )
                 all_results.append(results)
 
             return all_results
 
+    def _search(
+        self,
+        query_vectors: Sequence[Vector],
+        k: int,
+        allowed_labels: Optional[npt.NDArray[np.int64]] = None,
+    ) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.float32]]:
+        """Return the labels and distances of the k nearest neighbors of each query
+        vector among the allowed labels (or all labels, if None), in the form of
+        hnswlib's knn_query. k must not exceed the number of candidates. Filtered
+        queries over a small enough fraction of the index are answered exactly. The
+        caller must hold the lock."""
+        index = cast(hnswlib.Index, self._index)
+        if allowed_labels is None:
+            search_path = "hnsw"
+            labels, distances = index.knn_query(query_vectors, k=k)
+        elif len(allowed_labels) <= self._params.exact_search_ratio * len(self._id_map):
+            search_path = "exact"
+            labels, distances = self._exact_query(query_vectors, allowed_labels, k)
+        else:
+            search_path = "hnsw_filtered"
+            # hnswlib calls the filter for every node it visits, so keep it to a
+            # single byte lookup
+            bitset = bytearray(self._total_elements_added + 1)
+            np.frombuffer(bitset, dtype=np.uint8)[allowed_labels] = 1
+            labels, distances = index.knn_query(
+                query_vectors, k=k, filter=lambda label: bitset[label] == 1
+            )
+
+        # Queries run concurrently under the read lock
+        with self._search_paths_lock:
+            self._search_paths[search_path] += len(query_vectors)
+        return labels, distances
+
+    def search_path_metrics(self) -> Dict[str, int]:
+        """Return the number of query vectors answered by each search path: "hnsw"
+        for unfiltered queries, "hnsw_filtered" for filtered HNSW searches and
+        "exact" for filtered queries scored exactly"""
+        with self._search_paths_lock:
+            return {
+                path: self._search_paths[path]
+                for path in ("hnsw", "hnsw_filtered", "exact")
+            }
+
+    def _get_labels(self, ids: Sequence[str]) -> npt.NDArray[np.int64]:
+        """Return the sorted, distinct labels of the given IDs, skipping IDs that are
+        not in the index"""
+        labels = self._id_map.get_labels(ids)
+        return np.unique(labels[labels >= 0])
+
+    def _exact_query(
+        self, query_vectors: Sequence[Vector], labels: npt.NDArray[np.int64], k: int
+    ) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.float32]]:
+        """Score the queries against every one of the given labels, returning the
+        labels and distances of the k nearest for each query in the same form as
+        hnswlib's knn_query"""
+        vectors = self._get_embeddings(labels)
+        queries = np.asarray(query_vectors, dtype=np.float32).reshape(
+            -1, self._dimensionality or 0
+        )
+        if k == 0:
+            return (
+                np.empty((len(queries), 0), dtype=np.int64),
+                np.empty((len(queries), 0), dtype=np.float32),
+            )
+        top, top_distances = distance_functions.nearest(
+            self._params.space,
+            queries,
+            vectors,
+            distance_functions.squared_norms(vectors),
+            k,
+        )
+        return labels[top], top_distances
+
+    def _get_embeddings(self, labels: npt.ArrayLike) -> npt.NDArray[np.float32]:
+        """Fetch the vectors for an array of labels with a single call into hnswlib.
+        Returns a 2-D array with one row per label, in the order the labels are
+        given (the labels are flattened)."""
+        labels = np.asarray(labels).ravel()
+        if self._index is None or len(labels) == 0:
+            return np.empty((0, self._dimensionality or 0), dtype=np.float32)
+        return np.array(self._index.get_items(labels), dtype=np.float32)
+
     @override
     def max_seqid(self) -> SeqId:
         return self._max_seq_id
 
     @override
     def count(self) -> int:
-        return len(self._id_to_label)
+        return len(self._id_map)
 
     def _init_index(self, dimensionality: int) -> None:
+        self._index = self._create_index(dimensionality, DEFAULT_CAPACITY)
+        self._dimensionality = dimensionality
+
+    def _create_index(self, dimensionality: int, max_elements: int) -> hnswlib.Index:
+        """Create a new, empty hnswlib index"""
         # more comments available at the source: https://github.com/nmslib/hnswlib
 
         index = hnswlib.Index(
             space=self._params.space, dim=dimensionality
         )  # possible options are l2, cosine or ip
         index.init_index(
-            max_elements=DEFAULT_CAPACITY,
+            max_elements=max_elements,
             ef_construction=self._params.construction_ef,
             M=self._params.M,
         )
         index.set_ef(self._params.search_ef)
         index.set_num_threads(self._params.num_threads)
-
-        self._index = index
-        self._dimensionality = dimensionality
+        return index
 
     def _ensure_index(self, n: int, dim: int) -> None:
         """Create or resize the index as necessary to accomodate N new records"""
@@ -225,30 +324,26 @@ class LocalHnswSegment(VectorReader):
         vectors_to_write = batch.get_written_vectors(written_ids)
         labels_to_write = [0] * len(vectors_to_write)
 
+        if self._compaction_dirty_ids is not None:
+            self._compaction_dirty_ids.update(deleted_ids)
+            self._compaction_dirty_ids.update(written_ids)
+
         if len(deleted_ids) > 0:
             index = cast(hnswlib.Index, self._index)
-            for i in range(len(deleted_ids)):
-                id = deleted_ids[i]
-                # Never added this id to hnsw, so we can safely ignore it for deletions
-                if id not in self._id_to_label:
-                    continue
-                label = self._id_to_label[id]
-
+            # IDs never added to hnsw are not in the map, so they are safely ignored
+            for label in self._id_map.delete_many(deleted_ids):
                 index.mark_deleted(label)
-                del self._id_to_label[id]
-                del self._label_to_id[label]
-                del self._id_to_seq_id[id]
 
         if len(written_ids) > 0:
             self._ensure_index(batch.add_count, len(vectors_to_write[0]))
 
             next_label = self._total_elements_added + 1
-            for i in range(len(written_ids)):
-                if written_ids[i] not in self._id_to_label:
+            for i, label in enumerate(self._id_map.get_labels(written_ids).tolist()):
+                if label < 0:
                     labels_to_write[i] = next_label
                     next_label += 1
                 else:
-                    labels_to_write[i] = self._id_to_label[written_ids[i]]
+                    labels_to_write[i] = label
 
             index = cast(hnswlib.Index, self._index)
 
@@ -256,16 +351,22 @@ class LocalHnswSegment(VectorReader):
             index.add_items(vectors_to_write, labels_to_write)
 
             # If that succeeds, update the mappings
-            for i, id in enumerate(written_ids):
-                self._id_to_seq_id[id] = batch.get_record(id)["seq_id"]
-                self._id_to_label[id] = labels_to_write[i]
-                self._label_to_id[labels_to_write[i]] = id
+            self._id_map.put_many(
+                written_ids,
+                labels_to_write,
+                [batch.get_record(id)["seq_id"] for id in written_ids],
+            )
 
-            # If that succeeds, update the total count
-            self._total_elements_added += batch.add_count
+            # If that succeeds, update the total count. This counts the new labels
+            # rather than the batch's adds, since an ID deleted and added back in the
+            # same batch keeps its label.
+            self._total_elements_added = next_label - 1
 
             # If that succeeds, finally the seq ID
-            self._max_seq_id = batch.max_seq_id
+            self._max_seq_id = max(self._max_seq_id, batch.max_seq_id)
+
+        if self._should_compact():
+            self._compact_in_background()
 
     def _write_records(self, records: Sequence[EmbeddingRecord]) -> None:
         """Add a batch of embeddings to the index"""
@@ -275,33 +376,188 @@ class LocalHnswSegment(VectorReader):
         # Avoid all sorts of potential problems by ensuring single-threaded access
         with WriteRWLock(self._lock):
             batch = Batch()
+            in_index = self._id_map.get_labels([r["id"] for r in records]) >= 0
 
-            for record in records:
+            for record, indexed in zip(records, in_index.tolist()):
                 self._max_seq_id = max(self._max_seq_id, record["seq_id"])
                 id = record["id"]
                 op = record["operation"]
-                label = self._id_to_label.get(id, None)
+                # Earlier records of the same batch may have added or deleted the ID
+                exists = batch.is_written(id) or (indexed and not batch.is_deleted(id))
 
                 if op == Operation.DELETE:
-                    if label:
+                    if exists:
                         batch.apply(record)
                     else:
                         logger.warning(f"Delete of nonexisting embedding ID: {id}")
 
                 elif op == Operation.UPDATE:
                     if record["embedding"] is not None:
-                        if label is not None:
+                        if exists:
                             batch.apply(record)
                         else:
                             logger.warning(
                                 f"Update of nonexisting embedding ID: {record['id']}"
                             )
                 elif op == Operation.ADD:
-                    if not label:
+                    if not exists:
                         batch.apply(record, False)
                     else:
                         logger.warning(f"Add of existing embedding ID: {id}")
                 elif op == Operation.UPSERT:
-                    batch.apply(record, label is not None)
+                    batch.apply(record, exists)
 
             self._apply_batch(batch)
+
+    @override
+    def compact(self) -> bool:
+        """Rebuild the index from its live elements only, dropping the elements marked
+        as deleted and relabeling the live ones densely. This reclaims their space in
+        the index and in the label arrays, and keeps deleted elements from slowing
+        down searches.
+
+        The new index is built from a snapshot while the current one keeps serving
+        queries and writes. Writes made in the meantime are caught up on the new index
+        before it is swapped in, which is the only time readers are blocked. Returns
+        False if there was nothing to compact or a compaction was already running."""
+        if not self._compaction_lock.acquire(blocking=False):
+            return False
+        try:
+            with WriteRWLock(self._lock):
+                self._prepare_compaction()
+                if self._index is None or self._deleted_count() == 0:
+                    return False
+                self._start_compaction()
+                self._compaction_dirty_ids = set()
+
+            try:
+                self._compact()
+            except BaseException:
+                with WriteRWLock(self._lock):
+                    self._compaction_dirty_ids = None
+                    self._abort_compaction()
+                raise
+            return True
+        finally:
+            self._compaction_lock.release()
+
+    def _compact(self) -> None:
+        # Snapshot the live elements. Writers wait while the vectors are copied out,
+        # readers don't.
+        with ReadRWLock(self._lock):
+            dimensionality = cast(int, self._dimensionality)
+            labels = self._id_map.labels()
+            ids = self._id_map.ids_for(labels)
+            seq_ids = self._id_map.seq_ids_for(labels).tolist()
+            vectors = self._get_embeddings(labels)
+
+        count = len(ids)
+        index = self._create_index(
+            dimensionality,
+            max(int(count * self._params.resize_factor), DEFAULT_CAPACITY),
+        )
+        id_map = IdLabelMap()
+        if count > 0:
+            new_labels = np.arange(1, count + 1)
+            index.add_items(vectors, new_labels)
+            id_map.put_many(ids, new_labels.tolist(), seq_ids)
+        del vectors
+
+        with WriteRWLock(self._lock):
+            total_elements_added = self._catch_up(
+                index, id_map, count, cast(Set[str], self._compaction_dirty_ids)
+            )
+            deleted_count = self._deleted_count()
+            self._index = index
+            self._id_map = id_map
+            self._total_elements_added = total_elements_added
+            self._compaction_dirty_ids = None
+            self._finish_compaction()
+
+        logger.info(
+            f"Compacted index of segment {self._id}, reclaiming {deleted_count} "
+            f"deleted elements"
+        )
+
+    def _catch_up(
+        self,
+        index: hnswlib.Index,
+        id_map: IdLabelMap,
+        total_elements_added: int,
+        dirty_ids: Set[str],
+    ) -> int:
+        """Apply the writes made since the compaction snapshot to the compacted index
+        and its id map. Returns its new total number of elements added."""
+        written_ids = []
+        old_labels = []
+        new_labels = []
+        for id in dirty_ids:
+            old_label = self._id_map.get_label(id)
+            if old_label is None:
+                new_label = id_map.delete(id)
+                if new_label is not None:
+                    index.mark_deleted(new_label)
+                continue
+            new_label = id_map.get_label(id)
+            if new_label is None:
+                total_elements_added += 1
+                new_label = total_elements_added
+            written_ids.append(id)
+            old_labels.append(old_label)
+            new_labels.append(new_label)
+
+        if len(written_ids) > 0:
+            if total_elements_added > index.get_max_elements():
+                index.resize_index(
+                    int(total_elements_added * self._params.resize_factor)
+                )
+            index.add_items(self._get_embeddings(old_labels), new_labels)
+            id_map.put_many(
+                written_ids,
+                new_labels,
+                [self._id_map.get_seq_id(id) for id in written_ids],
+            )
+        return total_elements_added
+
+    def _deleted_count(self) -> int:
+        """Number of elements of the index that are marked as deleted"""
+        return self._total_elements_added - len(self._id_map)
+
+    def _should_compact(self) -> bool:
+        # An index never shrinks below DEFAULT_CAPACITY, so there is nothing to
+        # reclaim in smaller ones
+        return (
+            self._total_elements_added >= DEFAULT_CAPACITY
+            and self._deleted_count()
+            > self._params.compaction_threshold * self._total_elements_added
+        )
+
+    def _compact_in_background(self) -> None:
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+
+        def target() -> None:
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Compaction of segment {self._id} failed: {e}")
+
+        self._compaction_thread = threading.Thread(target=target, daemon=True)
+        self._compaction_thread.start()
+
+    def _prepare_compaction(self) -> None:
+        """Called with the write lock held before checking whether there is anything
+        to compact"""
+        pass
+
+    def _start_compaction(self) -> None:
+        """Called with the write lock held when a compaction starts"""
+        pass
+
+    def _finish_compaction(self) -> None:
+        """Called with the write lock held once the compacted index is swapped in"""
+        pass
+
+    def _abort_compaction(self) -> None:
+        """Called with the write lock held if a compaction fails"""
+        pass
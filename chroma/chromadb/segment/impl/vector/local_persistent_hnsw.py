@@ -2,8 +2,9 @@ import os
 import shutil
 from overrides import override
 import pickle
-from typing import Dict, List, Optional, Sequence, Set, cast
+from typing import List, Optional, Sequence, Set, Tuple, cast
 from chromadb.config import System
+from chromadb.db.mixins.embeddings_queue import SqlEmbeddingsQueue
 from chromadb.segment.impl.vector.batch import Batch
 from chromadb.segment.impl.vector.hnsw_params import PersistentHnswParams
 from chromadb.segment.impl.vector.local_hnsw import (
@@ -11,6 +12,7 @@ from chromadb.segment.impl.vector.local_hnsw import (
     LocalHnswSegment,
 )
 from chromadb.segment.impl.vector.brute_force_index import BruteForceIndex
+from chromadb.segment.impl.vector.id_map_log import IdMapLog
 from chromadb.types import (
     EmbeddingRecord,
     Metadata,
@@ -23,8 +25,12 @@ from chromadb.types import (
     VectorQueryResult,
 )
 import hnswlib
+import numpy as np
+import numpy.typing as npt
 import logging
 
+from chromadb.utils import distance_functions
+
 from chromadb.utils.read_write_lock import ReadRWLock, WriteRWLock
 
 
@@ -32,31 +38,22 @@ logger = logging.getLogger(__name__)
 
 
 class PersistentData:
-    """Stores the data and metadata needed for a PersistentLocalHnswSegment"""
+    """Stores the data and metadata needed for a PersistentLocalHnswSegment. The id <->
+    label mappings are stored separately, in an IdMapLog."""
 
     dimensionality: Optional[int]
     total_elements_added: int
     max_seq_id: SeqId
 
-    id_to_label: Dict[str, int]
-    label_to_id: Dict[int, str]
-    id_to_seq_id: Dict[str, SeqId]
-
     def __init__(
         self,
         dimensionality: Optional[int],
         total_elements_added: int,
         max_seq_id: int,
-        id_to_label: Dict[str, int],
-        label_to_id: Dict[int, str],
-        id_to_seq_id: Dict[str, SeqId],
     ):
         self.dimensionality = dimensionality
         self.total_elements_added = total_elements_added
         self.max_seq_id = max_seq_id
-        self.id_to_label = id_to_label
-        self.label_to_id = label_to_id
-        self.id_to_seq_id = id_to_seq_id
 
     @staticmethod
     def load_from_file(filename: str) -> "PersistentData":
@@ -68,6 +65,7 @@ class PersistentData:
 
 class PersistentLocalHnswSegment(LocalHnswSegment):
     METADATA_FILE: str = "index_metadata.pickle"
+    ID_MAP_FILE: str = "id_map.log"
     # How many records to add to index at once, we do this because crossing the python/c++ boundary is expensive (for add())
     # When records are not added to the c++ index, they are buffered in memory and served
     # via brute force search.
@@ -78,6 +76,17 @@ class PersistentLocalHnswSegment(LocalHnswSegment):
     _sync_threshold: int
     _persist_data: PersistentData
     _persist_directory: str
+    _id_map_log: IdMapLog
+    # IDs whose mapping changed since the last sync
+    _dirty_ids: Set[str]
+    # Cache of the hnsw labels shadowed by the current batch, see
+    # _get_shadowed_labels. Reset on every write.
+    _shadowed_labels: Optional[npt.NDArray[np.int64]]
+    _shadowed_mask: Optional[npt.NDArray[np.bool_]]
+    # Set while a compaction is building a new index in the storage folder, see
+    # _start_compaction. The current index can't be synced in the meantime.
+    _compacting: bool
+    _precompaction_id_map_log: Optional[IdMapLog]
 
     def __init__(self, system: System, segment: Segment):
         super().__init__(system, segment)
@@ -89,8 +98,15 @@ class PersistentLocalHnswSegment(LocalHnswSegment):
         self._persist_directory = system.settings.require("persist_directory")
         self._curr_batch = Batch()
         self._brute_force_index = None
+        self._dirty_ids = set()
+        self._shadowed_labels = None
+        self._shadowed_mask = None
+        self._compacting = False
+        self._precompaction_id_map_log = None
+        self._recover_compaction()
         if not os.path.exists(self._get_storage_folder()):
             os.makedirs(self._get_storage_folder(), exist_ok=True)
+        self._id_map_log = IdMapLog(self._get_id_map_file())
         # Load persist data if it exists already, otherwise create it
         if self._index_exists():
             self._persist_data = PersistentData.load_from_file(
@@ -99,11 +115,9 @@ class PersistentLocalHnswSegment(LocalHnswSegment):
             self._dimensionality = self._persist_data.dimensionality
             self._total_elements_added = self._persist_data.total_elements_added
             self._max_seq_id = self._persist_data.max_seq_id
-            self._id_to_label = self._persist_data.id_to_label
-            self._label_to_id = self._persist_data.label_to_id
-            self._id_to_seq_id = self._persist_data.id_to_seq_id
+            self._load_id_maps()
             # If the index was written to, we need to re-initialize it
-            if len(self._id_to_label) > 0:
+            if len(self._id_map) > 0:
                 self._dimensionality = cast(int, self._dimensionality)
                 self._init_index(self._dimensionality)
         else:
@@ -111,11 +125,35 @@ class PersistentLocalHnswSegment(LocalHnswSegment):
                 self._dimensionality,
                 self._total_elements_added,
                 self._max_seq_id,
-                self._id_to_label,
-                self._label_to_id,
-                self._id_to_seq_id,
             )
 
+    def _load_id_maps(self) -> None:
+        """Load the id <-> label mappings by replaying the id map log"""
+        # Indexes written before the id map log existed pickled the mappings along
+        # with the rest of the persistent data. They are rewritten as a log on the
+        # next sync.
+        legacy_id_to_label = self._persist_data.__dict__.pop("id_to_label", None)
+        legacy_id_to_seq_id = self._persist_data.__dict__.pop("id_to_seq_id", None)
+        self._persist_data.__dict__.pop("label_to_id", None)
+        if not self._id_map_log.exists():
+            for id, label in (legacy_id_to_label or {}).items():
+                self._id_map.put(id, label, legacy_id_to_seq_id[id])
+            return
+
+        max_label = 0
+        for written, deleted in self._id_map_log.load():
+            self._id_map.delete_many(deleted)
+            if len(written) == 0:
+                continue
+            # An ID that was deleted and re-added between two syncs is only logged
+            # with its new label, which put_many() takes care of
+            ids, labels, seq_ids = zip(*written)
+            self._id_map.put_many(ids, labels, seq_ids)
+            max_label = max(max_label, max(labels))
+        # The log may be ahead of the persisted data if we crashed between writing the
+        # two, make sure labels are never reused
+        self._total_elements_added = max(self._total_elements_added, max_label)
+
     @staticmethod
     @override
     def propagate_collection_metadata(metadata: Metadata) -> Optional[Metadata]:
@@ -131,22 +169,31 @@ class PersistentLocalHnswSegment(LocalHnswSegment):
         """Get the metadata file path"""
         return os.path.join(self._get_storage_folder(), self.METADATA_FILE)
 
+    def _get_id_map_file(self) -> str:
+        """Get the id map log file path"""
+        return os.path.join(self._get_storage_folder(), self.ID_MAP_FILE)
+
     def _get_storage_folder(self) -> str:
         """Get the storage folder path"""
         folder = os.path.join(self._persist_directory, str(self._id))
         return folder
 
+    def _get_precompaction_folder(self) -> str:
+        """Get the path the storage folder is moved to while a compaction runs"""
+        return self._get_storage_folder() + ".precompaction"
+
     @override
     def _init_index(self, dimensionality: int) -> None:
-        index = hnswlib.Index(space=self._params.space, dim=dimensionality)
         self._brute_force_index = BruteForceIndex(
             size=self._batch_size,
             dimensionality=dimensionality,
             space=self._params.space,
+            encoding=self._params.encoding,
         )
 
         # Check if index exists and load it if it does
         if self._index_exists():
+            index = hnswlib.Index(space=self._params.space, dim=dimensionality)
             index.load_index(
                 self._get_storage_folder(),
                 is_persistent_index=True,
@@ -154,21 +201,28 @@ class PersistentLocalHnswSegment(LocalHnswSegment):
                     max(self.count() * self._params.resize_factor, DEFAULT_CAPACITY)
                 ),
             )
+            index.set_ef(self._params.search_ef)
+            index.set_num_threads(self._params.num_threads)
         else:
-            index.init_index(
-                max_elements=DEFAULT_CAPACITY,
-                ef_construction=self._params.construction_ef,
-                M=self._params.M,
-                is_persistent_index=True,
-                persistence_location=self._get_storage_folder(),
-            )
-
-        index.set_ef(self._params.search_ef)
-        index.set_num_threads(self._params.num_threads)
+            index = self._create_index(dimensionality, DEFAULT_CAPACITY)
 
         self._index = index
         self._dimensionality = dimensionality
 
+    @override
+    def _create_index(self, dimensionality: int, max_elements: int) -> hnswlib.Index:
+        index = hnswlib.Index(space=self._params.space, dim=dimensionality)
+        index.init_index(
+            max_elements=max_elements,
+            ef_construction=self._params.construction_ef,
+            M=self._params.M,
+            is_persistent_index=True,
+            persistence_location=self._get_storage_folder(),
+        )
+        index.set_ef(self._params.search_ef)
+        index.set_num_threads(self._params.num_threads)
+        return index
+
     def _persist(self) -> None:
         """Persist the index and data to disk"""
         index = cast(hnswlib.Index, self._index)
@@ -176,25 +230,45 @@ class PersistentLocalHnswSegment(LocalHnswSegment):
         # Persist the index
         index.persist_dirty()
 
+        # Persist the id <-> label mappings that changed since the last sync
+        dirty_ids = list(self._dirty_ids)
+        labels = self._id_map.get_labels(dirty_ids)
+        seq_ids = self._id_map.seq_ids_for(labels).tolist()
+        written = []
+        deleted = []
+        for id, label, seq_id in zip(dirty_ids, labels.tolist(), seq_ids):
+            if label >= 0:
+                written.append((id, label, seq_id))
+            else:
+                deleted.append(id)
+        if not self._id_map_log.exists() or self._id_map_log.should_compact(
+            len(self._id_map), len(written) + len(deleted)
+        ):
+            self._id_map_log.compact(self._id_map.items())
+        else:
+            self._id_map_log.append(written, deleted)
+        self._dirty_ids.clear()
+
         # Persist the metadata
         self._persist_data.dimensionality = self._dimensionality
         self._persist_data.total_elements_added = self._total_elements_added
         self._persist_data.max_seq_id = self._max_seq_id
 
-        # TODO: This should really be stored in sqlite, the index itself, or a better
-        # storage format
-        self._persist_data.id_to_label = self._id_to_label
-        self._persist_data.label_to_id = self._label_to_id
-        self._persist_data.id_to_seq_id = self._id_to_seq_id
-
         with open(self._get_metadata_file(), "wb") as metadata_file:
             pickle.dump(self._persist_data, metadata_file, pickle.HIGHEST_PROTOCOL)
 
+        # Allow the records we persisted to be purged from the embeddings queue
+        if isinstance(self._consumer, SqlEmbeddingsQueue):
+            self._consumer.record_persisted_seq_id(self._id, self._max_seq_id)
+
     @override
     def _apply_batch(self, batch: Batch) -> None:
+        self._dirty_ids.update(batch.get_deleted_ids())
+        self._dirty_ids.update(batch.get_written_ids())
         super()._apply_batch(batch)
         if (
-            self._total_elements_added - self._persist_data.total_elements_added
+            not self._compacting
+            and self._total_elements_added - self._persist_data.total_elements_added
             >= self._sync_threshold
         ):
             self._persist()
@@ -206,6 +280,8 @@ class PersistentLocalHnswSegment(LocalHnswSegment):
             raise RuntimeError("Cannot add embeddings to stopped component")
 
         with WriteRWLock(self._lock):
+            self._shadowed_labels = None
+            self._shadowed_mask = None
             for record in records:
                 if record["embedding"] is not None:
                     self._ensure_index(len(records), len(record["embedding"]))
@@ -214,9 +290,9 @@ class PersistentLocalHnswSegment(LocalHnswSegment):
                 self._max_seq_id = max(self._max_seq_id, record["seq_id"])
                 id = record["id"]
                 op = record["operation"]
-                exists_in_index = self._id_to_label.get(
-                    id, None
-                ) is not None or self._brute_force_index.has_id(id)
+                exists_in_index = id in self._id_map or self._brute_force_index.has_id(
+                    id
+                )
 
                 if op == Operation.DELETE:
                     if exists_in_index:
@@ -246,14 +322,12 @@ class PersistentLocalHnswSegment(LocalHnswSegment):
                         self._curr_batch.apply(record, exists_in_index)
                         self._brute_force_index.upsert([record])
                 if len(self._curr_batch) >= self._batch_size:
-                    self._apply_batch(self._curr_batch)
-                    self._curr_batch = Batch()
-                    self._brute_force_index.clear()
+                    self._flush_batch()
 
     @override
     def count(self) -> int:
         return (
-            len(self._id_to_label)
+            len(self._id_map)
             + self._curr_batch.add_count
             - self._curr_batch.delete_count
         )
@@ -265,147 +339,254 @@ class PersistentLocalHnswSegment(LocalHnswSegment):
         """Get the embeddings from the HNSW index and layered brute force
         batch index."""
 
-        ids_hnsw: Set[str] = set()
-        ids_bf: Set[str] = set()
-
-        if self._index is not None:
-            ids_hnsw = set(self._id_to_label.keys())
-        if self._brute_force_index is not None:
-            ids_bf = set(self._curr_batch.get_written_ids())
-
-        target_ids = ids or list(ids_hnsw.union(ids_bf))
-        self._brute_force_index = cast(BruteForceIndex, self._brute_force_index)
-        hnsw_labels = []
-
-        results: List[Optional[VectorEmbeddingRecord]] = []
-        id_to_index: Dict[str, int] = {}
-        for i, id in enumerate(target_ids):
-            if id in ids_bf:
-                results.append(self._brute_force_index.get_vectors([id])[0])
-            elif id in ids_hnsw and id not in self._curr_batch._deleted_ids:
-                hnsw_labels.append(self._id_to_label[id])
-                # Placeholder for hnsw results to be filled in down below so we
-                # can batch the hnsw get() call
-                results.append(None)
-            id_to_index[id] = i
-
-        if len(hnsw_labels) > 0 and self._index is not None:
-            vectors = cast(Sequence[Vector], self._index.get_items(hnsw_labels))
-
-            for label, vector in zip(hnsw_labels, vectors):
-                id = self._label_to_id[label]
-                seq_id = self._id_to_seq_id[id]
-                results[id_to_index[id]] = VectorEmbeddingRecord(
-                    id=id, seq_id=seq_id, embedding=vector
-                )
-
-        return results  # type: ignore ## Python can't cast List with Optional to List with VectorEmbeddingRecord
+        with ReadRWLock(self._lock):
+            ids_bf: Set[str] = set()
+            if self._brute_force_index is not None:
+                ids_bf = set(self._curr_batch.get_written_ids())
+
+            if ids:
+                target_ids: Sequence[str] = ids
+            elif self._index is not None:
+                target_ids = list(ids_bf.union(self._id_map.ids()))
+            else:
+                target_ids = list(ids_bf)
+            self._brute_force_index = cast(BruteForceIndex, self._brute_force_index)
+            hnsw_labels = []
+            hnsw_positions = []
+
+            in_hnsw = [
+                id
+                for id in target_ids
+                if id not in ids_bf and not self._curr_batch.is_deleted(id)
+            ]
+            labels = dict(zip(in_hnsw, self._id_map.get_labels(in_hnsw).tolist()))
+
+            results: List[Optional[VectorEmbeddingRecord]] = []
+            for id in target_ids:
+                if id in ids_bf:
+                    results.append(self._brute_force_index.get_vectors([id])[0])
+                elif not self._curr_batch.is_deleted(id):
+                    label = labels[id]
+                    if label >= 0:
+                        hnsw_labels.append(label)
+                        hnsw_positions.append(len(results))
+                        # Placeholder for hnsw results to be filled in down below so we
+                        # can batch the hnsw get() call
+                        results.append(None)
+
+            if len(hnsw_labels) > 0 and self._index is not None:
+                vectors = cast(Sequence[Vector], self._index.get_items(hnsw_labels))
+                hnsw_ids = self._id_map.ids_for(hnsw_labels)
+                seq_ids = self._id_map.seq_ids_for(hnsw_labels).tolist()
+
+                for position, id, seq_id, vector in zip(
+                    hnsw_positions, hnsw_ids, seq_ids, vectors
+                ):
+                    results[position] = VectorEmbeddingRecord(
+                        id=id, seq_id=seq_id, embedding=vector
+                    )
+
+            return results  # type: ignore ## Python can't cast List with Optional to List with VectorEmbeddingRecord
 
     @override
     def query_vectors(
         self, query: VectorQuery
     ) -> Sequence[Sequence[VectorQueryResult]]:
-        if self._index is None and self._brute_force_index is None:
-            return [[] for _ in range(len(query["vectors"]))]
+        with ReadRWLock(self._lock):
+            if self._index is None and self._brute_force_index is None:
+                return [[] for _ in range(len(query["vectors"]))]
 
-        k = query["k"]
-        if k > self.count():
-            logger.warning(
-                f"Number of requested results {k} is greater than number of elements in index {self.count()}, updating n_results = {self.count()}"
+            k = query["k"]
+            if k > self.count():
+                logger.warning(
+                    f"Number of requested results {k} is greater than number of elements in index {self.count()}, updating n_results = {self.count()}"
+                )
+                k = self.count()
+
+            n_queries = len(query["vectors"])
+            self._brute_force_index = cast(BruteForceIndex, self._brute_force_index)
+            bf_rows, bf_distances = self._brute_force_index.search(
+                query["vectors"], k, query["allowed_ids"]
             )
-            k = self.count()
-
-        # Overquery by updated and deleted elements layered on the index because they may
-        # hide the real nearest neighbors in the hnsw index
-        hnsw_k = k + self._curr_batch.update_count + self._curr_batch.delete_count
-        if hnsw_k > len(self._id_to_label):
-            hnsw_k = len(self._id_to_label)
-        hnsw_query = VectorQuery(
-            vectors=query["vectors"],
-            k=hnsw_k,
-            allowed_ids=query["allowed_ids"],
-            include_embeddings=query["include_embeddings"],
-            options=query["options"],
-        )
 
-        # For each query vector, we want to take the top k results from the
-        # combined results of the brute force and hnsw index
-        results: List[List[VectorQueryResult]] = []
-        self._brute_force_index = cast(BruteForceIndex, self._brute_force_index)
-        with ReadRWLock(self._lock):
-            bf_results = self._brute_force_index.query(query)
-            hnsw_results = super().query_vectors(hnsw_query)
-            for i in range(len(query["vectors"])):
-                # Merge results into a single list of size k
-                bf_pointer: int = 0
-                hnsw_pointer: int = 0
-                curr_bf_result: Sequence[VectorQueryResult] = bf_results[i]
-                curr_hnsw_result: Sequence[VectorQueryResult] = hnsw_results[i]
-                curr_results: List[VectorQueryResult] = []
-                # In the case where filters cause the number of results to be less than k,
-                # we set k to be the number of results
-                total_results = len(curr_bf_result) + len(curr_hnsw_result)
-                if total_results == 0:
-                    results.append([])
-                else:
-                    while len(curr_results) < min(k, total_results):
-                        if bf_pointer < len(curr_bf_result) and hnsw_pointer < len(
-                            curr_hnsw_result
-                        ):
-                            bf_dist = curr_bf_result[bf_pointer]["distance"]
-                            hnsw_dist = curr_hnsw_result[hnsw_pointer]["distance"]
-                            if bf_dist <= hnsw_dist:
-                                curr_results.append(curr_bf_result[bf_pointer])
-                                bf_pointer += 1
-                            else:
-                                id = curr_hnsw_result[hnsw_pointer]["id"]
-                                # Only add the hnsw result if it is not in the brute force index
-                                # as updated or deleted
-                                if not self._brute_force_index.has_id(
-                                    id
-                                ) and not self._curr_batch.is_deleted(id):
-                                    curr_results.append(curr_hnsw_result[hnsw_pointer])
-                                hnsw_pointer += 1
-                        else:
-                            break
-                    remaining = min(k, total_results) - len(curr_results)
-                    if remaining > 0 and hnsw_pointer < len(curr_hnsw_result):
-                        for i in range(
-                            hnsw_pointer,
-                            min(len(curr_hnsw_result), hnsw_pointer + remaining + 1),
-                        ):
-                            id = curr_hnsw_result[i]["id"]
-                            if not self._brute_force_index.has_id(
-                                id
-                            ) and not self._curr_batch.is_deleted(id):
-                                curr_results.append(curr_hnsw_result[i])
-                    elif remaining > 0 and bf_pointer < len(curr_bf_result):
-                        curr_results.extend(
-                            curr_bf_result[bf_pointer : bf_pointer + remaining]
+            # Records updated or deleted in the current batch shadow their previous
+            # version in the hnsw index. Filtered queries exclude them up front;
+            # unfiltered queries overquery by their number and mask them out.
+            shadowed_labels, shadowed_mask = self._get_shadowed_labels()
+            hnsw_k = min(k + len(shadowed_labels), len(self._id_map))
+            allowed_labels = None
+            if query["allowed_ids"] is not None:
+                allowed_labels = np.setdiff1d(
+                    self._get_labels(query["allowed_ids"]),
+                    shadowed_labels,
+                    assume_unique=True,
+                )
+                hnsw_k = min(k, len(allowed_labels))
+
+            if self._index is not None and hnsw_k > 0:
+                hnsw_labels, hnsw_distances = self._search(
+                    query["vectors"], hnsw_k, allowed_labels
+                )
+                if allowed_labels is None and len(shadowed_labels) > 0:
+                    hnsw_distances = np.where(
+                        shadowed_mask[hnsw_labels], np.inf, hnsw_distances
+                    )
+            else:
+                hnsw_labels = np.empty((n_queries, 0), dtype=np.int64)
+                hnsw_distances = np.empty((n_queries, 0), dtype=np.float32)
+
+            sources, columns, distances = distance_functions.merge_top_k(
+                [bf_distances, hnsw_distances], k
+            )
+            valid = np.isfinite(distances)
+            from_bf = valid & (sources == 0)
+            from_hnsw = valid & (sources == 1)
+            result_bf_rows = bf_rows[np.nonzero(from_bf)[0], columns[from_bf]]
+            result_labels = hnsw_labels[np.nonzero(from_hnsw)[0], columns[from_hnsw]]
+
+            # Gather the ids and seq ids of all results from each source at once,
+            # into matrices shaped like the merged results
+            ids = np.empty(distances.shape, dtype=object)
+            ids[from_bf] = self._brute_force_index.ids_for(result_bf_rows)
+            ids[from_hnsw] = self._id_map.ids_for(result_labels)
+            seq_ids = np.zeros(distances.shape, dtype=np.int64)
+            seq_ids[from_bf] = [
+                self._brute_force_index.id_to_seq_id[id] for id in ids[from_bf]
+            ]
+            seq_ids[from_hnsw] = self._id_map.seq_ids_for(result_labels)
+            if query["include_embeddings"]:
+                embeddings = np.zeros(
+                    distances.shape + (self._dimensionality or 0,), dtype=np.float32
+                )
+                embeddings[from_bf] = self._brute_force_index.embeddings_at(
+                    result_bf_rows
+                )
+                embeddings[from_hnsw] = self._get_embeddings(result_labels)
+
+            results: List[List[VectorQueryResult]] = []
+            counts = valid.sum(axis=1).tolist()
+            distance_lists = distances.tolist()
+            seq_id_lists = seq_ids.tolist()
+            for i in range(n_queries):
+                results.append(
+                    [
+                        VectorQueryResult(
+                            id=ids[i, j],
+                            seq_id=seq_id_lists[i][j],
+                            distance=distance_lists[i][j],
+                            embedding=embeddings[i, j]
+                            if query["include_embeddings"]
+                            else None,
                         )
-                    results.append(curr_results)
+                        for j in range(counts[i])
+                    ]
+                )
             return results
 
+    def _get_shadowed_labels(
+        self,
+    ) -> Tuple[npt.NDArray[np.int64], npt.NDArray[np.bool_]]:
+        """Return the labels of the hnsw records that are updated or deleted by the
+        current batch, and a mask over all labels selecting them. These are computed
+        once per change to the batch rather than per query."""
+        if self._shadowed_labels is None:
+            shadowed_ids = self._curr_batch.get_written_ids()
+            shadowed_ids.extend(self._curr_batch.get_deleted_ids())
+            labels = self._get_labels(shadowed_ids)
+            mask = np.zeros(self._total_elements_added + 1, dtype=np.bool_)
+            mask[labels] = True
+            self._shadowed_mask = mask
+            self._shadowed_labels = labels
+        return self._shadowed_labels, cast(npt.NDArray[np.bool_], self._shadowed_mask)
+
+    def _flush_batch(self) -> None:
+        """Apply the pending batch to the hnsw index"""
+        if len(self._curr_batch) == 0:
+            return
+        self._apply_batch(self._curr_batch)
+        self._curr_batch = Batch()
+        self._shadowed_labels = None
+        self._shadowed_mask = None
+        cast(BruteForceIndex, self._brute_force_index).clear()
+
+    @override
+    def _prepare_compaction(self) -> None:
+        # Apply the pending batch first, so that its deletes are reclaimed too
+        self._flush_batch()
+
+    @override
+    def _start_compaction(self) -> None:
+        # The compacted index is built in the storage folder, so move the current one
+        # out of the way. Until the compaction finishes the current index keeps
+        # serving queries and writes from memory, but isn't synced. If we crash in the
+        # meantime, _recover_compaction restores it.
+        index = cast(hnswlib.Index, self._index)
+        index.close_file_handles()
+        os.rename(self._get_storage_folder(), self._get_precompaction_folder())
+        os.makedirs(self._get_storage_folder())
+        self._precompaction_id_map_log = self._id_map_log
+        self._id_map_log = IdMapLog(self._get_id_map_file())
+        self._compacting = True
+
+    @override
+    def _finish_compaction(self) -> None:
+        self._compacting = False
+        self._precompaction_id_map_log = None
+        # Labels have changed
+        self._shadowed_labels = None
+        self._shadowed_mask = None
+        # Sync the pending batch too, so that the persisted max seq id covers
+        # everything in the compacted index
+        self._flush_batch()
+        # The metadata file is written last, marking the compaction as complete
+        self._persist()
+        shutil.rmtree(self._get_precompaction_folder(), ignore_errors=True)
+
+    @override
+    def _abort_compaction(self) -> None:
+        self._compacting = False
+        shutil.rmtree(self._get_storage_folder(), ignore_errors=True)
+        os.rename(self._get_precompaction_folder(), self._get_storage_folder())
+        self._id_map_log = cast(IdMapLog, self._precompaction_id_map_log)
+        self._precompaction_id_map_log = None
+        cast(hnswlib.Index, self._index).open_file_handles()
+
+    def _recover_compaction(self) -> None:
+        """Clean up after a compaction that was interrupted by a crash. If the
+        compacted index was completely written, keep it, otherwise restore the index it
+        was replacing."""
+        precompaction_folder = self._get_precompaction_folder()
+        if not os.path.exists(precompaction_folder):
+            return
+        if self._index_exists():
+            shutil.rmtree(precompaction_folder)
+        else:
+            shutil.rmtree(self._get_storage_folder(), ignore_errors=True)
+            os.rename(precompaction_folder, self._get_storage_folder())
+
     @override
     def reset_state(self) -> None:
         data_path = self._get_storage_folder()
         if os.path.exists(data_path):
             shutil.rmtree(data_path, ignore_errors=True)
+        shutil.rmtree(self._get_precompaction_folder(), ignore_errors=True)
 
     @staticmethod
     def get_file_handle_count() -> int:
         """Return how many file handles are used by the index"""
         hnswlib_count = hnswlib.Index.file_handle_count
         hnswlib_count = cast(int, hnswlib_count)
-        # One extra for the metadata file
+        # One extra for the metadata file or the id map log, which are never open at
+        # the same time
         return hnswlib_count + 1  # type: ignore
 
     def open_persistent_index(self) -> None:
         """Open the persistent index"""
-        if self._index is not None:
+        # While compacting, the files of the current index have been moved away
+        if self._index is not None and not self._compacting:
             self._index.open_file_handles()
 
     def close_persistent_index(self) -> None:
         """Close the persistent index"""
-        if self._index is not None:
+        if self._index is not None and not self._compacting:
             self._index.close_file_handles()
@@ -11,7 +11,7 @@ from uuid import UUID
 
 import chromadb
 from chromadb.api.models.Collection import Collection
-from chromadb.api.types import GetResult, QueryResult
+from chromadb.api.types import CollectionStatistics, Facet, GetResult, QueryResult
 from chromadb.config import Settings
 import chromadb.server
 import chromadb.api
@@ -22,8 +22,10 @@ from chromadb.errors import (
 )
 from chromadb.server.fastapi.types import (
     AddEmbedding,
+    CountEmbedding,
     DeleteEmbedding,
     GetEmbedding,
+    GetFacets,
     QueryEmbedding,
     CreateCollection,
     UpdateCollection,
@@ -168,6 +170,30 @@ class FastAPI(chromadb.server.Server):
             methods=["GET"],
             response_model=None,
         )
+        self.router.add_api_route(
+            "/api/v1/collections/{collection_id}/count",
+            self.count_where,
+            methods=["POST"],
+            response_model=None,
+        )
+        self.router.add_api_route(
+            "/api/v1/collections/{collection_id}/statistics",
+            self.statistics,
+            methods=["GET"],
+            response_model=None,
+        )
+        self.router.add_api_route(
+            "/api/v1/collections/{collection_id}/facets",
+            self.facets,
+            methods=["POST"],
+            response_model=None,
+        )
+        self.router.add_api_route(
+            "/api/v1/collections/{collection_id}/compact",
+            self.compact,
+            methods=["POST"],
+            response_model=None,
+        )
         self.router.add_api_route(
             "/api/v1/collections/{collection_id}/query",
             self.get_nearest_neighbors,
@@ -288,6 +314,28 @@ class FastAPI(chromadb.server.Server):
     def count(self, collection_id: str) -> int:
         return self._api._count(_uuid(collection_id))
 
+    def count_where(self, collection_id: str, count: CountEmbedding) -> int:
+        return self._api._count(
+            _uuid(collection_id),
+            where=count.where,
+            where_document=count.where_document,
+        )
+
+    def statistics(self, collection_id: str) -> CollectionStatistics:
+        return self._api._statistics(_uuid(collection_id))
+
+    def facets(self, collection_id: str, facets: GetFacets) -> List[Facet]:
+        return self._api._facets(
+            _uuid(collection_id),
+            facets.key,
+            where=facets.where,
+            where_document=facets.where_document,
+            limit=facets.limit,
+        )
+
+    def compact(self, collection_id: str) -> bool:
+        return self._api._compact(_uuid(collection_id))
+
     def reset(self) -> bool:
         return self._api.reset()
 
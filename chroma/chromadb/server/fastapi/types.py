@@ -44,6 +44,18 @@ class GetEmbedding(BaseModel):  # type: ignore
     include: Include = ["metadatas", "documents"]
 
 
+class CountEmbedding(BaseModel):  # type: ignore
+    where: Optional[Dict[Any, Any]] = None
+    where_document: Optional[Dict[Any, Any]] = None
+
+
+class GetFacets(BaseModel):  # type: ignore
+    key: str
+    where: Optional[Dict[Any, Any]] = None
+    where_document: Optional[Dict[Any, Any]] = None
+    limit: Optional[int] = None
+
+
 class DeleteEmbedding(BaseModel):  # type: ignore
     ids: Optional[List[str]] = None
     where: Optional[Dict[Any, Any]] = None
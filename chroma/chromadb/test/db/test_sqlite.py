@@ -0,0 +1,184 @@
+import shutil
+import tempfile
+import threading
+from typing import Any, Dict, List
+from chromadb.db.impl.sqlite import SqliteDB
+from chromadb.config import System, Settings
+
+
+_PRAGMAS = [
+    "journal_mode",
+    "synchronous",
+    "mmap_size",
+    "cache_size",
+    "temp_store",
+    "busy_timeout",
+]
+
+
+def _pragmas(db: SqliteDB, names: List[str] = _PRAGMAS) -> Dict[str, Any]:
+    with db.tx() as cur:
+        return {name: cur.execute(f"PRAGMA {name}").fetchone()[0] for name in names}
+
+
+def test_pragmas_applied_to_every_connection() -> None:
+    save_path = tempfile.mkdtemp()
+    db = SqliteDB(
+        System(
+            Settings(
+                allow_reset=True,
+                is_persistent=True,
+                persist_directory=save_path,
+                sqlite_journal_mode="WAL",
+                sqlite_synchronous="NORMAL",
+                sqlite_mmap_size=1 << 20,
+                sqlite_cache_size=-4096,
+                sqlite_temp_store="MEMORY",
+                sqlite_busy_timeout=2500,
+            )
+        )
+    )
+    db.start()
+    try:
+        expected = {
+            "journal_mode": "wal",
+            "synchronous": 1,
+            "mmap_size": 1 << 20,
+            "cache_size": -4096,
+            "temp_store": 2,
+            "busy_timeout": 2500,
+        }
+        assert _pragmas(db) == expected
+
+        # Connections made by other threads get the same pragmas
+        results: List[Dict[str, Any]] = []
+        thread = threading.Thread(target=lambda: results.append(_pragmas(db)))
+        thread.start()
+        thread.join()
+        assert results == [expected]
+
+        # As do connections made after a reset
+        db.reset_state()
+        assert _pragmas(db) == expected
+    finally:
+        db.stop()
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+def test_default_pragmas() -> None:
+    db = SqliteDB(System(Settings(allow_reset=True)))
+    db.start()
+    try:
+        pragmas = _pragmas(db, ["journal_mode", "temp_store"])
+        assert pragmas == {"journal_mode": "memory", "temp_store": 0}
+    finally:
+        db.stop()
+
+
+def test_default_journal_mode_persistent() -> None:
+    save_path = tempfile.mkdtemp()
+    db = SqliteDB(
+        System(
+            Settings(allow_reset=True, is_persistent=True, persist_directory=save_path)
+        )
+    )
+    db.start()
+    try:
+        # Without a configured journal mode the database keeps SQLite's default
+        assert _pragmas(db, ["journal_mode"]) == {"journal_mode": "delete"}
+        assert "reader" not in db.pool_metrics()
+    finally:
+        db.stop()
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+def test_read_pool() -> None:
+    save_path = tempfile.mkdtemp()
+    db = SqliteDB(
+        System(
+            Settings(
+                allow_reset=True,
+                is_persistent=True,
+                persist_directory=save_path,
+                sqlite_journal_mode="WAL",
+                sqlite_read_pool_size=1,
+            )
+        )
+    )
+    db.start()
+    try:
+        with db.tx() as cur:
+            assert cur.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            cur.execute("CREATE TABLE test (value INTEGER)")
+
+        with db.read_tx() as cur:
+            assert cur.execute("PRAGMA query_only").fetchone()[0] == 1
+
+        # Reads inside a write transaction see its uncommitted writes
+        with db.tx() as cur:
+            cur.execute("INSERT INTO test VALUES (1)")
+            with db.read_tx() as read_cur:
+                assert read_cur.execute("SELECT count(*) FROM test").fetchone() == (1,)
+
+        # A reader does not block the writer, and nested read transactions reuse
+        # the thread's reader connection
+        with db.read_tx() as cur:
+            assert cur.execute("SELECT count(*) FROM test").fetchone() == (1,)
+            with db.tx() as write_cur:
+                write_cur.execute("INSERT INTO test VALUES (2)")
+            with db.read_tx() as nested_cur:
+                # Still reading the snapshot the read transaction started with
+                count = nested_cur.execute("SELECT count(*) FROM test").fetchone()
+                assert count == (1,)
+
+            # The pool is full, so another thread waits for the reader
+            counts: List[int] = []
+
+            def read() -> None:
+                with db.read_tx() as cur:
+                    count = cur.execute("SELECT count(*) FROM test").fetchone()
+                    counts.append(count[0])
+
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join(timeout=0.2)
+            assert thread.is_alive()
+        thread.join()
+        assert counts == [2]
+
+        metrics = db.pool_metrics()
+        assert metrics["reader"]["connections"] == 1
+        assert metrics["reader"]["waits"] == 1
+        assert metrics["reader"]["wait_seconds_max"] >= 0.2
+        assert metrics["writer"]["connections"] == 1
+        assert metrics["writer"]["acquisitions"] > 0
+    finally:
+        db.stop()
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+def test_statement_cache() -> None:
+    db = SqliteDB(System(Settings(allow_reset=True)))
+    db.start()
+    try:
+        builds: List[str] = []
+
+        def build() -> str:
+            builds.append("built")
+            return "SELECT ?"
+
+        assert db.statement("select_one", build) == "SELECT ?"
+        assert db.statement("select_one", build) == "SELECT ?"
+        assert builds == ["built"]
+
+        # Each filter combination of get_collections is its own statement shape
+        db.get_collections(name="a")
+        db.get_collections(name="a", topic="b")
+        db.get_collections(name="c")
+        shapes = [k for k in db._statements if k[0] == "get_collections"]
+        assert sorted(shapes) == [
+            ("get_collections", (False, False, True)),
+            ("get_collections", (False, True, True)),
+        ]
+    finally:
+        db.stop()
@@ -2,6 +2,7 @@ import os
 import shutil
 import tempfile
 import pytest
+import numpy as np
 from itertools import count
 from typing import (
     Generator,
@@ -14,7 +15,7 @@ from typing import (
     Sequence,
     Tuple,
 )
-from chromadb.ingest import Producer, Consumer
+from chromadb.ingest import Producer, Consumer, encode_vector, decode_vectors
 from chromadb.db.impl.sqlite import SqliteDB
 from chromadb.types import (
     SubmitEmbeddingRecord,
@@ -24,7 +25,8 @@ from chromadb.types import (
 )
 from chromadb.config import System, Settings
 from pytest import FixtureRequest, approx
-from asyncio import Event, wait_for, TimeoutError
+from asyncio import AbstractEventLoop, Event, get_event_loop, wait_for, TimeoutError
+import threading
 
 
 def sqlite() -> Generator[Tuple[Producer, Consumer], None, None]:
@@ -50,8 +52,19 @@ def sqlite_persistent() -> Generator[Tuple[Producer, Consumer], None, None]:
         shutil.rmtree(save_path)
 
 
+def sqlite_async() -> Generator[Tuple[Producer, Consumer], None, None]:
+    """Fixture generator for sqlite Producer + Consumer with asynchronous ingest"""
+    system = System(
+        Settings(allow_reset=True, async_ingest=True, async_ingest_buffer_size=4)
+    )
+    db = system.require(SqliteDB)
+    system.start()
+    yield db, db
+    system.stop()
+
+
 def fixtures() -> List[Callable[[], Generator[Tuple[Producer, Consumer], None, None]]]:
-    return [sqlite, sqlite_persistent]
+    return [sqlite, sqlite_persistent, sqlite_async]
 
 
 @pytest.fixture(scope="module", params=fixtures())
@@ -85,17 +98,21 @@ def sample_embeddings() -> Iterator[SubmitEmbeddingRecord]:
 
 class CapturingConsumeFn:
     embeddings: List[EmbeddingRecord]
-    waiters: List[Tuple[int, Event]]
+    waiters: List[Tuple[int, Event, AbstractEventLoop]]
+    calls: int
 
     def __init__(self) -> None:
         self.embeddings = []
         self.waiters = []
+        self.calls = 0
 
     def __call__(self, embeddings: Sequence[EmbeddingRecord]) -> None:
+        self.calls += 1
         self.embeddings.extend(embeddings)
-        for n, event in self.waiters:
+        # With asynchronous ingest, this is called from another thread
+        for n, event, loop in self.waiters:
             if len(self.embeddings) >= n:
-                event.set()
+                loop.call_soon_threadsafe(event.set)
 
     async def get(self, n: int) -> Sequence[EmbeddingRecord]:
         "Wait until at least N embeddings are available, then return all embeddings"
@@ -103,7 +120,7 @@ class CapturingConsumeFn:
             return self.embeddings[:n]
         else:
             event = Event()
-            self.waiters.append((n, event))
+            self.waiters.append((n, event, get_event_loop()))
             # timeout so we don't hang forever on failure
             await wait_for(event.wait(), 10)
             return self.embeddings[:n]
@@ -150,6 +167,8 @@ async def test_backfill(
 
     recieved = await consume_fn.get(3)
     assert_records_match(embeddings, recieved)
+    for record in recieved:
+        assert isinstance(record["embedding"], np.ndarray)
 
 
 @pytest.mark.asyncio
@@ -175,6 +194,36 @@ async def test_notifications(
         assert_records_match(embeddings, received)
 
 
+@pytest.mark.asyncio
+async def test_submit_embeddings(
+    producer_consumer: Tuple[Producer, Consumer],
+    sample_embeddings: Iterator[SubmitEmbeddingRecord],
+) -> None:
+    producer, consumer = producer_consumer
+    producer.reset_state()
+    producer.create_topic("test_topic")
+
+    consume_fn = CapturingConsumeFn()
+    consumer.subscribe("test_topic", consume_fn, start=consumer.min_seqid())
+
+    first = producer.submit_embedding("test_topic", next(sample_embeddings))
+    embeddings = [next(sample_embeddings) for _ in range(10)]
+    seq_ids = producer.submit_embeddings("test_topic", embeddings)
+    assert list(seq_ids) == list(range(first + 1, first + 11))
+    assert producer.submit_embeddings("test_topic", []) == []
+
+    received = await consume_fn.get(11)
+    assert_records_match(embeddings, received[1:])
+    # Vectors are delivered as numpy arrays in their encoding
+    for record in received:
+        assert isinstance(record["embedding"], np.ndarray)
+        assert record["embedding"].dtype == np.float32
+    assert [r["seq_id"] for r in received[1:]] == list(seq_ids)
+    if not producer._system.settings.async_ingest:
+        # The whole batch is delivered with a single callback
+        assert consume_fn.calls == 2
+
+
 @pytest.mark.asyncio
 async def test_multiple_topics(
     producer_consumer: Tuple[Producer, Consumer],
@@ -274,3 +323,121 @@ async def test_end_seq_id(
     # Should never produce a 7th
     with pytest.raises(TimeoutError):
         _ = await wait_for(consume_fn_2.get(7), timeout=1)
+
+
+def test_async_ingest_backpressure() -> None:
+    system = System(
+        Settings(allow_reset=True, async_ingest=True, async_ingest_buffer_size=2)
+    )
+    db = system.require(SqliteDB)
+    system.start()
+    db.reset_state()
+    embeddings = (
+        SubmitEmbeddingRecord(
+            id=f"embedding_{i}",
+            embedding=[float(i), float(i)],
+            encoding=ScalarEncoding.FLOAT32,
+            metadata=None,
+            operation=Operation.ADD,
+        )
+        for i in count()
+    )
+
+    applying = threading.Event()
+    unblock = threading.Event()
+    batches: List[Sequence[EmbeddingRecord]] = []
+
+    def consume(records: Sequence[EmbeddingRecord]) -> None:
+        applying.set()
+        unblock.wait()
+        batches.append(records)
+
+    db.subscribe("test_topic", consume, start=db.min_seqid())
+
+    def submit() -> None:
+        db.submit_embedding("test_topic", next(embeddings))
+
+    producer = threading.Thread(target=submit, daemon=True)
+    try:
+        # The first record is being applied and blocks, the next two fill the buffer
+        submit()
+        assert applying.wait(timeout=5)
+        submit()
+        submit()
+
+        producer.start()
+        producer.join(timeout=0.5)
+        assert producer.is_alive()
+    finally:
+        unblock.set()
+    producer.join(timeout=5)
+    assert not producer.is_alive()
+
+    # Stopping applies everything that was submitted. Records that were buffered
+    # together are applied in a single batch.
+    system.stop()
+    ids = [r["id"] for batch in batches for r in batch]
+    assert ids == [f"embedding_{i}" for i in range(4)]
+    assert len(batches) < 4
+
+
+def test_batch_size(sample_embeddings: Iterator[SubmitEmbeddingRecord]) -> None:
+    system = System(Settings(allow_reset=True, ingest_batch_size=4))
+    db = system.require(SqliteDB)
+    system.start()
+    db.reset_state()
+
+    backfilled = [next(sample_embeddings) for _ in range(10)]
+    db.submit_embeddings("test_topic", backfilled)
+
+    batches: List[Sequence[EmbeddingRecord]] = []
+    db.subscribe("test_topic", batches.append, start=db.min_seqid())
+    assert [len(b) for b in batches] == [4, 4, 2]
+
+    # New records are delivered in batches of the same size
+    embeddings = [next(sample_embeddings) for _ in range(6)]
+    db.submit_embeddings("test_topic", embeddings)
+    assert [len(b) for b in batches] == [4, 4, 2, 4, 2]
+    assert_records_match(
+        backfilled + embeddings, [r for batch in batches for r in batch]
+    )
+    system.stop()
+
+
+def test_submit_checks_seq_ids(
+    sample_embeddings: Iterator[SubmitEmbeddingRecord],
+) -> None:
+    system = System(Settings(allow_reset=True))
+    db = system.require(SqliteDB)
+    system.start()
+    db.reset_state()
+
+    db.submit_embeddings("test_topic", [next(sample_embeddings) for _ in range(2)])
+    # Once the largest rowid is taken, SQLite assigns random ones, which the SeqIDs
+    # returned by submit_embeddings could not match
+    with db.tx() as cur:
+        cur.execute(
+            "INSERT INTO embeddings_queue (seq_id, operation, topic, id) "
+            "VALUES (?, 0, 'other_topic', 'max')",
+            (2**63 - 1,),
+        )
+    with pytest.raises(RuntimeError):
+        db.submit_embeddings("test_topic", [next(sample_embeddings) for _ in range(2)])
+    system.stop()
+
+
+@pytest.mark.parametrize(
+    "encoding, tolerance",
+    [
+        (ScalarEncoding.FLOAT32, 0),
+        (ScalarEncoding.FLOAT16, 1e-3),
+        (ScalarEncoding.INT8, 1 / 254),
+    ],
+)
+def test_vector_encodings(encoding: ScalarEncoding, tolerance: float) -> None:
+    rng = np.random.default_rng(0)
+    vectors = (rng.random((5, 8)) * 2 - 1).tolist() + [[0.0] * 8, [0.5] * 3]
+    decoded = decode_vectors([encode_vector(v, encoding) for v in vectors], encoding)
+    for vector, result in zip(vectors, decoded):
+        assert result.dtype == np.float32  # type: ignore
+        np.testing.assert_allclose(result, vector, atol=tolerance)
@@ -0,0 +1,134 @@
+import pytest
+import numpy as np
+from typing import List, Optional, Sequence
+from chromadb.segment.impl.vector.brute_force_index import BruteForceIndex
+from chromadb.types import EmbeddingRecord, Operation, ScalarEncoding, VectorQuery
+from chromadb.utils import distance_functions
+
+
+def _records(vectors: np.ndarray, start: int = 0) -> List[EmbeddingRecord]:  # type: ignore
+    return [
+        EmbeddingRecord(
+            id=f"id_{start + i}",
+            seq_id=start + i,
+            embedding=vector.tolist(),
+            encoding=ScalarEncoding.FLOAT32,
+            metadata=None,
+            operation=Operation.ADD,
+        )
+        for i, vector in enumerate(vectors)
+    ]
+
+
+def _query(
+    vectors: np.ndarray, k: int, allowed_ids: Optional[Sequence[str]] = None  # type: ignore
+) -> VectorQuery:
+    return VectorQuery(
+        vectors=vectors.tolist(),
+        k=k,
+        allowed_ids=allowed_ids,
+        include_embeddings=False,
+        options=None,
+    )
+
+
+@pytest.mark.parametrize("space", ["l2", "cosine", "ip"])
+def test_query_matches_reference(space: str) -> None:
+    rng = np.random.default_rng(0)
+    data = rng.random((50, 8), dtype=np.float32)
+    queries = rng.random((5, 8), dtype=np.float32)
+
+    index = BruteForceIndex(size=64, dimensionality=8, space=space)
+    records = _records(data)
+    index.upsert(records)
+    index.delete(records[:10])
+
+    results = index.query(_query(queries, k=7))
+
+    reference_fn = distance_functions.distance_functions[space]
+    for query, result in zip(queries, results):
+        expected = sorted(
+            (reference_fn(query, data[i]), f"id_{i}") for i in range(10, 50)
+        )[:7]
+        assert [r["id"] for r in result] == [id for _, id in expected]
+        for r, (distance, _) in zip(result, expected):
+            assert r["distance"] == pytest.approx(distance, abs=1e-4)
+
+
+def test_l2_distances_are_exact_far_from_origin() -> None:
+    # Vectors that are close to each other but far from the origin, where expanding
+    # l2 into squared norms cancels most of the significant digits
+    rng = np.random.default_rng(2)
+    data = (1000 + rng.random((10, 16))).astype(np.float32)
+    index = BruteForceIndex(size=10, dimensionality=16)
+    index.upsert(_records(data))
+
+    results = index.query(_query(data[:3], k=10))
+    for query, result in zip(data[:3], results):
+        for r in result:
+            expected = np.sum((query - data[int(r["id"][3:])]) ** 2)
+            assert r["distance"] == pytest.approx(expected, rel=1e-5, abs=1e-6)
+
+
+@pytest.mark.parametrize("offset", [100, 1000])
+def test_l2_selects_nearest_far_from_origin(offset: float) -> None:
+    # Selecting k < n candidates must not rely on distances that lost their
+    # significant digits, since dropped neighbors cannot be recovered later
+    rng = np.random.default_rng(3)
+    data = (offset + rng.random((1000, 16))).astype(np.float32)
+    queries = (offset + rng.random((100, 16))).astype(np.float32)
+    index = BruteForceIndex(size=1000, dimensionality=16)
+    index.upsert(_records(data))
+
+    results = index.query(_query(queries, k=10))
+    for query, result in zip(queries, results):
+        exact = np.sum((data.astype(np.float64) - query) ** 2, axis=1)
+        expected = [f"id_{i}" for i in np.argsort(exact, kind="stable")[:10]]
+        assert [r["id"] for r in result] == expected
+
+
+def test_query_allowed_ids_and_small_index() -> None:
+    rng = np.random.default_rng(1)
+    data = rng.random((20, 4), dtype=np.float32)
+    index = BruteForceIndex(size=100, dimensionality=4)
+    index.upsert(_records(data))
+
+    allowed = ["id_3", "id_7", "id_11", "not_in_index"]
+    results = index.query(_query(data[:2], k=10, allowed_ids=allowed))
+    for result in results:
+        assert len(result) == 3
+        assert {r["id"] for r in result} == {"id_3", "id_7", "id_11"}
+        assert [r["distance"] for r in result] == sorted(r["distance"] for r in result)
+
+    # Each vector is its own nearest neighbor
+    results = index.query(_query(data, k=1))
+    assert [r[0]["id"] for r in results] == [f"id_{i}" for i in range(20)]
+
+    index.clear()
+    assert index.query(_query(data[:1], k=5)) == [[]]
+
+
+@pytest.mark.parametrize(
+    "encoding, tolerance",
+    [
+        (ScalarEncoding.FLOAT32, 0),
+        (ScalarEncoding.FLOAT16, 1e-3),
+        (ScalarEncoding.INT8, 1 / 254),
+    ],
+)
+def test_encodings(encoding: ScalarEncoding, tolerance: float) -> None:
+    rng = np.random.default_rng(2)
+    data = rng.random((30, 8), dtype=np.float32)
+    index = BruteForceIndex(size=32, dimensionality=8, encoding=encoding)
+    index.upsert(_records(data))
+
+    ids = [f"id_{i}" for i in range(30)]
+    np.testing.assert_allclose(index.get_embeddings(ids), data, atol=tolerance)
+    vectors = index.get_vectors(ids[:1])
+    np.testing.assert_allclose(vectors[0]["embedding"], data[0], atol=tolerance)
+
+    # Each vector is still its own nearest neighbor
+    results = index.query(_query(data, k=1))
+    assert [r[0]["id"] for r in results] == ids
+    for r in results:
+        assert r[0]["distance"] == pytest.approx(0, abs=8 * tolerance + 1e-5)
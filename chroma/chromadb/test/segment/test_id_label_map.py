@@ -0,0 +1,140 @@
+import numpy as np
+from chromadb.segment.impl.vector.id_label_map import IdLabelMap, _encode
+
+
+def test_put_get_delete() -> None:
+    id_map = IdLabelMap()
+    expected = {}
+    # Enough entries to force the hash table, label arrays and arena to grow
+    for label in range(1, 5001):
+        id = f"id_{label}_é"
+        id_map.put(id, label, label * 10)
+        expected[id] = label
+
+    assert len(id_map) == 5000
+    for id, label in expected.items():
+        assert id in id_map
+        assert id_map.get_label(id) == label
+        assert id_map.get_id(label) == id
+        assert id_map.get_seq_id(id) == label * 10
+    assert id_map.get_label("missing") is None
+    assert "missing" not in id_map
+
+    for label in range(1, 5001, 2):
+        assert id_map.delete(f"id_{label}_é") == label
+    assert id_map.delete("missing") is None
+    assert len(id_map) == 2500
+    assert id_map.get_label("id_1_é") is None
+    assert id_map.get_label("id_2_é") == 2
+
+    # Re-adding a deleted ID under a new label and moving a live ID to a new label
+    id_map.put("id_1_é", 6001, 1)
+    id_map.put("id_2_é", 6002, 2)
+    assert id_map.get_label("id_1_é") == 6001
+    assert id_map.get_label("id_2_é") == 6002
+    assert id_map.get_seq_id("id_2_é") == 2
+    assert 2 not in id_map.labels()
+    assert len(id_map) == 2501
+
+    items = list(id_map.items())
+    assert len(items) == 2501
+    for id, label, seq_id in items:
+        assert id_map.get_label(id) == label
+        assert id_map.get_seq_id(id) == seq_id
+
+
+def test_vectorized_lookup() -> None:
+    id_map = IdLabelMap()
+    for label in range(1, 11):
+        id_map.put(str(label), label, label + 100)
+
+    labels = np.array([[3, 1], [10, 7]], dtype=np.uint64)
+    assert id_map.ids_for(labels) == ["3", "1", "10", "7"]
+    assert id_map.seq_ids_for(labels).tolist() == [[103, 101], [110, 107]]
+
+
+def test_compact_arena() -> None:
+    id_map = IdLabelMap()
+    for label in range(1, 101):
+        id_map.put(f"id_{label}", label, label)
+    for label in range(1, 101, 3):
+        id_map.delete(f"id_{label}")
+    before = list(id_map.items())
+    arena_size = len(id_map._arena)
+
+    id_map._compact_arena()
+
+    assert len(id_map._arena) < arena_size
+    assert list(id_map.items()) == before
+    for id, label, _ in before:
+        assert id_map.get_label(id) == label
+
+
+def test_put_many_delete_many() -> None:
+    id_map = IdLabelMap()
+    id_map.put_many(["a", "é", "c"], [1, 2, 3], [10, 20, 30])
+    assert [id_map.get_id(label) for label in (1, 2, 3)] == ["a", "é", "c"]
+
+    # New IDs, including non-ASCII ones, along with moved and updated IDs
+    id_map.put_many(["d", "ü", "é", "a"], [4, 5, 6, 1], [40, 50, 60, 11])
+    assert list(id_map.items()) == [
+        ("a", 1, 11),
+        ("c", 3, 30),
+        ("d", 4, 40),
+        ("ü", 5, 50),
+        ("é", 6, 60),
+    ]
+
+    assert id_map.delete_many(["c", "missing", "ü"]) == [3, 5]
+    assert list(id_map.items()) == [("a", 1, 11), ("d", 4, 40), ("é", 6, 60)]
+    assert id_map.delete_many([]) == []
+
+
+def test_matches_dict_reference() -> None:
+    # Batches of puts, moves and deletes, checked against dicts after each one
+    rng = np.random.default_rng(0)
+    id_map = IdLabelMap()
+    labels = {}
+    seq_ids = {}
+    next_label = 1
+    for round in range(50):
+        ids = list(
+            dict.fromkeys(f"id_{i}_{'é' * (i % 3)}" for i in rng.integers(0, 3000, 200))
+        )
+        new_labels = []
+        for id in ids:
+            if id in labels and rng.random() < 0.5:
+                new_labels.append(labels[id])
+            else:
+                new_labels.append(next_label)
+                next_label += 1
+        id_map.put_many(ids, new_labels, [round] * len(ids))
+        labels.update(zip(ids, new_labels))
+        seq_ids.update((id, round) for id in ids)
+
+        deleted = [f"id_{i}_{'é' * (i % 3)}" for i in rng.integers(0, 3000, 100)]
+        expected = sorted({labels[id] for id in deleted if id in labels})
+        assert sorted(id_map.delete_many(deleted)) == expected
+        for id in deleted:
+            labels.pop(id, None)
+
+        assert len(id_map) == len(labels)
+        assert sorted(id_map.items()) == sorted(
+            (id, label, seq_ids[id]) for id, label in labels.items()
+        )
+        probe = list(labels)[:50] + ["missing", "id_1"]
+        assert id_map.get_labels(probe).tolist() == [labels.get(id, -1) for id in probe]
+        assert [id_map.get_label(id) for id in probe] == [
+            labels.get(id) for id in probe
+        ]
+
+
+def test_hash_collision() -> None:
+    id_map = IdLabelMap()
+    id_map.put_many(["a", "bb"], [1, 2], [1, 2])
+    # Probe for other IDs as if they had the hashes of those in the map
+    ids = ["b", "cc", "a"]
+    hashes, encoded, starts, lengths = _encode(ids)
+    hashes[:2] = [hash("a"), hash("bb")]
+    _, labels = id_map._find_many(ids, hashes, encoded, starts, lengths)
+    assert labels.tolist() == [-1, -1, 1]
@@ -2,7 +2,17 @@ import os
 import shutil
 import tempfile
 import pytest
-from typing import Generator, List, Callable, Iterator, Dict, Optional, Union, Sequence
+from typing import (
+    Any,
+    Generator,
+    List,
+    Callable,
+    Iterator,
+    Dict,
+    Optional,
+    Union,
+    Sequence,
+)
 from chromadb.config import System, Settings
 from chromadb.types import (
     SubmitEmbeddingRecord,
@@ -12,7 +22,10 @@ from chromadb.types import (
     Segment,
     SegmentScope,
     SeqId,
+    Where,
 )
+from chromadb.db.base import get_sql
+from chromadb.db.impl.sqlite import SqliteDB
 from chromadb.ingest import Producer
 from chromadb.segment import MetadataReader
 import uuid
@@ -269,6 +282,266 @@ def test_get(
     assert len(result) == 1
 
 
+def test_pagination(
+    system: System, sample_embeddings: Iterator[SubmitEmbeddingRecord]
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    topic = str(segment_definition["topic"])
+
+    embeddings = [next(sample_embeddings) for i in range(10)]
+    seq_ids = producer.submit_embeddings(topic, embeddings)
+
+    segment = SqliteMetadataSegment(system, segment_definition)
+    segment.start()
+    sync(segment, seq_ids[-1])
+
+    ids = [e["id"] for e in embeddings]
+
+    # Pages apply to records, not to their metadata rows, in insertion order
+    assert [r["id"] for r in segment.get_metadata(limit=3)] == ids[:3]
+    assert [r["id"] for r in segment.get_metadata(limit=3, offset=8)] == ids[8:]
+    assert [r["id"] for r in segment.get_metadata(offset=7)] == ids[7:]
+    assert all(r["metadata"] for r in segment.get_metadata(limit=3, offset=3))
+
+    # Pagination applies after filtering
+    result = segment.get_metadata(where={"bool_key": True}, limit=2, offset=1)
+    assert [r["id"] for r in result] == ids[3:6:2]
+
+    # Keyset pagination
+    pages = []
+    after = None
+    while True:
+        page = segment.get_metadata(limit=4, after=after)
+        if not page:
+            break
+        pages.append([r["id"] for r in page])
+        after = page[-1]["id"]
+    assert pages == [ids[0:4], ids[4:8], ids[8:10]]
+
+    result = segment.get_metadata(where={"bool_key": True}, after=ids[4], limit=1)
+    assert [r["id"] for r in result] == [ids[5]]
+    with pytest.raises(ValueError):
+        segment.get_metadata(after="not_an_id")
+
+    # A cursor that was deleted between pages is an error rather than an empty page,
+    # which would look like the end of the records
+    page = segment.get_metadata(limit=4)
+    max_id = producer.submit_embedding(
+        topic,
+        SubmitEmbeddingRecord(
+            id=page[-1]["id"],
+            embedding=None,
+            encoding=None,
+            metadata=None,
+            operation=Operation.DELETE,
+        ),
+    )
+    sync(segment, max_id)
+    with pytest.raises(ValueError):
+        segment.get_metadata(limit=4, after=page[-1]["id"])
+
+
+def test_projection(
+    system: System, sample_embeddings: Iterator[SubmitEmbeddingRecord]
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    topic = str(segment_definition["topic"])
+
+    segment = SqliteMetadataSegment(system, segment_definition)
+    segment.start()
+
+    embeddings = [next(sample_embeddings) for i in range(10)]
+    max_id = 0
+    for e in embeddings:
+        max_id = producer.submit_embedding(topic, e)
+    sync(segment, max_id)
+
+    # IDs only
+    result = segment.get_metadata(keys=[])
+    assert [r["id"] for r in result] == [e["id"] for e in embeddings]
+    assert all(r["metadata"] is None for r in result)
+
+    # Only the requested keys, for records that have them
+    result = segment.get_metadata(
+        where={"int_key": {"$gte": 4}}, keys=["chroma:document", "div_by_three"]
+    )
+    assert [r["metadata"] for r in result] == [
+        {"chroma:document": "four"},
+        {"chroma:document": "five"},
+        {"chroma:document": "six", "div_by_three": "true"},
+        {"chroma:document": "seven"},
+        {"chroma:document": "eight"},
+        {"chroma:document": "nine", "div_by_three": "true"},
+    ]
+
+    result = segment.get_metadata(keys=["missing"], limit=2)
+    assert [(r["id"], r["metadata"]) for r in result] == [
+        ("embedding_0", None),
+        ("embedding_1", None),
+    ]
+
+
+def test_sort(
+    system: System, sample_embeddings: Iterator[SubmitEmbeddingRecord]
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    topic = str(segment_definition["topic"])
+
+    segment = SqliteMetadataSegment(system, segment_definition)
+    segment.start()
+
+    embeddings = [next(sample_embeddings) for i in range(10)]
+    max_id = 0
+    for e in embeddings:
+        max_id = producer.submit_embedding(topic, e)
+    sync(segment, max_id)
+
+    def sorted_ids(**kwargs: Any) -> List[int]:
+        records = segment.get_metadata(keys=[], **kwargs)
+        return [int(r["id"].split("_")[1]) for r in records]
+
+    # Records without the key (embedding_0 has no metadata) come last
+    assert sorted_ids(sort="int_key") == [1, 2, 3, 4, 5, 6, 7, 8, 9, 0]
+    assert sorted_ids(sort="-float_key") == [9, 8, 7, 6, 5, 4, 3, 2, 1, 0]
+    assert sorted_ids(sort="chroma:document") == [8, 5, 4, 9, 1, 7, 6, 3, 2, 0]
+    # Ties are broken in the order records were added, in either order
+    assert sorted_ids(sort="bool_key") == [2, 4, 6, 8, 1, 3, 5, 7, 9, 0]
+    assert sorted_ids(sort="-bool_key") == [1, 3, 5, 7, 9, 2, 4, 6, 8, 0]
+    assert sorted_ids(sort="-bool_key", limit=3, offset=4) == [9, 2, 4]
+    assert sorted_ids(sort="div_by_three") == [3, 6, 9, 0, 1, 2, 4, 5, 7, 8]
+
+    # Combined with filters and pages, including pages past the sorted records
+    assert sorted_ids(sort="-int_key", where={"int_key": {"$gt": 3}}) == [
+        9,
+        8,
+        7,
+        6,
+        5,
+        4,
+    ]
+    assert sorted_ids(sort="-int_key", limit=3, offset=2) == [7, 6, 5]
+    assert sorted_ids(sort="div_by_three", limit=3, offset=2) == [9, 0, 1]
+    assert sorted_ids(sort="div_by_three", limit=2, offset=5) == [2, 4]
+    assert sorted_ids(sort="div_by_three", offset=8) == [7, 8]
+    assert sorted_ids(sort="missing", limit=2, offset=1) == [1, 2]
+
+    # Records are hydrated in sorted order
+    result = segment.get_metadata(sort="-int_key", limit=2, keys=["int_key"])
+    assert [r["metadata"] for r in result] == [{"int_key": 9}, {"int_key": 8}]
+
+    # A sorted page walks the sort index, rather than sorting the whole segment
+    db = system.instance(SqliteDB)
+    sql, params = get_sql(
+        segment._get_query(None, None, None, 10, None, None, None, "-int_key")
+    )
+    with db.tx() as cur:
+        plan = [row[3] for row in cur.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+    assert "SEARCH sort USING INDEX embedding_metadata_sort (key=?)" in plan
+    assert not any("segment_id=?" in step for step in plan)
+
+
+@pytest.mark.parametrize(
+    "where, indexes",
+    [
+        ({"source": "a"}, ["embedding_metadata_string_value"]),
+        ({"page": 3}, ["embedding_metadata_int_value"]),
+        ({"score": 0.5}, ["embedding_metadata_float_value"]),
+        ({"flag": True}, ["embedding_metadata_bool_value"]),
+        ({"page": {"$ne": 3}}, ["embedding_metadata_int_value"]),
+        (
+            {"page": {"$gte": 3}},
+            ["embedding_metadata_int_value", "embedding_metadata_float_value"],
+        ),
+        (
+            {"$or": [{"source": "a"}, {"page": {"$lt": 3}}]},
+            [
+                "embedding_metadata_string_value",
+                "embedding_metadata_int_value",
+                "embedding_metadata_float_value",
+            ],
+        ),
+    ],
+)
+def test_where_uses_indexes(system: System, where: Where, indexes: List[str]) -> None:
+    segment = SqliteMetadataSegment(system, segment_definition)
+    db = system.instance(SqliteDB)
+    sql, params = get_sql(segment._get_query(where, None, None, None, None, None))
+    with db.tx() as cur:
+        plan = [row[3] for row in cur.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+    # Filters never scan the metadata table
+    assert not any(step.startswith("SCAN embedding_metadata") for step in plan)
+    used = [
+        index
+        for step in plan
+        for index in indexes
+        if step.startswith("SEARCH embedding_metadata") and f"INDEX {index} " in step
+    ]
+    assert sorted(used) == sorted(indexes)
+
+
+def test_where_plan(system: System) -> None:
+    segment = SqliteMetadataSegment(system, segment_definition)
+    db = system.instance(SqliteDB)
+    where: Where = {
+        "$and": [
+            {"flag": True},
+            {"page": {"$ne": 3}},
+            {"score": {"$gt": 0.5}},
+            {"source": "a"},
+        ]
+    }
+    sql, params = get_sql(segment._get_query(where, None, None, None, None, None))
+    with db.tx() as cur:
+        plan = [row[3] for row in cur.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+    # The most selective predicate (equality on a string) selects the candidate
+    # embeddings, which are looked up by primary key rather than scanning the
+    # segment
+    candidates = [step for step in plan if "INDEX embedding_metadata_" in step]
+    assert candidates == [
+        "SEARCH embedding_metadata USING COVERING INDEX "
+        "embedding_metadata_string_value (key=? AND string_value=?)"
+    ]
+    assert "SEARCH embeddings USING INTEGER PRIMARY KEY (rowid=?)" in plan
+    assert not any("(segment_id=?)" in step for step in plan)
+    # The other predicates are checked per candidate
+    probes = [step for step in plan if step.startswith("SEARCH probe")]
+    assert len(probes) == 4  # One for each of the int and float columns of $gt
+    assert all("(id=? AND key=?)" in step for step in probes)
+    assert params[1:3] == ("source", "a")
+
+
+def test_where_plan_from_data(
+    system: System, sample_embeddings: Iterator[SubmitEmbeddingRecord]
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    topic = str(segment_definition["topic"])
+
+    segment = SqliteMetadataSegment(system, segment_definition)
+    segment.start()
+
+    embeddings = [next(sample_embeddings) for i in range(21)]
+    max_id = producer.submit_embeddings(topic, embeddings)
+    sync(segment, max_id[-1])
+
+    # String equality usually matches fewer rows than a range, but here it matches
+    # every third embedding and the range only three
+    where: Where = {"$and": [{"div_by_three": "true"}, {"int_key": {"$gt": 17}}]}
+    sql, params = get_sql(segment._get_query(where, None, None, None, None, None))
+    db = system.instance(SqliteDB)
+    with db.tx() as cur:
+        plan = [row[3] for row in cur.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+    candidates = [step for step in plan if "INDEX embedding_metadata_" in step]
+    assert all("embedding_metadata_string_value" not in step for step in candidates)
+    assert params[1] == "int_key"
+
+    results = segment.get_metadata(where=where)
+    assert [r["id"] for r in results] == ["embedding_18"]
+
+
 def test_fulltext(
     system: System, sample_embeddings: Iterator[SubmitEmbeddingRecord]
 ) -> None:
@@ -329,6 +602,30 @@ def test_fulltext(
     result = segment.get_metadata(where_document={"$contains": "zer"})
     assert len(result) == 9
 
+    # $contains is case sensitive, with or without the trigram index
+    assert segment.get_metadata(where_document={"$contains": "Zero"}) == []
+    assert segment.get_metadata(where_document={"$contains": "Ze"}) == []
+    result = segment.get_metadata(where_document={"$contains": "ze"})
+    assert len(result) == 9
+
+    # $search matches any of its terms, ranking documents that match more of
+    # them first
+    result = segment.get_metadata(where_document={"$search": "four two"}, limit=2)
+    assert set([r["id"] for r in result]) == {"embedding_42", "embedding_24"}
+    fours_or_twos = [
+        i for i in range(1, 100) if {"four", "two"} & set(_build_document(i).split())
+    ]
+    result = segment.get_metadata(where_document={"$search": "four two"})
+    assert len(result) == len(fours_or_twos)
+    result = segment.get_metadata(
+        where={"int_key": {"$gt": 30}}, where_document={"$search": "four two"}
+    )
+    assert set([r["id"] for r in result]) == {
+        f"embedding_{i}" for i in fours_or_twos if i > 30
+    }
+    with pytest.raises(ValueError):
+        segment.get_metadata(where_document={"$search": "a b"})
+
 
 def test_delete(
     system: System, sample_embeddings: Iterator[SubmitEmbeddingRecord]
@@ -391,6 +688,212 @@ def test_delete(
     assert segment.count() == 10
     results = segment.get_metadata(ids=["embedding_0"])
 
+    # Deleting a record removes its document from the full text index
+    assert len(segment.get_metadata(where_document={"$contains": "nine"})) == 1
+    max_id = producer.submit_embedding(
+        topic,
+        SubmitEmbeddingRecord(
+            id="embedding_9",
+            embedding=None,
+            encoding=None,
+            metadata=None,
+            operation=Operation.DELETE,
+        ),
+    )
+    sync(segment, max_id)
+    with system.instance(SqliteDB).tx() as cur:
+        sql = "SELECT count(*) FROM embedding_fulltext_search WHERE string_value = ?"
+        assert cur.execute(sql, ("nine",)).fetchone()[0] == 0
+
+
+def test_statistics(
+    system: System, sample_embeddings: Iterator[SubmitEmbeddingRecord]
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    topic = str(segment_definition["topic"])
+
+    segment = SqliteMetadataSegment(system, segment_definition)
+    segment.start()
+
+    assert segment.statistics() == {
+        "count": 0,
+        "document_bytes": 0,
+        "adds": 0,
+        "updates": 0,
+        "upserts": 0,
+        "deletes": 0,
+    }
+
+    embeddings = [next(sample_embeddings) for i in range(10)]
+    # Adding an existing ID is not counted
+    max_id = producer.submit_embeddings(topic, embeddings + embeddings[:1])
+    sync(segment, max_id[-1])
+    documents = [_build_document(i) for i in range(1, 10)]
+    document_bytes = sum(len(d) for d in documents)
+
+    def record(id: str, operation: Operation, document: Any) -> SubmitEmbeddingRecord:
+        return SubmitEmbeddingRecord(
+            id=id,
+            embedding=None,
+            encoding=None,
+            metadata=None if document is False else {"chroma:document": document},
+            operation=operation,
+        )
+
+    max_id = producer.submit_embeddings(
+        topic,
+        [
+            # Replaces "one" with a document of 5 bytes
+            record("embedding_1", Operation.UPDATE, "ünus"),
+            # Removes "two"
+            record("embedding_2", Operation.UPDATE, None),
+            record("no_such_id", Operation.UPDATE, "x"),
+            record("embedding_3", Operation.UPSERT, "3"),
+            record("embedding_10", Operation.UPSERT, "ten"),
+            record("embedding_4", Operation.DELETE, False),
+            record("no_such_id", Operation.DELETE, False),
+        ],
+    )
+    sync(segment, max_id[-1])
+
+    assert segment.statistics() == {
+        "count": 10,
+        "document_bytes": document_bytes + 2 - 3 - 4 + 3 - 4,
+        "adds": 10,
+        "updates": 2,
+        "upserts": 2,
+        "deletes": 1,
+    }
+    assert segment.count() == len(segment.get_metadata())
+    assert segment.count(where={"int_key": {"$gte": 5}}) == 5
+    # ünus, seven, nine and ten
+    assert segment.count(where_document={"$contains": "n"}) == 4
+    count = segment.count(
+        where={"div_by_three": "true"}, where_document={"$contains": "i"}
+    )
+    assert count == 2
+
+
+def test_bad_record_in_batch(
+    system: System, sample_embeddings: Iterator[SubmitEmbeddingRecord]
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    topic = str(segment_definition["topic"])
+
+    segment = SqliteMetadataSegment(system, segment_definition)
+    segment.start()
+
+    embeddings = [next(sample_embeddings) for i in range(5)]
+    # SQLite can't store an integer this large, which fails the whole batch
+    bad = SubmitEmbeddingRecord(
+        id="bad",
+        embedding=None,
+        encoding=None,
+        metadata={"int_key": 2**64},
+        operation=Operation.ADD,
+    )
+    max_id = producer.submit_embeddings(topic, embeddings[:2] + [bad] + embeddings[2:])
+    sync(segment, max_id[-1])
+
+    # The other records of the batch are written
+    assert segment.count() == 5
+    assert [r["id"] for r in segment.get_metadata()] == [e["id"] for e in embeddings]
+    assert segment.statistics()["adds"] == 5
+
+
+def test_facets(
+    system: System, sample_embeddings: Iterator[SubmitEmbeddingRecord]
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    topic = str(segment_definition["topic"])
+
+    segment = SqliteMetadataSegment(system, segment_definition)
+    segment.start()
+
+    embeddings = [next(sample_embeddings) for i in range(10)]
+    max_id = producer.submit_embeddings(topic, embeddings)
+    sync(segment, max_id[-1])
+
+    # From the most to the least common value, then in order of value
+    assert segment.facets("bool_key") == [
+        {"value": True, "count": 5},
+        {"value": False, "count": 4},
+    ]
+    assert segment.facets("div_by_three") == [{"value": "true", "count": 3}]
+    assert segment.facets("int_key", limit=2) == [
+        {"value": 1, "count": 1},
+        {"value": 2, "count": 1},
+    ]
+    assert segment.facets("int_key", limit=0) == []
+    assert segment.facets("missing") == []
+
+    # Among the records matching filters
+    assert segment.facets("bool_key", where={"int_key": {"$gt": 4}}) == [
+        {"value": True, "count": 3},
+        {"value": False, "count": 2},
+    ]
+    facets = segment.facets(
+        "div_by_three", where={"bool_key": True}, where_document={"$contains": "n"}
+    )
+    assert facets == [{"value": "true", "count": 1}]
+
+    # Groups the values of the key in the order of its index, rather than scanning
+    # the segment and sorting its values
+    db = system.instance(SqliteDB)
+    sql, params = get_sql(segment._facets_query("int_key", None, None))
+    with db.tx() as cur:
+        plan = [row[3] for row in cur.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+    assert "SEARCH facet USING INDEX embedding_metadata_sort (key=?)" in plan
+    assert not any("GROUP BY" in step or "segment_id=?" in step for step in plan)
+
+
+def test_facets_mixed_types(system: System) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    topic = str(segment_definition["topic"])
+
+    segment = SqliteMetadataSegment(system, segment_definition)
+    segment.start()
+
+    # True, 1 and 1.0 compare equal in SQLite but are distinct facets
+    values: List[Union[str, int, float, bool]] = [True, 1, 1.0, 1, 0, False, "1"]
+    embeddings = [
+        SubmitEmbeddingRecord(
+            id=f"embedding_{i}",
+            embedding=[float(i), float(i)],
+            encoding=ScalarEncoding.FLOAT32,
+            metadata={"mixed": value},
+            operation=Operation.ADD,
+        )
+        for i, value in enumerate(values)
+    ]
+    max_id = producer.submit_embeddings(topic, embeddings)
+    sync(segment, max_id[-1])
+
+    facets = segment.facets("mixed")
+    assert facets == [
+        {"value": 1, "count": 2},
+        {"value": False, "count": 1},
+        {"value": 0, "count": 1},
+        {"value": True, "count": 1},
+        {"value": 1.0, "count": 1},
+        {"value": "1", "count": 1},
+    ]
+    assert [type(facet["value"]) for facet in facets] == [
+        int,
+        bool,
+        int,
+        bool,
+        float,
+        str,
+    ]
+    # The limit applies to facets rather than to the values SQLite groups
+    assert segment.facets("mixed", limit=2) == facets[:2]
+    assert segment.facets("mixed", limit=4) == facets[:4]
+
 
 def test_update(
     system: System, sample_embeddings: Iterator[SubmitEmbeddingRecord]
@@ -1,5 +1,5 @@
 import pytest
-from typing import Generator, List, Callable, Iterator, Type, cast
+from typing import Any, Generator, List, Callable, Iterator, Sequence, Type, cast
 from chromadb.config import System, Settings
 from chromadb.types import (
     SubmitEmbeddingRecord,
@@ -478,3 +478,401 @@ def test_upsert(
     result = segment.get_vectors(ids=["no_such_record"])
     assert len(result) == 1
     assert approx_equal_vector(result[0]["embedding"], [42, 42])
+
+
+def test_persistent_id_maps_reload(
+    system: System,
+    sample_embeddings: Iterator[SubmitEmbeddingRecord],
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    segment_definition = create_random_segment_definition()
+    segment_definition["metadata"] = {"hnsw:batch_size": 10, "hnsw:sync_threshold": 10}
+    topic = str(segment_definition["topic"])
+
+    segment = PersistentLocalHnswSegment(system, segment_definition)
+    segment.start()
+
+    embeddings = [next(sample_embeddings) for i in range(100)]
+    seq_ids: List[SeqId] = []
+    for e in embeddings:
+        seq_ids.append(producer.submit_embedding(topic, e))
+    for e in embeddings[:40]:
+        seq_ids.append(
+            producer.submit_embedding(
+                topic,
+                SubmitEmbeddingRecord(
+                    id=e["id"],
+                    embedding=None,
+                    encoding=None,
+                    metadata=None,
+                    operation=Operation.DELETE,
+                ),
+            )
+        )
+    for e in embeddings[:10]:
+        seq_ids.append(producer.submit_embedding(topic, e))
+    sync(segment, seq_ids[-1])
+    for e in embeddings[10:20]:
+        seq_ids.append(producer.submit_embedding(topic, e))
+    sync(segment, seq_ids[-1])
+    segment.stop()
+
+    # Only the records that were synced are loaded from disk, the rest are
+    # backfilled from the embeddings queue
+    reloaded = PersistentLocalHnswSegment(system, segment_definition)
+    assert list(reloaded._id_map.items()) == list(segment._id_map.items())
+    assert reloaded._total_elements_added == segment._total_elements_added
+
+    reloaded.start()
+    assert reloaded.count() == 80
+    ids = {r["id"] for r in reloaded.get_vectors()}
+    assert ids == {e["id"] for e in embeddings[:20] + embeddings[40:]}
+
+
+def test_query_include_embeddings(
+    system: System,
+    sample_embeddings: Iterator[SubmitEmbeddingRecord],
+    vector_reader: Type[VectorReader],
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    segment_definition = create_random_segment_definition()
+    segment_definition["metadata"] = {"hnsw:batch_size": 10}
+    topic = str(segment_definition["topic"])
+
+    segment = vector_reader(system, segment_definition)
+    segment.start()
+
+    # With a batch size of 10, the persistent segment serves the last 5 records from
+    # the brute force index and the rest from hnsw
+    embeddings = [next(sample_embeddings) for i in range(25)]
+    seq_ids: List[SeqId] = []
+    for e in embeddings:
+        seq_ids.append(producer.submit_embedding(topic, e))
+    sync(segment, seq_ids[-1])
+
+    by_id = {e["id"]: cast(Vector, e["embedding"]) for e in embeddings}
+    query = VectorQuery(
+        vectors=[cast(Vector, e["embedding"]) for e in embeddings[::3]],
+        k=4,
+        allowed_ids=None,
+        options=None,
+        include_embeddings=True,
+    )
+    results = segment.query_vectors(query)
+    assert len(results) == len(embeddings[::3])
+    for result in results:
+        assert len(result) == 4
+        for r in result:
+            assert r["embedding"] is not None
+            assert approx_equal_vector(r["embedding"], by_id[r["id"]])
+
+
+@pytest.mark.parametrize("exact_search_ratio", [0.0, 1.0])
+def test_filtered_query_search_paths(
+    system: System,
+    sample_embeddings: Iterator[SubmitEmbeddingRecord],
+    vector_reader: Type[VectorReader],
+    exact_search_ratio: float,
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    segment_definition = create_random_segment_definition()
+    segment_definition["metadata"] = {
+        "hnsw:batch_size": 10,
+        "hnsw:exact_search_ratio": exact_search_ratio,
+    }
+    topic = str(segment_definition["topic"])
+
+    segment = vector_reader(system, segment_definition)
+    segment.start()
+
+    embeddings = [next(sample_embeddings) for i in range(105)]
+    seq_ids: List[SeqId] = []
+    for e in embeddings:
+        seq_ids.append(producer.submit_embedding(topic, e))
+    sync(segment, seq_ids[-1])
+
+    # A ratio of 0 always filters during the HNSW search, a ratio of 1 always scores
+    # the allowed vectors exactly. Both must find the true nearest allowed neighbors.
+    allowed = embeddings[::7]
+    query_vector = cast(Vector, embeddings[50]["embedding"])
+    query = VectorQuery(
+        vectors=[query_vector],
+        k=5,
+        allowed_ids=[e["id"] for e in allowed] + ["not_in_index"],
+        options=None,
+        include_embeddings=False,
+    )
+    results = segment.query_vectors(query)
+    search_path = "hnsw_filtered" if exact_search_ratio == 0.0 else "exact"
+    metrics = cast(LocalHnswSegment, segment).search_path_metrics()
+    assert metrics == {"hnsw": 0, "hnsw_filtered": 0, "exact": 0, search_path: 1}
+
+    expected = sorted(
+        allowed,
+        key=lambda e: abs(cast(Vector, e["embedding"])[0] - query_vector[0]),
+    )[:5]
+    assert [r["id"] for r in results[0]] == [e["id"] for e in expected]
+    for r, e in zip(results[0], expected):
+        vector = cast(Vector, e["embedding"])
+        assert approx_equal(
+            r["distance"],
+            (vector[0] - query_vector[0]) ** 2 + (vector[1] - query_vector[1]) ** 2,
+            epsilon=0.01,
+        )
+
+
+def test_query_merges_pending_writes(
+    system: System,
+    sample_embeddings: Iterator[SubmitEmbeddingRecord],
+    vector_reader: Type[VectorReader],
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    segment_definition = create_random_segment_definition()
+    segment_definition["metadata"] = {"hnsw:batch_size": 10}
+    topic = str(segment_definition["topic"])
+
+    segment = vector_reader(system, segment_definition)
+    segment.start()
+
+    embeddings = [next(sample_embeddings) for i in range(24)]
+    for e in embeddings:
+        producer.submit_embedding(topic, e)
+
+    # With a batch size of 10 these stay in the brute force index of the persistent
+    # segment, shadowing the versions of the updated and deleted records in hnsw
+    for i in [2, 5, 6]:
+        producer.submit_embedding(
+            topic,
+            SubmitEmbeddingRecord(
+                id=embeddings[i]["id"],
+                embedding=[100.0 + i, 100.0 + i],
+                encoding=ScalarEncoding.FLOAT32,
+                metadata=None,
+                operation=Operation.UPDATE,
+            ),
+        )
+    for i in [3, 7]:
+        seq_id = producer.submit_embedding(
+            topic,
+            SubmitEmbeddingRecord(
+                id=embeddings[i]["id"],
+                embedding=None,
+                encoding=ScalarEncoding.FLOAT32,
+                metadata=None,
+                operation=Operation.DELETE,
+            ),
+        )
+    sync(segment, seq_id)
+
+    vectors = {r["id"]: r["embedding"] for r in segment.get_vectors()}
+    assert len(vectors) == 22
+
+    def expected(query_vector: Vector, ids: Sequence[str], k: int) -> List[str]:
+        return sorted(
+            ids,
+            key=lambda id: sum((a - b) ** 2 for a, b in zip(vectors[id], query_vector)),
+        )[:k]
+
+    query_vectors = [cast(Vector, embeddings[i]["embedding"]) for i in range(0, 10)]
+    query_vectors.append([101.0, 101.0])
+    query = VectorQuery(
+        vectors=query_vectors,
+        k=6,
+        allowed_ids=None,
+        options=None,
+        include_embeddings=True,
+    )
+    for query_vector, result in zip(query_vectors, segment.query_vectors(query)):
+        assert [r["id"] for r in result] == expected(query_vector, list(vectors), 6)
+        for r in result:
+            assert approx_equal_vector(cast(Vector, r["embedding"]), vectors[r["id"]])
+
+    allowed = [e["id"] for e in embeddings[:12]]
+    query["allowed_ids"] = allowed
+    live_allowed = [id for id in allowed if id in vectors]
+    for query_vector, result in zip(query_vectors, segment.query_vectors(query)):
+        assert [r["id"] for r in result] == expected(query_vector, live_allowed, 6)
+
+
+def _delete_record(id: str) -> SubmitEmbeddingRecord:
+    return SubmitEmbeddingRecord(
+        id=id,
+        embedding=None,
+        encoding=None,
+        metadata=None,
+        operation=Operation.DELETE,
+    )
+
+
+def test_compact(
+    system: System,
+    sample_embeddings: Iterator[SubmitEmbeddingRecord],
+    vector_reader: Type[VectorReader],
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    segment_definition = create_random_segment_definition()
+    segment_definition["metadata"] = {"hnsw:batch_size": 10, "hnsw:sync_threshold": 10}
+    topic = str(segment_definition["topic"])
+
+    segment = cast(LocalHnswSegment, vector_reader(system, segment_definition))
+    segment.start()
+    assert not segment.compact()
+
+    embeddings = [next(sample_embeddings) for i in range(60)]
+    for e in embeddings:
+        producer.submit_embedding(topic, e)
+    for e in embeddings[:40]:
+        seq_id = producer.submit_embedding(topic, _delete_record(e["id"]))
+    sync(segment, seq_id)
+
+    # Write while the compacted index is being built, these must be caught up
+    create_index = segment._create_index
+
+    def create_index_and_write(dimensionality: int, max_elements: int) -> Any:
+        index = create_index(dimensionality, max_elements)
+        for e in embeddings[40:45]:
+            producer.submit_embedding(topic, _delete_record(e["id"]))
+        for e in embeddings[:25]:
+            producer.submit_embedding(topic, e)
+        return index
+
+    segment._create_index = create_index_and_write  # type: ignore
+    assert segment.compact()
+    segment._create_index = create_index  # type: ignore
+
+    expected_ids = [e["id"] for e in embeddings[:25] + embeddings[45:]]
+    assert segment.count() == 40
+    assert sorted(r["id"] for r in segment.get_vectors()) == sorted(expected_ids)
+    # The 20 records live at the start of the compaction were relabeled, the 25
+    # added while it ran got new labels and the 5 deleted were caught up as deletes
+    assert segment._total_elements_added == 45
+    assert segment.compact()
+    assert segment._total_elements_added == 40
+    assert not segment.compact()
+
+    by_id = {e["id"]: cast(Vector, e["embedding"]) for e in embeddings}
+    query = VectorQuery(
+        vectors=[by_id[id] for id in expected_ids],
+        k=1,
+        allowed_ids=None,
+        options=None,
+        include_embeddings=False,
+    )
+    results = segment.query_vectors(query)
+    assert [r[0]["id"] for r in results] == expected_ids
+
+    # The compacted index keeps accepting writes
+    more = [next(sample_embeddings) for i in range(15)]
+    for e in more:
+        seq_id = producer.submit_embedding(topic, e)
+    sync(segment, seq_id)
+    assert segment.count() == 55
+    segment.stop()
+
+    if vector_reader == PersistentLocalHnswSegment:
+        reloaded = PersistentLocalHnswSegment(system, segment_definition)
+        reloaded.start()
+        assert sorted(r["id"] for r in reloaded.get_vectors()) == sorted(
+            expected_ids + [e["id"] for e in more]
+        )
+        reloaded.stop()
+
+
+def test_delete_and_add_in_one_batch(
+    system: System, sample_embeddings: Iterator[SubmitEmbeddingRecord]
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    segment_definition = create_random_segment_definition()
+    topic = str(segment_definition["topic"])
+
+    segment = LocalHnswSegment(system, segment_definition)
+    segment.start()
+
+    embeddings = [next(sample_embeddings) for i in range(10)]
+    producer.submit_embeddings(topic, embeddings)
+    # The ID keeps its label, so nothing is left marked as deleted
+    seq_ids = producer.submit_embeddings(
+        topic, [_delete_record(embeddings[0]["id"]), embeddings[0]]
+    )
+    sync(segment, seq_ids[-1])
+
+    assert segment.count() == 10
+    assert segment._total_elements_added == 10
+    assert segment._deleted_count() == 0
+    assert not segment.compact()
+    segment.stop()
+
+
+def test_compact_in_background(
+    system: System,
+    sample_embeddings: Iterator[SubmitEmbeddingRecord],
+    vector_reader: Type[VectorReader],
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    segment_definition = create_random_segment_definition()
+    segment_definition["metadata"] = {"hnsw:compaction_threshold": 0.25}
+    topic = str(segment_definition["topic"])
+
+    segment = cast(LocalHnswSegment, vector_reader(system, segment_definition))
+    segment.start()
+
+    embeddings = [next(sample_embeddings) for i in range(1200)]
+    for e in embeddings:
+        producer.submit_embedding(topic, e)
+    for e in embeddings[:400]:
+        seq_id = producer.submit_embedding(topic, _delete_record(e["id"]))
+    sync(segment, seq_id)
+
+    assert segment._compaction_thread is not None
+    segment._compaction_thread.join()
+    assert segment.count() == 800
+    assert segment._total_elements_added < 1200
+    segment.stop()
+
+
+def test_persistent_compaction_recovery(
+    system: System,
+    sample_embeddings: Iterator[SubmitEmbeddingRecord],
+) -> None:
+    producer = system.instance(Producer)
+    system.reset_state()
+    segment_definition = create_random_segment_definition()
+    segment_definition["metadata"] = {"hnsw:batch_size": 10, "hnsw:sync_threshold": 10}
+    topic = str(segment_definition["topic"])
+
+    segment = PersistentLocalHnswSegment(system, segment_definition)
+    segment.start()
+
+    embeddings = [next(sample_embeddings) for i in range(30)]
+    for e in embeddings:
+        producer.submit_embedding(topic, e)
+    for e in embeddings[:10]:
+        seq_id = producer.submit_embedding(topic, _delete_record(e["id"]))
+    sync(segment, seq_id)
+
+    # Simulate a crash while the compacted index is being built
+    def fail(dimensionality: int, max_elements: int) -> Any:
+        raise RuntimeError("crash")
+
+    segment._start_compaction()
+    segment._compaction_dirty_ids = set()
+    segment._create_index = fail  # type: ignore
+    with pytest.raises(RuntimeError):
+        segment._compact()
+    segment._compacting = False
+    segment.stop()
+
+    reloaded = PersistentLocalHnswSegment(system, segment_definition)
+    assert not os.path.exists(reloaded._get_precompaction_folder())
+    reloaded.start()
+    assert sorted(r["id"] for r in reloaded.get_vectors()) == sorted(
+        e["id"] for e in embeddings[10:]
+    )
+    reloaded.stop()
@@ -2,9 +2,11 @@
 import chromadb
 from chromadb.api.types import QueryResult
 from chromadb.config import Settings
+from chromadb.db.impl.sqlite import SqliteDB
 import chromadb.server.fastapi
 import pytest
 import tempfile
+import threading
 import numpy as np
 import os
 import shutil
@@ -82,6 +84,65 @@ def test_persist_index_loading(api_fixture, request):
         assert len(nn[key]) == 1
 
 
+def test_purge_embeddings_queue(request):
+    api = request.getfixturevalue("local_persist_api")
+    api.reset()
+    db = api._system.instance(SqliteDB)
+
+    def queue_size():
+        with db.tx() as cur:
+            return cur.execute("SELECT count(*) FROM embeddings_queue").fetchone()[0]
+
+    collection = api.create_collection(
+        "test", metadata={"hnsw:batch_size": 10, "hnsw:sync_threshold": 10}
+    )
+    collection.add(
+        ids=[str(i) for i in range(100)], embeddings=[[i, i] for i in range(100)]
+    )
+    # Both segments have persisted every record. The last one is kept so that SeqIDs
+    # keep increasing.
+    db.purge()
+    assert queue_size() == 1
+
+    # The vector segment has not persisted these yet, they must be kept to be
+    # replayed on restart
+    collection.add(
+        ids=[str(i) for i in range(100, 105)],
+        embeddings=[[i, i] for i in range(100, 105)],
+    )
+    db.purge()
+    assert queue_size() == 5
+
+    api2 = request.getfixturevalue("local_persist_api_cache_bust")
+    collection = api2.get_collection("test")
+    assert collection.count() == 105
+    result = collection.query(query_embeddings=[[104, 104]], n_results=1)
+    assert result["ids"] == [["104"]]
+
+
+def test_record_persisted_seq_id_does_not_wait_for_writers(request):
+    api = request.getfixturevalue("local_persist_api")
+    api.reset()
+    db = api._system.instance(SqliteDB)
+    collection = api.create_collection("test")
+    collection.add(ids=["0"], embeddings=[[0, 0]])
+    segment_id = db.get_segments(collection=collection.id)[0]["id"]
+
+    # Vector segments record their progress while holding their own lock, which a
+    # concurrent writer holding the write transaction may be waiting for
+    recorded = threading.Event()
+    with db.tx():
+        thread = threading.Thread(
+            target=lambda: (
+                db.record_persisted_seq_id(segment_id, 1),
+                recorded.set(),
+            )
+        )
+        thread.start()
+        assert recorded.wait(timeout=10)
+    thread.join()
+
+
 @pytest.mark.parametrize("api_fixture", [local_persist_api])
 def test_persist_index_loading_embedding_function(api_fixture, request):
     embedding_function = lambda x: [[1, 2, 3] for _ in range(len(x))]  # noqa E731
@@ -275,6 +336,20 @@ def test_delete(api):
     assert collection.count() == 0
 
 
+def test_compact(api):
+    api.reset()
+    collection = api.create_collection("testspace")
+    ids = [str(i) for i in range(300)]
+    collection.add(ids=ids, embeddings=[[float(i), float(i)] for i in range(300)])
+    collection.delete(ids=ids[:150])
+
+    assert collection.compact()
+    assert not collection.compact()
+    assert collection.count() == 150
+    result = collection.query(query_embeddings=[[10.0, 10.0]], n_results=1)
+    assert result["ids"] == [["150"]]
+
+
 def test_delete_with_index(api):
     api.reset()
     collection = api.create_collection("testspace")
@@ -291,6 +366,65 @@ def test_count(api):
     assert collection.count() == 2
 
 
+def test_count_where_and_statistics(api):
+    api.reset()
+    collection = api.create_collection("testspace")
+    collection.add(**contains_records)
+
+    assert collection.count(where={"int_value": {"$gt": 1}}) == 1
+    assert collection.count(where_document={"$contains": "great"}) == 2
+    count = collection.count(
+        where={"int_value": 1}, where_document={"$contains": "doc2"}
+    )
+    assert count == 0
+
+    collection.delete(ids=["id2"])
+    statistics = collection.statistics()
+    assert statistics == {
+        "count": 1,
+        "document_bytes": len("this is doc1 and it's great!"),
+        "adds": 2,
+        "updates": 0,
+        "upserts": 0,
+        "deletes": 1,
+    }
+
+
+def test_facets(api):
+    api.reset()
+    collection = api.create_collection("testspace")
+    collection.add(
+        ids=["a", "b", "c", "d"],
+        embeddings=[[1.0, 2.0]] * 4,
+        metadatas=[
+            {"source": "x.pdf", "page": 1},
+            {"source": "y.pdf", "page": 1},
+            {"source": "x.pdf", "page": 2},
+            {"page": 3},
+        ],
+        documents=["one", "two", "three", "four"],
+    )
+
+    assert collection.facets("source") == [
+        {"value": "x.pdf", "count": 2},
+        {"value": "y.pdf", "count": 1},
+    ]
+    assert collection.facets("page", where={"source": "x.pdf"}) == [
+        {"value": 1, "count": 1},
+        {"value": 2, "count": 1},
+    ]
+    assert collection.facets("source", where_document={"$contains": "t"}, limit=1) == [
+        {"value": "x.pdf", "count": 1}
+    ]
+
+    assert collection.facets("source", limit=0) == []
+
+    with pytest.raises(ValueError):
+        collection.facets("")
+    with pytest.raises(ValueError):
+        collection.facets("source", limit=-1)
+
+
 def test_modify(api):
     api.reset()
     collection = api.create_collection("testspace")
@@ -752,6 +886,39 @@ def test_get_where_document(api):
     assert len(items["metadatas"]) == 0
 
 
+def test_get_where_document_search(api):
+    api.reset()
+    collection = api.create_collection("test_get_where_document_search")
+    collection.add(**contains_records)
+
+    # Documents matching more of the terms come first
+    items = collection.get(where_document={"$search": "great doc1"})
+    assert items["ids"] == ["id1", "id2"]
+
+    items = collection.get(where_document={"$search": "also"})
+    assert items["ids"] == ["id2"]
+
+    items = collection.get(where_document={"$search": "bad"})
+    assert items["ids"] == []
+
+
+def test_get_sort(api):
+    api.reset()
+    collection = api.create_collection("test_get_sort")
+    collection.add(
+        ids=["a", "b", "c", "d"],
+        embeddings=[[1.0, 2.0]] * 4,
+        metadatas=[{"page": 2}, {"page": 1.5}, {"other": 1}, {"page": 3}],
+    )
+
+    assert collection.get(sort="page")["ids"] == ["b", "a", "d", "c"]
+    assert collection.get(sort="-page", limit=2)["ids"] == ["d", "a"]
+    assert collection.get(sort="-page", limit=2, offset=2)["ids"] == ["b", "c"]
+
+    with pytest.raises(ValueError):
+        collection.get(sort="-")
+
+
 def test_query_where_document(api):
     api.reset()
     collection = api.create_collection("test_query_where_document")
@@ -1078,6 +1245,30 @@ def test_invalid_index_params(api):
         )
         collection.add(**records)
 
+    with pytest.raises(Exception):
+        collection = api.create_collection(
+            name="test_index_params", metadata={"hnsw:encoding": "INT32"}
+        )
+        collection.add(**records)
+
+
+@pytest.mark.parametrize("encoding", ["FLOAT32", "FLOAT16", "INT8"])
+def test_vector_encodings(api, encoding):
+    api.reset()
+    collection = api.create_collection(
+        name="test_encodings", metadata={"hnsw:encoding": encoding}
+    )
+    rng = np.random.default_rng(0)
+    embeddings = rng.random((50, 16)).tolist()
+    collection.add(ids=[str(i) for i in range(50)], embeddings=embeddings)
+
+    result = collection.query(
+        query_embeddings=embeddings[:5], n_results=1, include=["embeddings"]
+    )
+    assert result["ids"] == [[str(i)] for i in range(5)]
+    for expected, found in zip(embeddings, result["embeddings"]):
+        assert np.allclose(expected, found[0], atol=1e-2)
+
 
 def test_persist_index_loading_params(api, request):
     api = request.getfixturevalue("local_persist_api")
@@ -14,6 +14,10 @@ NamespacedName = str
 class ScalarEncoding(Enum):
     FLOAT32 = "FLOAT32"
     INT32 = "INT32"
+    FLOAT16 = "FLOAT16"
+    # Each vector is scaled into int8 by its largest magnitude, and stored with its
+    # float32 scale
+    INT8 = "INT8"
 
 
 class SegmentScope(Enum):
@@ -75,6 +79,18 @@ class MetadataEmbeddingRecord(TypedDict):
     metadata: Optional[Metadata]
 
 
+class SegmentStatistics(TypedDict):
+    """Statistics of the records of a segment: how many there are, the total size of
+    their documents in bytes (UTF-8), and how many operations were applied"""
+
+    count: int
+    document_bytes: int
+    adds: int
+    updates: int
+    upserts: int
+    deletes: int
+
+
 class EmbeddingRecord(TypedDict):
     id: str
     seq_id: SeqId
@@ -128,10 +144,17 @@ Where = Dict[
     Union[str, LogicalOperator], Union[LiteralValue, OperatorExpression, List["Where"]]
 ]
 
-WhereDocumentOperator = Union[Literal["$contains"], LogicalOperator]
+WhereDocumentOperator = Union[Literal["$contains"], Literal["$search"], LogicalOperator]
 WhereDocument = Dict[WhereDocumentOperator, Union[str, List["WhereDocument"]]]
 
 
+class Facet(TypedDict):
+    """A distinct value of a metadata key, and the number of records with it"""
+
+    value: LiteralValue
+    count: int
+
+
 class Unspecified:
     """A sentinel value used to indicate that a value should not be updated"""
 
@@ -1,4 +1,4 @@
-from typing import Dict, Callable
+from typing import Dict, Callable, Sequence, Tuple
 import numpy as np
 import numpy.typing as npt
 
@@ -16,3 +16,118 @@ distance_functions: Dict[str, Callable[[npt.ArrayLike, npt.ArrayLike], float]] =
 l2 = distance_functions["l2"]
 cosine = distance_functions["cosine"]
 ip = distance_functions["ip"]
+
+
+def squared_norms(vectors: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    """Return the squared L2 norm of each row of a 2-D array. These are cached by
+    callers and passed to pairwise_distances to avoid recomputing them per query."""
+    return np.einsum("ij,ij->i", vectors, vectors)
+
+
+def pairwise_distances(
+    space: str,
+    queries: npt.NDArray[np.float32],
+    vectors: npt.NDArray[np.float32],
+    vector_squared_norms: npt.NDArray[np.float32],
+) -> npt.NDArray[np.float32]:
+    """Compute the (n_queries, n_vectors) distance matrix between two sets of row
+    vectors with a single matrix product. Results match the per-pair functions above
+    (and therefore hnswlib) up to floating point error, see nearest() for selecting
+    l2 neighbors from them."""
+    dot = queries @ vectors.T
+    if space == "l2":
+        distances = squared_norms(queries)[:, np.newaxis] - 2 * dot
+        distances += vector_squared_norms[np.newaxis, :]
+        # Cancellation can produce tiny negative values for (near) identical vectors
+        return np.maximum(distances, 0, out=distances)
+    elif space == "cosine":
+        query_norms = np.sqrt(squared_norms(queries)) + NORM_EPS
+        vector_norms = np.sqrt(vector_squared_norms) + NORM_EPS
+        return 1 - dot / query_norms[:, np.newaxis] / vector_norms[np.newaxis, :]
+    elif space == "ip":
+        return 1 - dot
+    else:
+        raise ValueError(f"Unknown distance function: {space}")
+
+
+def nearest(
+    space: str,
+    queries: npt.NDArray[np.float32],
+    vectors: npt.NDArray[np.float32],
+    vector_squared_norms: npt.NDArray[np.float32],
+    k: int,
+) -> Tuple[npt.NDArray[np.intp], npt.NDArray[np.float32]]:
+    """Return the row indices and distances of the k nearest vectors to each query,
+    as (n_queries, k') arrays sorted nearest first, like top_k over
+    pairwise_distances.
+
+    Expanding l2 into |q|^2 - 2 q.v + |v|^2 cancels most of the significant digits
+    when the vectors are far from the origin relative to the distances between
+    them. Every candidate whose float32 distance is within the rounding error bound
+    of the k-th one is therefore reranked from its exact float64 difference to the
+    query. Near the origin these are barely more than k candidates."""
+    distances = pairwise_distances(space, queries, vectors, vector_squared_norms)
+    n_queries, n_vectors = distances.shape
+    k = min(k, n_vectors)
+    if space != "l2" or k <= 0:
+        return top_k(distances, k)
+
+    # Bound on the rounding error of each float32 distance
+    eps = float(np.finfo(np.float32).eps)
+    query_norms = np.sqrt(squared_norms(queries).astype(np.float64))
+    max_norm = float(np.sqrt(vector_squared_norms.max()))
+    tolerance = (queries.shape[1] + 2) * eps * (query_norms + max_norm) ** 2
+    kth = np.partition(distances, k - 1, axis=1)[:, k - 1]
+    candidates = distances <= (kth + 2 * tolerance)[:, np.newaxis]
+
+    top = np.empty((n_queries, k), dtype=np.intp)
+    top_distances = np.empty((n_queries, k), dtype=np.float32)
+    for i in range(n_queries):
+        columns = np.flatnonzero(candidates[i])
+        differences = vectors[columns].astype(np.float64) - queries[i]
+        exact = np.einsum("ij,ij->i", differences, differences)
+        order = np.argsort(exact, kind="stable")[:k]
+        top[i] = columns[order]
+        top_distances[i] = exact[order]
+    return top, top_distances
+
+
+def top_k(
+    distances: npt.NDArray[np.float32], k: int
+) -> Tuple[npt.NDArray[np.intp], npt.NDArray[np.float32]]:
+    """Given an (n_queries, n_vectors) distance matrix, return the column indices and
+    distances of the k nearest vectors for each query, nearest first. Only the k
+    nearest columns of each row are sorted."""
+    n_queries, n_vectors = distances.shape
+    k = min(k, n_vectors)
+    if k <= 0:
+        return (
+            np.empty((n_queries, 0), dtype=np.intp),
+            np.empty((n_queries, 0), dtype=distances.dtype),
+        )
+    if k < n_vectors:
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(n_vectors), (n_queries, n_vectors))
+    top_distances = np.take_along_axis(distances, top, axis=1)
+    order = np.argsort(top_distances, axis=1, kind="stable")
+    return (
+        np.take_along_axis(top, order, axis=1),
+        np.take_along_axis(top_distances, order, axis=1),
+    )
+
+
+def merge_top_k(
+    distances: Sequence[npt.NDArray[np.float32]], k: int
+) -> Tuple[npt.NDArray[np.intp], npt.NDArray[np.intp], npt.NDArray[np.float32]]:
+    """Merge the candidates of several sources into the k nearest per query, in one
+    pass over all queries. Each source is an (n_queries, n_i) distance matrix, where
+    np.inf marks a candidate to exclude. Returns the source index, the column within
+    that source and the distance of each result, as (n_queries, k') arrays sorted
+    nearest first. Excluded candidates sort last with an infinite distance, and
+    callers should drop them. Ties favor earlier sources."""
+    merged = np.concatenate(distances, axis=1)
+    top, top_distances = top_k(merged, k)
+    offsets = np.cumsum([0] + [d.shape[1] for d in distances])
+    sources = np.searchsorted(offsets, top, side="right") - 1
+    return sources, top - offsets[sources], top_distances